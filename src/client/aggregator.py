@@ -0,0 +1,115 @@
+import math
+import time
+from typing import List, Optional
+
+from enums import (
+    AGGREGATE_FRAMES,
+    MAX_AGGREGATE_FRAMES,
+    ADAPTIVE_AGGREGATION,
+    BLOCK_DURATION,
+)
+from protocol import pack_audio_frame
+
+RTT_SMOOTHING = 0.2  # weight of a new RTT sample in the running average
+
+
+class FrameAggregator:
+    """
+    Packs consecutive Opus frames into one binary message.
+
+    Every message costs a syscall and a TCP push on the Pi, so under Wi-Fi contention
+    sending one message per frame is wasteful. Frames are held until frames_per_message
+    are pending, the sequence numbers stop being consecutive, or the oldest pending
+    frame has waited frames_per_message blocks (the beamformer stops producing frames
+    when nobody is talking, a partial batch must not sit forever).
+
+    With adaptive aggregation frames_per_message follows the measured round trip time:
+    batching for up to one RTT adds no more latency than the link already has.
+    """
+
+    def __init__(
+        self,
+        frames_per_message: int = AGGREGATE_FRAMES,
+        max_frames: int = MAX_AGGREGATE_FRAMES,
+        adaptive: bool = ADAPTIVE_AGGREGATION,
+    ) -> None:
+        self.min_frames = frames_per_message
+        self.max_frames = max(max_frames, frames_per_message)
+        self.frames_per_message = frames_per_message
+        self.adaptive = adaptive
+        self.rtt: Optional[float] = None
+        self._frames: List[bytes] = []
+        self._seq = 0
+        self._timestamp = 0.0
+        self._first_added = 0.0
+        # Sequence number of the last frame packed into a message
+        self.flushed_seq = -1
+        # counters for stats()
+        self.messages = 0
+        self.frames = 0
+        self._added_latency = 0.0
+
+    def add(self, seq: int, timestamp: float, packet: bytes) -> List[bytes]:
+        """
+        Queue one Opus frame.
+        :param seq: Sequence number of the frame.
+        :param timestamp: Capture timestamp of the frame.
+        :param packet: Opus packet.
+        :return: Messages ready to be sent, possibly empty.
+        """
+        messages = []
+        if self._frames and seq != self._seq + len(self._frames):
+            # Frames in a message are always consecutive
+            messages.append(self.flush())
+        if not self._frames:
+            self._seq = seq
+            self._timestamp = timestamp
+            self._first_added = time.monotonic()
+        self._frames.append(packet)
+        if len(self._frames) >= self.frames_per_message:
+            messages.append(self.flush())
+        return messages
+
+    def flush(self) -> bytes:
+        """
+        Pack every pending frame into one message.
+        """
+        message = pack_audio_frame(self._seq, self._timestamp, self._frames)
+        self.flushed_seq = self._seq + len(self._frames) - 1
+        self.messages += 1
+        self.frames += len(self._frames)
+        self._added_latency += time.monotonic() - self._first_added
+        self._frames = []
+        return message
+
+    def __len__(self) -> int:
+        return len(self._frames)
+
+    def timeout(self) -> Optional[float]:
+        """
+        Seconds until the pending frames have to be flushed, None if nothing is pending.
+        """
+        if not self._frames:
+            return None
+        deadline = self._first_added + self.frames_per_message * BLOCK_DURATION / 1000
+        return max(deadline - time.monotonic(), 0.0)
+
+    def update_rtt(self, rtt: float) -> None:
+        """
+        Feed one round trip time measurement (seconds) and adapt frames_per_message.
+        """
+        self.rtt = rtt if self.rtt is None else self.rtt + RTT_SMOOTHING * (rtt - self.rtt)
+        if self.adaptive:
+            frames = math.ceil(self.rtt * 1000 / BLOCK_DURATION)
+            self.frames_per_message = min(max(frames, self.min_frames), self.max_frames)
+
+    def stats(self) -> dict:
+        return {
+            "messages": self.messages,
+            "frames": self.frames,
+            "frames_per_message": self.frames_per_message,
+            "rtt_ms": None if self.rtt is None else round(self.rtt * 1000, 1),
+            "mean_added_latency_ms": round(
+                self._added_latency / max(self.messages, 1) * 1000, 1
+            ),
+        }
@@ -1,48 +1,273 @@
 import asyncio
+import base64
 import json
-from multiprocessing import Process, Queue
+import queue
 import sys
 import numpy as np
 import time
 import traceback
+import uuid
 
 import websockets
 from websockets.sync.client import connect
 
 import sounddevice as sd
 
-from encoder import encode_audio
-from beamforming import beamform_audio
+from encoder import PROFILE_NAMES
 from led_control import clear_leds, retry_connection_led
 
-from record import open, record, close
-from logger import logger
-from enums import retry_max, retry_delay, RATE, CHANNELS, CHUNK, RECORD, BLOCK_DURATION
-
-wav_file_output, wav_file_input = None, None
-file_name = time.time()
-if RECORD:
-    wav_file_output = open(f"recordings/output/{file_name}.wav")
-    wav_file_input = open(f"recordings/input/{file_name}.wav", 8)
-
-encoded_audio_queue = Queue()
-beamformed_audio_queue = Queue()
-raw_audio_queue = Queue()
-# define processes
-beamformer = Process(
-    target=beamform_audio,
-    args=(raw_audio_queue, beamformed_audio_queue),
+from pipeline import create_pipeline
+from protocol import (
+    FRAMING_BINARY,
+    FRAMING_JSON,
+    FLAG_REPLAY,
+    OPUS_PROFILES,
+    pack_audio_frame,
 )
-encoder = Process(
-    target=encode_audio,
-    args=(beamformed_audio_queue, encoded_audio_queue, wav_file_output),
+from aggregator import FrameAggregator
+from backlog import PacketBacklog
+from logger import logger
+from enums import (
+    retry_max,
+    retry_delay,
+    RATE,
+    CHANNELS,
+    CHUNK,
+    STATS_INTERVAL,
+    RTT_PROBE_INTERVAL,
+    MAX_REPLAY_FRAMES,
+    OPUS_PROFILE,
+    KWS_PRE_ROLL_SECONDS,
+    DEVICE_ID,
 )
 
+# Capture -> beamformer -> encoder, as processes or as threads (PIPELINE)
+pipeline = create_pipeline()
+raw_audio_ring = pipeline.raw_audio_ring
+beamformed_audio_ring = pipeline.beamformed_audio_ring
+encoded_audio_queue = pipeline.encoded_audio_queue
+opus_profile = pipeline.opus_profile
+wake_word = pipeline.wake_word
+throttle = pipeline.throttle
+beamformer = pipeline.beamformer
+encoder = pipeline.encoder
+# Packets kept for replay after a reconnect
+backlog = PacketBacklog()
+# Capture timestamp of the last local wake word the server was told about
+announced_wake_word = 0.0
+# Sequence numbers start over with the process, the server only dedupes within a stream
+stream_id = uuid.uuid4().hex
+
 
 def read_callback(in_data, _frame_count, _time_info, _status):
-    raw_audio_queue.put(in_data.copy())
-    if wav_file_input:
-        record(in_data, wav_file_input)
+    # Copied straight into the ring. A full ring drops the block and counts an overrun.
+    # Recording happens in the beamformer, off this thread.
+    raw_audio_ring.write(in_data)
+
+
+def negotiate_config(ws, timeout: float = 2.0) -> str:
+    """
+    Announce the stream format, ask the server for binary audio frames and propose
+    OPUS_PROFILE. DEVICE_ID names the server session, replies and wake word state are
+    never shared with other devices and survive reconnects. stream_id tells the server
+    whether the sequence numbers go on from the last connection. The server answers with
+    the framing and the Opus profile to use, the encoder process picks up the profile
+    from the shared opus_profile. Servers that do not answer the config message keep
+    getting base64-in-JSON with OPUS_PROFILE.
+    :param ws: Connected websocket.
+    :param timeout: Seconds to wait for the server reply.
+    :return: The framing to send audio with.
+    """
+    ws.send(
+        json.dumps(
+            {
+                "type": "config",
+                "sample_rate": RATE,
+                "channels": 1,
+                "framing": FRAMING_BINARY,
+                "opus_profile": OPUS_PROFILE,
+                "device_id": DEVICE_ID,
+                "stream_id": stream_id,
+            }
+        )
+    )
+    try:
+        reply = json.loads(ws.recv(timeout=timeout))
+    except (TimeoutError, ValueError):
+        logger.debug("No config reply from server, using JSON framing")
+        return FRAMING_JSON
+    if reply.get("type") != "config":
+        return FRAMING_JSON
+    profile = reply.get("opus_profile", OPUS_PROFILE)
+    if profile in OPUS_PROFILES:
+        opus_profile.value = PROFILE_NAMES.index(profile)
+    else:
+        logger.error(f"Unknown Opus profile {profile}, keeping {OPUS_PROFILE}")
+        opus_profile.value = PROFILE_NAMES.index(OPUS_PROFILE)
+    if reply.get("framing") == FRAMING_BINARY:
+        return FRAMING_BINARY
+    return FRAMING_JSON
+
+
+def json_audio_message(audio_data: bytes, replay: bool = False) -> str:
+    message = {"type": "audio", "data": base64.b64encode(audio_data).decode("utf-8")}
+    if replay:
+        message["replay"] = True
+    return json.dumps(message)
+
+
+def announce_wake_word(ws) -> None:
+    """
+    Tell the server about a wake word spotted on the device, ahead of the pre-roll
+    audio that holds it.
+    """
+    global announced_wake_word
+    if wake_word.value == announced_wake_word:
+        return
+    announced_wake_word = wake_word.value
+    ws.send(
+        json.dumps(
+            {
+                "type": "wake_word",
+                "timestamp": announced_wake_word,
+                "pre_roll": KWS_PRE_ROLL_SECONDS,
+            }
+        )
+    )
+
+
+def handle_server_messages(ws) -> None:
+    """
+    Take what the server sent since the last call. A throttle message means STT is
+    falling behind, the beamformer streams speech blocks only until the throttle is
+    lifted. Replies and thinking notices are only logged.
+    """
+    while True:
+        try:
+            message = ws.recv(timeout=0)
+        except TimeoutError:
+            return
+        try:
+            data = json.loads(message)
+        except ValueError:
+            logger.info(f"Server: {message}")
+            continue
+        if not isinstance(data, dict) or data.get("type") != "throttle":
+            logger.debug(f"Server: {data}")
+            continue
+        logger.info(f"Server throttle: {data}")
+        throttle.value = bool(data["active"])
+
+
+def replay_backlog(ws, framing: str) -> None:
+    """
+    Send what was captured while the connection was down.
+    Everything the encoder queued in the meantime goes through the backlog first. The
+    server gets a gap message with the last sequence number handed to the socket and
+    how many packets follow as replay and how many are lost, then the replayed
+    packets, marked with FLAG_REPLAY so it can fast-forward through them. With binary
+    framing the last BACKLOG_REPLAY_SECONDS are replayed whether they were sent or
+    not, a sent packet may have died in the socket buffer, the server drops the
+    duplicates by sequence number.
+    """
+    while True:
+        try:
+            backlog.add(*encoded_audio_queue.get_nowait())
+        except queue.Empty:
+            break
+    # A wake word spotted during the outage goes before its replayed pre-roll
+    announce_wake_word(ws)
+    replay, lost = backlog.recent(sent=framing == FRAMING_BINARY)
+    if backlog.last_sent_seq < 0 and not replay:
+        # First connection, nothing to report
+        return
+    ws.send(
+        json.dumps(
+            {
+                "type": "gap",
+                "last_seq": backlog.last_sent_seq,
+                "replayed": len(replay),
+                "lost": lost,
+            }
+        )
+    )
+    logger.debug(f"Replaying {len(replay)} packets, {lost} lost: {backlog.stats()}")
+    if framing == FRAMING_JSON:
+        for seq, _timestamp, packet in replay:
+            ws.send(json_audio_message(packet, replay=True))
+            backlog.mark_sent(seq)
+        return
+    start = 0
+    while start < len(replay):
+        # Runs of consecutive packets, at most MAX_REPLAY_FRAMES per message
+        end = start + 1
+        while (
+            end < len(replay)
+            and end - start < MAX_REPLAY_FRAMES
+            and replay[end][0] == replay[end - 1][0] + 1
+        ):
+            end += 1
+        seq, timestamp, _packet = replay[start]
+        frames = [packet for _seq, _timestamp, packet in replay[start:end]]
+        ws.send(pack_audio_frame(seq, timestamp, frames, flags=FLAG_REPLAY))
+        backlog.mark_sent(replay[end - 1][0])
+        start = end
+
+
+def send_audio(ws, framing: str) -> None:
+    """
+    Forward encoded frames to the server until the connection drops.
+    With binary framing consecutive frames are aggregated into one message and the
+    round trip time is probed with websocket pings to adapt the aggregation. Every
+    packet goes through the backlog, so whatever the socket did not take is replayed
+    on the next connection.
+    """
+    # A new connection starts unthrottled
+    throttle.value = False
+    replay_backlog(ws, framing)
+    aggregator = FrameAggregator()
+    pong_waiter, ping_sent = None, 0.0
+    next_probe = time.monotonic()
+    while True:
+        if framing == FRAMING_BINARY:
+            now = time.monotonic()
+            if pong_waiter is not None and pong_waiter.is_set():
+                aggregator.update_rtt(now - ping_sent)
+                pong_waiter = None
+            if pong_waiter is None and now >= next_probe:
+                pong_waiter, ping_sent = ws.ping(), now
+                next_probe = now + RTT_PROBE_INTERVAL
+        try:
+            seq, timestamp, audio_data = encoded_audio_queue.get(
+                timeout=aggregator.timeout()
+            )
+        except queue.Empty:
+            # The oldest pending frame has waited long enough
+            ws.send(aggregator.flush())
+            backlog.mark_sent(aggregator.flushed_seq)
+            continue
+        except Exception as e:
+            logger.error(f"Error in getting audio data: {e}")
+            continue
+        if len(audio_data) == 0:
+            continue
+        handle_server_messages(ws)
+        if len(aggregator) and wake_word.value != announced_wake_word:
+            # Frames from before the wake word are not part of its session
+            ws.send(aggregator.flush())
+            backlog.mark_sent(aggregator.flushed_seq)
+        announce_wake_word(ws)
+        backlog.add(seq, timestamp, audio_data)
+        if framing == FRAMING_BINARY:
+            for message in aggregator.add(seq, timestamp, audio_data):
+                ws.send(message)
+                backlog.mark_sent(aggregator.flushed_seq)
+            if aggregator.messages and aggregator.messages % STATS_INTERVAL == 0:
+                logger.debug(f"Frame aggregation: {aggregator.stats()}")
+                logger.debug(f"Backlog: {backlog.stats()}")
+        else:
+            ws.send(json_audio_message(audio_data))
+            backlog.mark_sent(seq)
 
 
 def run():
@@ -50,10 +275,25 @@ def run():
     port = 8765
     source = 2
     retry_count = 0
+    # Capture keeps running across reconnects, the backlog holds the audio captured
+    # while the socket is down
+    stream = sd.InputStream(
+        device=source,
+        channels=CHANNELS,
+        samplerate=RATE,
+        callback=read_callback,
+        dtype=np.int16,
+        blocksize=CHUNK,
+    )
     while retry_count < retry_max:
         try:
             with connect(uri=f"ws://{host}:{port}") as ws:  # type: ignore
                 logger.debug("Socket connected")
+                framing = negotiate_config(ws)
+                logger.debug(
+                    f"Audio framing: {framing}, "
+                    f"Opus profile: {PROFILE_NAMES[opus_profile.value]}"
+                )
                 logger.debug("Starting audio stream")
                 try:
                     # Start the beamformer
@@ -63,31 +303,9 @@ def run():
                     if not encoder.is_alive():
                         encoder.start()
 
-                    with sd.InputStream(
-                        device=source,
-                        channels=CHANNELS,
-                        samplerate=RATE,
-                        callback=read_callback,
-                        dtype=np.int16,
-                        blocksize=CHUNK,
-                    ):
-                        while True:
-                            try:
-                                audio_data = encoded_audio_queue.get()
-                            except Exception as e:
-                                logger.error(f"Error in getting audio data: {e}")
-                                continue
-                            # logger.debug(f"Got encoded audio data with len: {len(audio_data)}")
-                            # logger.debug("Sending audio data to server")
-                            if len(audio_data) > 0:
-                                ws.send(
-                                    json.dumps({"type": "audio", "data": audio_data})
-                                )
-                            # else:
-                            #     # continue
-                            #     sd.sleep(
-                            #         BLOCK_DURATION / 2000
-                            #     )  # sleep for BLOCK_DURATION / 2 in ms
+                    if not stream.active:
+                        stream.start()
+                    send_audio(ws, framing)
                 except websockets.exceptions.ConnectionClosed:
                     logger.error("Connection closed, attempting to reconnect...")
 
@@ -116,10 +334,6 @@ def run():
                     encoder.terminate()
                     clear_leds()
                     break  # close connection and reconnect
-                finally:
-                    if RECORD:
-                        close(wav_file_output)
-                        close(wav_file_input)
         # Exceptions
         except websockets.exceptions.ConnectionClosed:
             logger.error("Connection closed, attempting to reconnect...")
@@ -166,9 +380,13 @@ def run():
                 raise e
         else:
             logger.debug("Maximum retry attempts reached. Shutting down.")
+    stream.close()
     clear_leds()
     beamformer.terminate() if beamformer.is_alive() else beamformer.join()
     encoder.terminate() if encoder.is_alive() else encoder.join()
+    for ring in (raw_audio_ring, beamformed_audio_ring):
+        ring.close()
+        ring.unlink()
 
 
 if __name__ == "__main__":
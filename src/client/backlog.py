@@ -0,0 +1,85 @@
+import time
+from collections import deque
+from typing import Deque, List, Tuple
+
+from enums import BACKLOG_SECONDS, BACKLOG_REPLAY_SECONDS, BLOCK_DURATION
+
+Packet = Tuple[int, float, bytes]  # (seq, capture timestamp, Opus packet)
+
+
+class PacketBacklog:
+    """
+    Bounded history of the encoded packets, used to replay audio lost to a dropped
+    connection.
+
+    Every packet is added before it is sent, and mark_sent() records the highest
+    sequence number the socket accepted. That only means the bytes reached the kernel,
+    packets written into a dying connection are lost all the same, so after a
+    reconnect recent() returns every packet of the last replay_seconds of capture time,
+    sent or not, and the server drops the ones it already has by sequence number. A
+    long outage does not turn into a long stale replay. At most BACKLOG_SECONDS of
+    packets are held, older ones are evicted and counted when they were never sent.
+    """
+
+    def __init__(
+        self,
+        seconds: float = BACKLOG_SECONDS,
+        replay_seconds: float = BACKLOG_REPLAY_SECONDS,
+    ) -> None:
+        self.packets: Deque[Packet] = deque(
+            maxlen=int(seconds * 1000 / BLOCK_DURATION)
+        )
+        self.replay_seconds = replay_seconds
+        self.last_sent_seq = -1
+        # counters for stats()
+        self.evicted = 0
+        self._evicted_unreported = 0
+        self.replayed = 0
+        self.expired = 0
+
+    def add(self, seq: int, timestamp: float, packet: bytes) -> None:
+        if (
+            len(self.packets) == self.packets.maxlen
+            and self.packets[0][0] > self.last_sent_seq
+        ):
+            self.evicted += 1
+            self._evicted_unreported += 1
+        self.packets.append((seq, timestamp, packet))
+
+    def mark_sent(self, seq: int) -> None:
+        self.last_sent_seq = max(self.last_sent_seq, seq)
+
+    def recent(self, sent: bool = True) -> Tuple[List[Packet], int]:
+        """
+        Packets to replay after a reconnect.
+        :param sent: Include the packets already handed to the socket. Only for
+        servers that drop duplicates by sequence number (binary framing).
+        :return: The packets captured within the last replay_seconds, oldest first,
+        and the number of unsent packets lost since the last call, because they were
+        too old to be replayed or evicted from the backlog.
+        """
+        oldest = time.time() - self.replay_seconds
+        unsent = [packet for packet in self.packets if packet[0] > self.last_sent_seq]
+        replay = [
+            packet
+            for packet in (self.packets if sent else unsent)
+            if packet[1] >= oldest
+        ]
+        expired = sum(1 for packet in unsent if packet[1] < oldest)
+        self.replayed += len(replay)
+        self.expired += expired
+        if expired:
+            # Expired packets are given up on, never offer them again
+            self.mark_sent(unsent[expired - 1][0])
+        lost = expired + self._evicted_unreported
+        self._evicted_unreported = 0
+        return replay, lost
+
+    def stats(self) -> dict:
+        return {
+            "held": len(self.packets),
+            "last_sent_seq": self.last_sent_seq,
+            "replayed": self.replayed,
+            "expired": self.expired,
+            "evicted": self.evicted,
+        }
@@ -1,15 +1,23 @@
+import time
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 from scipy.interpolate import interp1d
 
-from multiprocessing import Queue
+from ring_buffer import SharedRingBuffer
 from tdoa import calculate_doa
 
+from multiprocessing.sharedctypes import Synchronized
 from typing import Tuple
 from numpy.typing import NDArray
 
 import strength as str
-from fir_filter import apply_fir_filter
-from led_control import set_leds, clear_leds
+from fir_filter import StreamingFIR
+from vad import VoiceActivityDetector
+from led_control import LedRenderer, ThetaSmoother
+from record import AsyncRecorder
+from utils import StageTimer
+from governor import CpuGovernor
+from kws import KeywordSpotter, WakeWordGate, load_model
 
 from logger import logger
 
@@ -20,6 +28,22 @@ from enums import (
     CHUNK,
     CHANNELS,
     mic_positions_3d,
+    SPEED_OF_SOUND,
+    FRACTIONAL_DELAY_HALF_TAPS,
+    AZIMUTH_GRID_STEP,
+    STATS_INTERVAL,
+    BLOCK_DURATION,
+    VAD,
+    KWS,
+    KWS_MODEL,
+    RECORD,
+    BEAMFORMER_MODE,
+    MVDR_FRAME,
+    MVDR_FORGETTING,
+    MVDR_DIAGONAL_LOADING,
+    MVDR_COVARIANCE_TOLERANCE,
+    SRP_MIN_FREQUENCY,
+    SRP_MAX_FREQUENCY,
 )
 
 # Strength tracker parameters
@@ -30,13 +54,78 @@ str_tracker = str.SignalStrengthTracker(
     smoothing_window=30, silence_threshold=STRENGHT_THRESHOLD
 )  # processes each "chunk"
 
+# Largest relative delay (in samples) the array can produce: the aperture of the array.
+MAX_DELAY_SAMPLES = int(
+    np.ceil(
+        np.max(
+            np.linalg.norm(
+                mic_positions_3d[:, np.newaxis, :] - mic_positions_3d[np.newaxis, :, :],
+                axis=-1,
+            )
+        )
+        / SPEED_OF_SOUND
+        * RATE
+    )
+)
+# Constant latency added to every channel so all steering delays are causal.
+BULK_DELAY_SAMPLES = MAX_DELAY_SAMPLES + FRACTIONAL_DELAY_HALF_TAPS
+NUM_TAPS = 2 * BULK_DELAY_SAMPLES + 1
+
+
+def create_wake_word_gate(path: str = KWS_MODEL) -> WakeWordGate | None:
+    try:
+        return WakeWordGate(KeywordSpotter(load_model(path)))
+    except Exception as e:
+        logger.error(f"Could not load the keyword model {path}, streaming all audio: {e}")
+        return None
+
 
-def beamform_audio(raw_audio_queue: Queue, beamformed_audio_queue: Queue):
+def beamform_audio(
+    raw_audio_ring: SharedRingBuffer,
+    beamformed_audio_ring: SharedRingBuffer,
+    wake_word: Synchronized,
+    throttle: Synchronized,
+):
+    """
+    :param wake_word: Set to the capture timestamp of every local wake word detection,
+    for the sender to announce it.
+    :param throttle: Set while the server is behind, only the blocks the VAD classifies
+    as speech are streamed then, whether VAD gating is on or not.
+    """
     logger.debug("Starting beamformer")
+    chunk_count = 0
+    # LED I/O runs in its own thread of the beamformer process
+    led_renderer = LedRenderer()
+    led_renderer.start()
+    # Raw input and beamformed output are recorded side by side, block aligned
+    recorder = AsyncRecorder({"input": CHANNELS, "output": 1}) if RECORD else None
+    # Nothing is streamed before the wake word is spotted on the device
+    wake_word_gate = create_wake_word_gate() if KWS else None
 
     while True:
-        # get audio from queue
-        audio_data: NDArray[np.int16] = raw_audio_queue.get()
+        # get a view of the next captured block
+        block = raw_audio_ring.peek(timeout=2 * BLOCK_DURATION / 1000)
+        if block is None:
+            continue
+        _seq, timestamp, audio_data = block
+        cycle_start = time.perf_counter()
+        chunk_count += 1
+        if chunk_count % STATS_INTERVAL == 0:
+            logger.debug(f"Governor: {governor.stats()}")
+            logger.debug(f"Steering cache: {steering_cache.stats()}")
+            if BEAMFORMER_MODE == "mvdr":
+                logger.debug(f"MVDR: {mvdr_beamformer.stats()}")
+            logger.debug(f"VAD: {vad.stats()}")
+            if wake_word_gate:
+                logger.debug(f"Wake word: {wake_word_gate.stats()}")
+            logger.debug(f"Stage latency (us): {stage_timer.percentiles()}")
+            logger.debug(f"LED renderer: {led_renderer.stats()}")
+            if recorder:
+                logger.debug(f"Recorder: {recorder.stats()}")
+            logger.debug(
+                f"Raw ring: {raw_audio_ring.stats()}, "
+                f"beamformed ring: {beamformed_audio_ring.stats()}"
+            )
         reshaped_audio_data = None
         try:
             reshaped_audio_data = np.reshape(audio_data, (CHUNK, CHANNELS)).T
@@ -45,41 +134,420 @@ def beamform_audio(raw_audio_queue: Queue, beamformed_audio_queue: Queue):
         except Exception as e:
             logger.error(f"Error in reshaping audio: {e}")
             reshaped_audio_data = audio_data
-        # Apply FIR filter # TODO: Fix this
-        # reshaped_audio_data = apply_fir_filter(reshaped_audio_data, RATE)
+        # Apply FIR filter
+        reshaped_audio_data = filter_audio(reshaped_audio_data)
         # beamform
         try:
             beamformed_audio, doa_angle, strength = process_audio(reshaped_audio_data)
+            if recorder:
+                # The raw block is a view into the ring, copy it before advance()
+                recorder.write(timestamp, input=audio_data, output=beamformed_audio)
         except Exception as e:
             logger.error(f"Error in beamforming: {e}")
             raise e
+        finally:
+            # the raw block has been consumed, hand the slot back to the callback
+            raw_audio_ring.advance()
         # logger.debug(f"DOA: {doa_angle}, Strength: {strength}")
         if strength > STRENGHT_THRESHOLD:
             # set leds
-            set_leds(doa_angle, strength)
-            beamformed_audio_queue.put(beamformed_audio)
+            led_renderer.submit(doa_angle, strength)
         else:
             # clear leds
-            clear_leds()
-            # i think this should be enough to make the server not play the audio
-            # beamformed_audio_queue.put(silent_waveform)
+            led_renderer.clear()
+        throttled = bool(throttle.value)
+        if VAD or throttled:
+            # Only speech, with its leading context and hangover, reaches the encoder
+            with stage_timer.stage("vad"):
+                frames = vad.process(beamformed_audio, timestamp)
+            if throttled:
+                # Pauses, leading context and hangover are left out too
+                frames = frames[-1:] if vad.speech else []
+        elif strength > STRENGHT_THRESHOLD:
+            frames = [(beamformed_audio, timestamp)]
+        else:
+            frames = []
+        if wake_word_gate:
+            with stage_timer.stage("kws"):
+                frames, detected = wake_word_gate.process(
+                    beamformed_audio,
+                    timestamp,
+                    frames,
+                    vad.active if VAD else strength > STRENGHT_THRESHOLD,
+                )
+            if detected:
+                logger.debug(f"Wake word detected: {wake_word_gate.stats()}")
+                # Announced before the pre-roll reaches the encoder
+                wake_word.value = timestamp
+        for frame, frame_timestamp in frames:
+            beamformed_audio_ring.write(frame, frame_timestamp)
+        governor.end_chunk(time.perf_counter() - cycle_start)
+
+
+def filter_audio(audio: NDArray[np.int16]) -> NDArray[np.int16]:
+    # High pass FIR, unless the governor dropped it to save CPU
+    global fir_active
+    if not governor.mode.fir:
+        fir_active = False
+        return audio
+    if not fir_active:
+        # Stale history from before the FIR was switched off would click
+        streaming_fir.reset()
+        fir_active = True
+    with stage_timer.stage("fir"):
+        return streaming_fir.process(audio)
+
+
+def calculate_delays(mic_positions, theta, speed_of_sound=SPEED_OF_SOUND, fs=16000):
+    # theta is the azimuth in radians, as returned by calculate_doa.
+    # phi is the elevation above the plane of the array.
+    phi = np.radians(0)
+
+    # Calculate the unit vector pointing at the source
+    unit_vector = np.array(
+        [np.cos(theta) * np.cos(phi), np.sin(theta) * np.cos(phi), np.sin(phi)]
+    )
+
+    # Calculate the delays in seconds
+    delays_in_seconds = np.dot(mic_positions, unit_vector) / speed_of_sound
+
+    # Normalize the delays to be relative to the first microphone
+    delays_in_seconds -= delays_in_seconds[0]
+
+    # Convert delays from seconds to samples by multiplying with the sampling rate
+    # delays_in_samples = delays_in_seconds * fs
+
+    # return delays_in_samples
+    return delays_in_seconds
+
+
+class FractionalDelayBeamformer:
+    """
+    Streaming delay-and-sum beamformer.
+
+    All channels are delayed with a bank of windowed-sinc fractional delay filters and
+    summed in a single NumPy operation. The last NUM_TAPS - 1 samples of every channel
+    are carried over to the next chunk so the output is continuous across block edges.
+    """
+
+    def __init__(self, channels=CHANNELS, chunk=CHUNK, num_taps=NUM_TAPS):
+        self.channels = channels
+        self.chunk = chunk
+        self.num_taps = num_taps
+        self.history = num_taps - 1
+        # [history | current chunk] for every channel
+        self.buffer = np.zeros((channels, self.history + chunk), dtype=np.float32)
+
+    def process(
+        self, audio_data_2d: NDArray[np.int16], taps: NDArray[np.float32]
+    ) -> NDArray[np.int16]:
+        assert audio_data_2d.shape == (
+            self.channels,
+            self.chunk,
+        ), "Mismatch between audio shape and beamformer configuration"
+        assert taps.shape == (
+            self.channels,
+            self.num_taps,
+        ), "Mismatch between number of channels and delay filters"
+
+        # Keep the tail of the previous chunk and append the new one
+        self.buffer[:, : self.history] = self.buffer[:, self.chunk :]
+        self.buffer[:, self.history :] = audio_data_2d
+
+        # windows[c, n, k] = buffer[c, n + k], so the taps are applied reversed
+        windows = sliding_window_view(self.buffer, self.num_taps, axis=1)
+        result = np.einsum("cnk,ck->n", windows, taps[:, ::-1], optimize=True)
+        result /= self.channels
+
+        return np.clip(result, -32768, 32767).astype(np.int16)
+
+    def reset(self):
+        self.buffer.fill(0)
+
+
+def design_fractional_delay_filters(
+    delays, fs=RATE, half_taps=FRACTIONAL_DELAY_HALF_TAPS
+) -> NDArray[np.float32]:
+    """
+    Build one windowed-sinc fractional delay filter per channel.
+
+    Parameters:
+    delays: Per channel delays in seconds, as returned by calculate_delays.
+    fs: Sampling frequency.
+    half_taps: One sided length of the sinc kernel.
+
+    Returns:
+    taps: (channels, NUM_TAPS) filter bank. Every channel is delayed by
+    BULK_DELAY_SAMPLES on top of its steering delay.
+    """
+    bulk_delay = MAX_DELAY_SAMPLES + half_taps
+    num_taps = 2 * bulk_delay + 1
+    delays_in_samples = np.clip(
+        np.asarray(delays) * fs, -MAX_DELAY_SAMPLES, MAX_DELAY_SAMPLES
+    )
+    # Distance of every tap from the (fractional) centre of each channel's kernel
+    t = np.arange(num_taps)[np.newaxis, :] - (bulk_delay + delays_in_samples)[:, np.newaxis]
+    window = np.where(
+        np.abs(t) <= half_taps + 1, 0.5 * (1 + np.cos(np.pi * t / (half_taps + 1))), 0.0
+    )
+    taps = np.sinc(t) * window
+    # Unity gain at DC
+    taps /= np.sum(taps, axis=1, keepdims=True)
+    return taps.astype(np.float32)
+
+
+class SteeringCache:
+    """
+    Steering delays and fractional delay filters for every azimuth on the
+    AZIMUTH_GRID_STEP grid, so the per chunk steering is a table lookup.
+    """
+
+    def __init__(
+        self, mic_positions=mic_positions_3d, grid_step=AZIMUTH_GRID_STEP, precompute=True
+    ):
+        self.mic_positions = mic_positions
+        self.grid_step = np.radians(grid_step)
+        self.size = int(round(2 * np.pi / self.grid_step))
+        channels = mic_positions.shape[0]
+        self.delays = np.zeros((self.size, channels), dtype=np.float64)
+        self.taps = np.zeros((self.size, channels, NUM_TAPS), dtype=np.float32)
+        self.filled = np.zeros(self.size, dtype=bool)
+        self.hits = 0
+        self.misses = 0
+        if precompute:
+            for index in range(self.size):
+                self._fill(index)
+
+    def _fill(self, index: int) -> None:
+        delays = calculate_delays(self.mic_positions, index * self.grid_step)
+        self.delays[index] = delays
+        self.taps[index] = design_fractional_delay_filters(delays)
+        self.filled[index] = True
+
+    def quantize(self, theta) -> int:
+        return int(round(theta / self.grid_step)) % self.size
+
+    def lookup(self, theta) -> Tuple[NDArray[np.float64], NDArray[np.float32]]:
+        index = self.quantize(theta)
+        if self.filled[index]:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self._fill(index)
+        return self.delays[index], self.taps[index]
+
+    def stats(self) -> dict:
+        return {"size": self.size, "hits": self.hits, "misses": self.misses}
+
+
+class MvdrBeamformer:
+    """
+    Streaming MVDR beamformer in the STFT domain.
+
+    Every chunk is cut into frames of `frame` samples with a hop of `hop`, analysed and
+    resynthesised with a square root Hann window (perfect reconstruction at 50 %
+    overlap), so the output lags the input by frame - hop samples. In the speech band
+    the weights are w = R^-1 a / (a^H R^-1 a) for the steering vector a and the noise
+    spatial covariance R of every bin, outside it they are plain delay-and-sum.
+
+    R starts as the coherence of a spherically diffuse noise field, which makes the
+    beamformer superdirective until noise has been observed, and is then updated
+    recursively from the chunks the caller marks as noise only. The weights are cached
+    and only solved again (one batched solve over all bins) when the steering azimuth
+    changes or R has moved by more than covariance_tolerance since the last solve.
+    """
+
+    def __init__(
+        self,
+        mic_positions=mic_positions_3d,
+        chunk=CHUNK,
+        frame=MVDR_FRAME,
+        fs=RATE,
+        forgetting=MVDR_FORGETTING,
+        diagonal_loading=MVDR_DIAGONAL_LOADING,
+        covariance_tolerance=MVDR_COVARIANCE_TOLERANCE,
+        speed_of_sound=SPEED_OF_SOUND,
+    ):
+        assert chunk % (frame // 2) == 0, "The chunk must be a whole number of hops"
+        self.channels = mic_positions.shape[0]
+        self.chunk = chunk
+        self.frame = frame
+        self.hop = frame // 2
+        self.forgetting = forgetting
+        self.diagonal_loading = diagonal_loading
+        self.covariance_tolerance = covariance_tolerance
+        self.window = np.sqrt(np.hanning(frame + 1)[:-1]).astype(np.float32)
+        self.frequencies = np.fft.rfftfreq(frame, d=1 / fs)
+        self.bins = np.flatnonzero(
+            (self.frequencies >= SRP_MIN_FREQUENCY)
+            & (self.frequencies <= SRP_MAX_FREQUENCY)
+        )
+        # Diffuse noise coherence between every pair of microphones
+        distances = np.linalg.norm(
+            mic_positions[:, np.newaxis, :] - mic_positions[np.newaxis, :, :], axis=-1
+        )
+        self.noise_covariance = np.sinc(
+            2
+            * self.frequencies[self.bins, np.newaxis, np.newaxis]
+            * distances[np.newaxis, :, :]
+            / speed_of_sound
+        ).astype(np.complex64)
+        self.solved_covariance = self.noise_covariance.copy()
+        self.steering_index = None
+        self.weights = np.zeros((len(self.frequencies), self.channels), np.complex64)
+        self.solves = 0
+        self.noise_updates = 0
+        # [last frame - hop input samples | chunk] and the overlap-add tail
+        self.input_buffer = np.zeros(
+            (self.channels, self.frame - self.hop + chunk), dtype=np.float32
+        )
+        self.output_tail = np.zeros(self.frame - self.hop, dtype=np.float32)
+
+    def steering_vectors(self, delays) -> NDArray[np.complex64]:
+        # Undo the exp(-j w t) arrival phase: channels that hear the source early
+        # (positive delay from calculate_delays) are delayed the most
+        return np.exp(
+            2j * np.pi * self.frequencies[:, np.newaxis] * np.asarray(delays)[np.newaxis, :]
+        ).astype(np.complex64)
+
+    def update_noise(self, spectra: NDArray[np.complex64]) -> None:
+        # spectra: (bins, channels, frames) of a noise only chunk
+        frames = spectra.shape[2]
+        sample_covariance = spectra @ spectra.conj().transpose(0, 2, 1) / frames
+        alpha = self.forgetting**frames
+        self.noise_covariance *= alpha
+        self.noise_covariance += (1 - alpha) * sample_covariance
+        self.noise_updates += 1
+
+    def solve(self, steering: NDArray[np.complex64]) -> None:
+        covariance = self.noise_covariance
+        # Diagonal loading relative to the power of each bin keeps the white noise
+        # gain bounded where the array is small compared to the wavelength
+        loading = self.diagonal_loading * np.trace(covariance, axis1=1, axis2=2).real
+        loaded = covariance + (loading / self.channels)[:, np.newaxis, np.newaxis] * (
+            np.eye(self.channels, dtype=np.complex64)
+        )
+        a = steering[self.bins]
+        r_inv_a = np.linalg.solve(loaded, a[:, :, np.newaxis])[:, :, 0]
+        denominator = np.einsum("fc,fc->f", a.conj(), r_inv_a)
+        # Delay-and-sum outside the speech band
+        self.weights = steering / self.channels
+        self.weights[self.bins] = r_inv_a / denominator[:, np.newaxis]
+        self.solved_covariance = covariance.copy()
+        self.solves += 1
+
+    def covariance_changed(self) -> bool:
+        change = np.linalg.norm(self.noise_covariance - self.solved_covariance)
+        return change > self.covariance_tolerance * np.linalg.norm(self.solved_covariance)
+
+    def process(
+        self,
+        audio_data_2d: NDArray[np.int16],
+        steering_index: int,
+        delays,
+        noise_only: bool,
+    ) -> NDArray[np.int16]:
+        """
+        :param audio_data_2d: (channels, chunk) block.
+        :param steering_index: Quantized azimuth (SteeringCache.quantize), weights are
+        solved again when it changes.
+        :param delays: Steering delays in seconds for that azimuth.
+        :param noise_only: The chunk holds no speech and updates the noise covariance.
+        :return: (chunk,) beamformed block, delayed by frame - hop samples.
+        """
+        history = self.frame - self.hop
+        self.input_buffer[:, :history] = self.input_buffer[:, self.chunk :]
+        self.input_buffer[:, history:] = audio_data_2d
+        frames = sliding_window_view(self.input_buffer, self.frame, axis=1)[
+            :, :: self.hop
+        ]
+        # (channels, frames, frequencies)
+        spectra = np.fft.rfft(frames * self.window, axis=-1).astype(np.complex64)
+
+        if noise_only:
+            self.update_noise(spectra[:, :, self.bins].transpose(2, 0, 1))
+        if steering_index != self.steering_index or (
+            noise_only and self.covariance_changed()
+        ):
+            self.steering_index = steering_index
+            self.solve(self.steering_vectors(delays))
+
+        output_spectra = np.einsum("fc,ctf->tf", self.weights.conj(), spectra)
+        output_frames = np.fft.irfft(output_spectra, n=self.frame, axis=-1) * self.window
+        # Overlap-add
+        output = np.zeros(self.chunk + history, dtype=np.float32)
+        output[:history] = self.output_tail
+        for index, output_frame in enumerate(output_frames):
+            start = index * self.hop
+            output[start : start + self.frame] += output_frame
+        self.output_tail = output[self.chunk :].copy()
+        return np.clip(output[: self.chunk], -32768, 32767).astype(np.int16)
+
+    def stats(self) -> dict:
+        return {"solves": self.solves, "noise_updates": self.noise_updates}
+
+
+streaming_fir = StreamingFIR(RATE)
+beamformer = FractionalDelayBeamformer()
+mvdr_beamformer = MvdrBeamformer()
+steering_cache = SteeringCache()
+vad = VoiceActivityDetector()
+# Classifies the raw chunk on the first microphone for the MVDR noise covariance, its
+# own noise floor, so vad only ever tracks the beamformed signal
+reference_vad = VoiceActivityDetector()
+theta_smoother = ThetaSmoother()
+stage_timer = StageTimer()
+governor = CpuGovernor()
+fir_active = governor.mode.fir
+# Steering of the last DOA estimate, reused while the governor skips DOA
+delays, taps = steering_cache.lookup(0)
 
 
 def process_audio(
     audio: NDArray[np.int16],
 ) -> Tuple[NDArray[np.int16], np.float64, np.float64]:
     # Get theta from TDOA
-    theta = calculate_doa(audio, mic_positions)
-    # logger.debug(f"Theta: {theta}")
-    delays = calculate_delays(mic_positions_3d, theta)
+    # Steer and draw the LEDs with the smoothed azimuth, so steering does not jump
+    # between chunks on noisy estimates
+    global delays, taps
+    if governor.should_update_doa(audio):
+        with stage_timer.stage("doa"):
+            theta = theta_smoother.update(
+                calculate_doa(audio, mic_positions, method=governor.mode.doa_method)
+            )
+        # logger.debug(f"Theta: {theta}")
+        with stage_timer.stage("steering"):
+            delays, taps = steering_cache.lookup(theta)
+    else:
+        # Talkers barely move between chunks, keep the last steering
+        theta = theta_smoother.get_theta()
     # Apply delays and sum signals
-    audio = delay_and_sum(audio, delays)
+    with stage_timer.stage("beamform"):
+        if BEAMFORMER_MODE == "mvdr":
+            # The noise covariance only learns from chunks without speech: the chunk
+            # itself is classified before it is beamformed, so speech onsets are kept
+            # out, and the previous chunks' hangover keeps word endings out
+            speech = reference_vad.is_speech(audio[0])
+            recent_speech = (
+                vad.active
+                if VAD
+                else str_tracker.get_smoothed_strength() > STRENGHT_THRESHOLD
+            )
+            noise_only = not speech and not recent_speech
+            audio = mvdr_beamformer.process(
+                audio, steering_cache.quantize(theta), delays, noise_only
+            )
+        else:
+            audio = beamformer.process(audio, taps)
     # Calculate signal strength
-    strength = str_tracker.process_chunk(audio)
+    with stage_timer.stage("strength"):
+        strength = str_tracker.process_chunk(audio)
     # logger.debug(f"Strength: {type(strength)}")
     return audio, theta, strength  # type: ignore # TODO: Fix type
 
 
+# Reference implementation, kept for benchmark.py. process_audio uses FractionalDelayBeamformer
+# or MvdrBeamformer.
 def delay_and_sum(audio_data_2d, delays):
     # Make sure audio_data_2d and delays have the same number of rows (channels)
     assert audio_data_2d.shape[0] == len(
@@ -111,26 +579,3 @@ def delay_and_sum(audio_data_2d, delays):
     result /= len(delays)
 
     return result.astype(np.int16)
-
-
-def calculate_delays(mic_positions, theta, speed_of_sound=343, fs=16000):
-    # Convert angles to radians
-    theta = np.radians(theta)
-    phi = np.radians(0)
-
-    # Calculate the unit vector for the given angles
-    unit_vector = np.array(
-        [np.sin(theta) * np.cos(phi), np.sin(theta) * np.sin(phi), np.cos(theta)]
-    )
-
-    # Calculate the delays in seconds
-    delays_in_seconds = np.dot(mic_positions, unit_vector) / speed_of_sound
-
-    # Normalize the delays to be relative to the first microphone
-    delays_in_seconds -= delays_in_seconds[0]
-
-    # Convert delays from seconds to samples by multiplying with the sampling rate
-    # delays_in_samples = delays_in_seconds * fs
-
-    # return delays_in_samples
-    return delays_in_seconds
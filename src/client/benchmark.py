@@ -0,0 +1,123 @@
+# Micro benchmarks for the client DSP chain.
+# Run on the device with: python benchmark.py
+import timeit
+import numpy as np
+
+from beamforming import (
+    FractionalDelayBeamformer,
+    MvdrBeamformer,
+    SteeringCache,
+    calculate_delays,
+    delay_and_sum,
+    design_fractional_delay_filters,
+)
+from fir_filter import StreamingFIR, apply_fir_filter
+from tdoa import calculate_doa
+from enums import CHANNELS, CHUNK, BLOCK_DURATION, mic_positions, mic_positions_3d
+
+ITERATIONS = 500
+
+
+def report(name: str, seconds: float, iterations: int = ITERATIONS) -> None:
+    per_chunk_us = seconds / iterations * 1e6
+    # Share of the real time budget (one block) spent in this stage
+    load = per_chunk_us / (BLOCK_DURATION * 1000) * 100
+    print(f"{name:<40} {per_chunk_us:10.1f} us/chunk {load:6.2f} % of block")
+
+
+def random_chunk() -> np.ndarray:
+    rng = np.random.default_rng(0)
+    return rng.integers(-8000, 8000, size=(CHANNELS, CHUNK), dtype=np.int16)
+
+
+def bench_delay_and_sum() -> None:
+    audio = random_chunk()
+    delays = calculate_delays(mic_positions_3d, np.pi / 4)
+    taps = design_fractional_delay_filters(delays)
+    beamformer = FractionalDelayBeamformer()
+
+    report(
+        "delay_and_sum (interp1d)",
+        timeit.timeit(lambda: delay_and_sum(audio, delays), number=ITERATIONS),
+    )
+    report(
+        "FractionalDelayBeamformer",
+        timeit.timeit(lambda: beamformer.process(audio, taps), number=ITERATIONS),
+    )
+    report(
+        "FractionalDelayBeamformer + filter design",
+        timeit.timeit(
+            lambda: beamformer.process(audio, design_fractional_delay_filters(delays)),
+            number=ITERATIONS,
+        ),
+    )
+
+    mvdr = MvdrBeamformer()
+    report(
+        "MvdrBeamformer (cached weights)",
+        timeit.timeit(lambda: mvdr.process(audio, 0, delays, False), number=ITERATIONS),
+    )
+    report(
+        "MvdrBeamformer (noise update)",
+        timeit.timeit(lambda: mvdr.process(audio, 0, delays, True), number=ITERATIONS),
+    )
+    report(
+        "MvdrBeamformer.solve",
+        timeit.timeit(
+            lambda: mvdr.solve(mvdr.steering_vectors(delays)), number=ITERATIONS
+        ),
+    )
+
+
+def bench_steering() -> None:
+    cache = SteeringCache()
+    thetas = np.random.default_rng(0).uniform(0, 2 * np.pi, ITERATIONS)
+    thetas_iter = iter(np.tile(thetas, 2))
+
+    report(
+        "calculate_delays + filter design",
+        timeit.timeit(
+            lambda: design_fractional_delay_filters(
+                calculate_delays(mic_positions_3d, next(thetas_iter))
+            ),
+            number=ITERATIONS,
+        ),
+    )
+    report(
+        "SteeringCache.lookup",
+        timeit.timeit(lambda: cache.lookup(next(thetas_iter)), number=ITERATIONS),
+    )
+    print(f"Steering cache: {cache.stats()}")
+
+
+def bench_fir() -> None:
+    audio = random_chunk()
+    fir = StreamingFIR()
+
+    report(
+        "apply_fir_filter (stateless)",
+        timeit.timeit(lambda: apply_fir_filter(audio), number=ITERATIONS),
+    )
+    report(
+        "StreamingFIR",
+        timeit.timeit(lambda: fir.process(audio), number=ITERATIONS),
+    )
+
+
+def bench_doa() -> None:
+    audio = random_chunk()
+    for method in ("cross_correlation", "gcc_phat", "srp_phat"):
+        report(
+            f"calculate_doa ({method})",
+            timeit.timeit(
+                lambda: calculate_doa(audio, mic_positions, method=method),
+                number=ITERATIONS,
+            ),
+        )
+
+
+if __name__ == "__main__":
+    bench_delay_and_sum()
+    bench_steering()
+    bench_fir()
+    bench_doa()
@@ -1,54 +1,150 @@
 import base64
+import ctypes
+import queue
 from typing import Text
-import wave
 from line_profiler import profile
 import numpy as np
 from numpy.typing import NDArray
 from multiprocessing import Queue
-from pyogg import OpusEncoder, OpusDecoder  # type: ignore # Pylance issue
+from multiprocessing.sharedctypes import Synchronized
+from pyogg import OpusDecoder, opus  # type: ignore # Pylance issue
 
 from logger import logger
-from enums import CHUNK, RATE, BLOCK_DURATION
-from record import record
+from enums import CHUNK, RATE, BLOCK_DURATION, STATS_INTERVAL, OPUS_PROFILE
+from protocol import OPUS_PROFILES, OpusProfile
+from ring_buffer import SharedRingBuffer
+
+# libopus constants (opus_defines.h)
+OPUS_APPLICATIONS = {"voip": 2048, "audio": 2049, "restricted_lowdelay": 2051}
+OPUS_SET_BITRATE_REQUEST = 4002
+OPUS_SET_COMPLEXITY_REQUEST = 4010
+OPUS_SET_INBAND_FEC_REQUEST = 4012
+OPUS_SET_PACKET_LOSS_PERC_REQUEST = 4014
+OPUS_SET_DTX_REQUEST = 4016
+OPUS_SET_SIGNAL_REQUEST = 4024
+OPUS_SIGNAL_VOICE = 3001
+MAX_PACKET_BYTES = 1275  # largest Opus frame
+# With DTX, silence is encoded into packets this small that need not be sent
+DTX_PACKET_BYTES = 2
+
+# Profiles in a fixed order, the index is shared with the encoder process
+PROFILE_NAMES = tuple(OPUS_PROFILES)
+
+
+class ProfileEncoder:
+    """
+    Mono Opus encoder configured from an OpusProfile.
+    pyogg's OpusEncoder only sets the application, the bitrate, complexity, DTX and
+    FEC go through the libopus encoder controls.
+    """
+
+    def __init__(self, name: str, sample_rate: int = RATE) -> None:
+        self.name = name
+        self.profile: OpusProfile = OPUS_PROFILES[name]
+        error = ctypes.c_int()
+        self.encoder = opus.opus_encoder_create(
+            sample_rate,
+            1,
+            OPUS_APPLICATIONS[self.profile.application],
+            ctypes.byref(error),
+        )
+        if error.value != 0:
+            raise RuntimeError(f"Could not create the Opus encoder: {error.value}")
+        for request, value in (
+            (OPUS_SET_BITRATE_REQUEST, self.profile.bitrate),
+            (OPUS_SET_COMPLEXITY_REQUEST, self.profile.complexity),
+            (OPUS_SET_DTX_REQUEST, int(self.profile.dtx)),
+            (OPUS_SET_INBAND_FEC_REQUEST, int(self.profile.fec)),
+            (OPUS_SET_PACKET_LOSS_PERC_REQUEST, self.profile.packet_loss),
+            (OPUS_SET_SIGNAL_REQUEST, OPUS_SIGNAL_VOICE),
+        ):
+            opus.opus_encoder_ctl(self.encoder, request, ctypes.c_int(value))
+        self._packet = (ctypes.c_ubyte * MAX_PACKET_BYTES)()
+
+    def encode(self, pcm: bytes) -> bytes:
+        length = opus.opus_encode(
+            self.encoder,
+            ctypes.cast(pcm, ctypes.POINTER(ctypes.c_int16)),
+            len(pcm) // 2,
+            self._packet,
+            MAX_PACKET_BYTES,
+        )
+        if length < 0:
+            raise RuntimeError(f"opus_encode failed: {length}")
+        return ctypes.string_at(self._packet, length)
+
+    def __del__(self) -> None:
+        if getattr(self, "encoder", None):
+            opus.opus_encoder_destroy(self.encoder)
+
 
 # Create an Opus encoder/decoder
-opus_encoder = OpusEncoder()
+opus_encoder = ProfileEncoder(OPUS_PROFILE)
 opus_decoder = OpusDecoder()
 
-opus_encoder.set_application("audio")  # type: ignore
-
-opus_encoder.set_sampling_frequency(RATE)  # type: ignore
 opus_decoder.set_sampling_frequency(RATE)  # type: ignore
 
-opus_encoder.set_channels(1)  # type: ignore
 opus_decoder.set_channels(1)  # type: ignore
 
 
 def encode_audio(
-    beamformed_audio_queue: Queue,
+    beamformed_audio_ring: SharedRingBuffer,
     encoded_audio_queue: Queue,
-    wav_file: wave.Wave_write | None = None,
+    opus_profile: Synchronized,
 ) -> None:
+    """
+    Encode every beamformed block and queue the packets for the sender.
+    :param opus_profile: Index into PROFILE_NAMES of the profile negotiated with the
+    server, the encoder is recreated when it changes.
+    """
+    global opus_encoder
+    dropped = 0
+    discontinued = 0
     while True:
-        audio_data = beamformed_audio_queue.get()
-        # convert to np.int16
-        if wav_file:
-            record(audio_data, wav_file)
-        audio_data = audio_data.astype(np.int16)
+        block = beamformed_audio_ring.peek()
+        if block is None:
+            continue
+        if PROFILE_NAMES[opus_profile.value] != opus_encoder.name:
+            opus_encoder = ProfileEncoder(PROFILE_NAMES[opus_profile.value])
+            logger.debug(f"Opus profile {opus_encoder.name}: {opus_encoder.profile}")
+        seq, timestamp, audio_data = block
         encoded_audio = encode(audio_data)
-        encoded_audio_queue.put(encoded_audio)
+        beamformed_audio_ring.advance()
+        if encoded_audio is None:
+            continue
+        if len(encoded_audio) <= DTX_PACKET_BYTES:
+            # Silence under DTX, the server sees a sequence gap
+            discontinued += 1
+            if discontinued % STATS_INTERVAL == 0:
+                logger.debug(f"DTX: {discontinued} silent packets not sent")
+            continue
+        while True:
+            try:
+                encoded_audio_queue.put_nowait((seq, timestamp, encoded_audio))
+                break
+            except queue.Full:
+                # Disconnected for longer than the backlog holds. The most recent
+                # audio is what gets replayed, drop the oldest instead of blocking
+                # the pipeline
+                try:
+                    encoded_audio_queue.get_nowait()
+                except queue.Empty:
+                    # The sender took it meanwhile
+                    continue
+                dropped += 1
+                if dropped % STATS_INTERVAL == 1:
+                    logger.error(f"Encoded audio queue full, {dropped} packets dropped")
 
 
 @profile
-def encode(waveform: NDArray[np.int16]) -> Text | None:
+def encode(waveform: NDArray[np.int16]) -> bytes | None:
     try:
         # Ensure waveform is in int16 format and convert to bytes
         byte_audio = waveform.tobytes()
         # Ensure the audio is the correct length
         assert calculate_sample_duration(byte_audio) == BLOCK_DURATION
         # Encode the audio
-        encoded_audio = opus_encoder.encode(byte_audio)  # type: ignore
-        return base64.b64encode(encoded_audio).decode("utf-8")
+        return opus_encoder.encode(byte_audio)
     except Exception as e:
         logger.error(f"Error in Opus encoding: {type(e).__name__}, {e}")
         return None  # Or handle the error as appropriate
@@ -1,3 +1,6 @@
+import socket
+import uuid
+
 import numpy as np
 from numpy.typing import NDArray
 
@@ -5,6 +8,20 @@ retry_max = 12
 retry_delay = 5
 
 
+def device_id() -> str:
+    # Stock images are all called raspberrypi, the machine ID (or the MAC address)
+    # tells them apart
+    try:
+        with open("/etc/machine-id") as machine_id_file:
+            machine_id = machine_id_file.read().strip()
+    except OSError:
+        machine_id = ""
+    if not machine_id:
+        machine_id = f"{uuid.getnode():012x}"
+    # Shorter than the server's SESSION_ID_BYTES
+    return f"{socket.gethostname()[:40]}-{machine_id[:16]}"
+
+
 # recording configs
 CHANNELS: int = 8  # overriden from client
 SAMPLE_WIDTH: int = 2  # We are using int16 which is 2 bytes
@@ -12,10 +29,74 @@ RATE: int = 16000  # overriden from client
 BLOCK_DURATION = 40  # milliseconds
 RECORD_SECONDS: int = 5
 RECORD: bool = False
+RECORD_DIRECTORY: str = "recordings"
+RECORD_RING_CAPACITY: int = 250  # blocks the recorder can fall behind by (10 s)
+RECORD_BATCH: int = 25  # blocks per write to the SD card (1 s)
+RECORD_ROTATE_BYTES: int = 100_000_000  # start a new segment past this WAV size
+RECORD_ROTATE_SECONDS: int = 3600  # or after this long
 
 CHUNK: int = int((RATE * BLOCK_DURATION) // 1000)
+RING_CAPACITY: int = 50  # blocks held by the rings between pipeline stages (2 s)
+PIPELINE: str = "processes"  # "processes" or "threads" (one process, less memory)
 
 STRENGHT_THRESHOLD = -45
+STATS_INTERVAL: int = 1500  # chunks between debug logs of pipeline stats (1 minute)
+STAGE_TIMER_CAPACITY: int = 1500  # chunks kept for the per stage latency percentiles
+LED_MAX_FPS: int = 15  # cap on everloop redraws, the DSP loop runs at 25 chunks/s
+
+# cpu governor configs
+GOVERNOR: bool = True  # trade DOA cadence and the FIR for CPU when running late
+GOVERNOR_HIGH_LOAD: float = 0.8  # share of the block duration, step to a cheaper mode
+GOVERNOR_LOW_LOAD: float = 0.5  # step back to a better mode
+GOVERNOR_DWELL: int = 50  # minimum chunks between two mode changes (2 s)
+GOVERNOR_ONSET_DB: float = 6.0  # level jump that always triggers a DOA estimate
+
+# voice activity detection configs
+VAD: bool = True  # only speech (plus pre-roll and hangover) is encoded and sent
+VAD_ENERGY_MARGIN: float = 9.0  # dB above the tracked noise floor
+VAD_MIN_ENERGY: float = -65.0  # dBFS, quieter blocks are never speech
+VAD_FLATNESS_THRESHOLD: float = 0.3  # white noise ~0.5, voiced speech < 0.1
+VAD_HANGOVER: int = 8  # blocks still sent after the last speech block (320 ms)
+VAD_PRE_ROLL: int = 5  # blocks of leading context sent on speech onset (200 ms)
+
+# keyword spotting configs
+KWS: bool = False  # stream only after a wake word spotted on the device
+KWS_MODEL: str = "models/kws.npz"  # NumPy GRU weights (.npz) or an ONNX model (.onnx)
+KWS_THRESHOLD: float = 0.8  # smoothed wake word probability that triggers
+KWS_SMOOTHING: int = 3  # model scores averaged before the threshold
+KWS_STRIDE: int = 2  # blocks between two model runs (80 ms)
+KWS_PRE_ROLL_SECONDS: float = 1.5  # audio before the detection, holds the wake word
+KWS_SESSION_SECONDS: float = 8.0  # streaming continues this long after the last speech
+KWS_MAX_SESSION_SECONDS: float = 30.0  # hard limit on one session
+
+# streaming configs
+AGGREGATE_FRAMES: int = 1  # Opus frames packed into one binary message (minimum)
+MAX_AGGREGATE_FRAMES: int = 5  # upper bound when adapting to RTT (200 ms)
+ADAPTIVE_AGGREGATION: bool = True  # follow the measured RTT between the two bounds
+RTT_PROBE_INTERVAL: float = 5.0  # seconds between websocket pings
+BACKLOG_SECONDS: float = 10.0  # encoded audio kept (and queued) across reconnects
+BACKLOG_REPLAY_SECONDS: float = 3.0  # most recent audio replayed on reconnect, sent or not
+MAX_REPLAY_FRAMES: int = 25  # Opus frames per replay message
+OPUS_PROFILE: str = "voip"  # proposed to the server, see protocol.OPUS_PROFILES
+DEVICE_ID: str = device_id()  # the server keeps one session per device
+
+# beamforming configs
+BEAMFORMER_MODE: str = "delay_and_sum"  # "delay_and_sum" or "mvdr"
+FIR_FILTER: bool = True  # high pass the raw channels before DOA and beamforming
+SPEED_OF_SOUND: float = 343.0  # m/s
+FRACTIONAL_DELAY_HALF_TAPS: int = 8  # one sided length of the windowed-sinc kernel
+MVDR_FRAME: int = 640  # STFT frame, hop is half of it (adds 20 ms of latency)
+MVDR_FORGETTING: float = 0.98  # per STFT frame, noise covariance time constant ~1 s
+MVDR_DIAGONAL_LOADING: float = 1e-2  # relative to the mean power of each bin
+MVDR_COVARIANCE_TOLERANCE: float = 0.1  # relative change that triggers a new solve
+
+# direction of arrival configs
+DOA_METHOD: str = "srp_phat"  # "srp_phat", "gcc_phat" or "cross_correlation"
+AZIMUTH_GRID_STEP: int = 2  # degrees between SRP-PHAT candidate directions
+SRP_MIN_FREQUENCY: int = 300  # Hz, band used by SRP-PHAT
+SRP_MAX_FREQUENCY: int = 3400  # Hz
+THETA_SMOOTHING: int = 10  # blocks in the circular moving average of the azimuth
+THETA_OUTLIER_DEGREES: float = 20  # azimuths further from the average are discarded
 
 # Microphone positions in millimeters, converted to meters
 mic_positions_3d: NDArray[np.float64] = np.array(
@@ -4,6 +4,8 @@ from scipy.signal import lfilter
 
 from numpy.typing import NDArray
 
+from enums import CHANNELS, CHUNK, RATE
+
 
 class FIRCoeff:
     def __init__(self, rate, coeffs):
@@ -1213,33 +1215,73 @@ FIR_default = [
 ]
 
 
+# Coefficients are stored in Q15
+FIR_SCALE = 1 << 15
+
+# Coefficients per sample rate, converted once
+fir_coefficients = {
+    f.rate: np.asarray(f.coeffs, dtype=np.float64) / FIR_SCALE for f in FIR_default
+}
+
+
+class StreamingFIR:
+    """
+    Overlap-save FIR filter for (channels, chunk) blocks.
+
+    The last num_taps - 1 input samples of every channel are kept between calls, so
+    consecutive chunks are filtered as one continuous signal. All channels are filtered
+    with a single batched FFT.
+    """
+
+    def __init__(self, sample_rate=RATE, channels=CHANNELS, chunk=CHUNK):
+        coeffs = fir_coefficients.get(sample_rate)
+        if coeffs is None:
+            raise ValueError(f"No FIR coefficients for sample rate {sample_rate}")
+        self.channels = channels
+        self.chunk = chunk
+        self.num_taps = len(coeffs)
+        self.history = self.num_taps - 1
+        # Overlap-save needs n_fft >= chunk + num_taps - 1 for the kept samples to be
+        # free of circular wrap around
+        self.n_fft = 1 << int(np.ceil(np.log2(chunk + self.history)))
+        self.coeff_spectrum = np.fft.rfft(coeffs, n=self.n_fft)
+        # [history | current chunk | padding] for every channel
+        self.buffer = np.zeros((channels, self.n_fft), dtype=np.float64)
+
+    def process(self, audio_signal: NDArray[np.int16]) -> NDArray[np.int16]:
+        assert audio_signal.shape == (
+            self.channels,
+            self.chunk,
+        ), "Mismatch between audio shape and FIR configuration"
+        history, chunk = self.history, self.chunk
+        # Keep the tail of the previous chunk and append the new one
+        self.buffer[:, :history] = self.buffer[:, chunk : chunk + history]
+        self.buffer[:, history : history + chunk] = audio_signal
+
+        spectrum = np.fft.rfft(self.buffer, axis=1)
+        spectrum *= self.coeff_spectrum
+        filtered_signal = np.fft.irfft(spectrum, n=self.n_fft, axis=1)[
+            :, history : history + chunk
+        ]
+        return np.clip(filtered_signal, -32768, 32767).astype(np.int16)
+
+    def reset(self) -> None:
+        self.buffer.fill(0)
+
+
+# Stateless version, every call starts from silence. Use StreamingFIR for a stream of chunks.
 def apply_fir_filter(
     audio_signal: NDArray[np.int16], sample_rate=16000
 ) -> NDArray[np.int16]:
     if not isinstance(audio_signal, np.ndarray):
         raise TypeError("audio_signal must be a NumPy ndarray")
-    if audio_signal.dtype != np.float64:
-        # convert to float64 to avoid overflows
-        audio_signal = audio_signal.astype(np.float64)
     # Select the FIR coefficients for the given sample rate
-    fir_coeff = next((f.coeffs for f in FIR_default if f.rate == sample_rate), None)
+    fir_coeff = fir_coefficients.get(sample_rate)
 
     if fir_coeff is None:
         raise ValueError(f"No FIR coefficients for sample rate {sample_rate}")
 
-    # Apply FIR filter
-    # filtered_signal = lfilter(fir_coeff, [1.0], audio_signal)
-    # Check if audio_signal is multi-dimensional and apply filter to each channel
-    if audio_signal.ndim > 1:
-        filtered_signal = np.zeros_like(audio_signal, dtype=np.float64)
-        for i in range(audio_signal.shape[0]):
-            channel_signal = audio_signal[i].astype(np.float64)
-            filtered_signal[i] = np.convolve(channel_signal, fir_coeff, mode="same")
-    else:
-        if audio_signal.dtype != np.float64:
-            # Convert to float64 to preserve precision during filtering
-            audio_signal = audio_signal.astype(np.float64)
-        filtered_signal = np.convolve(audio_signal, fir_coeff, mode="same")
-    # filtered_signal = np.clip(filtered_signal, -32768, 32767)
-    filtered_signal = np.asarray(filtered_signal, dtype=np.int16)
-    return filtered_signal
+    # Apply FIR filter along the last axis, to every channel at once
+    filtered_signal = lfilter(fir_coeff, [1.0], audio_signal, axis=-1)
+    filtered_signal = np.clip(filtered_signal, -32768, 32767)
+    return np.asarray(filtered_signal, dtype=np.int16)
@@ -0,0 +1,154 @@
+from typing import NamedTuple, Tuple
+
+import numpy as np
+from numpy.typing import NDArray
+
+from logger import logger
+from enums import (
+    BLOCK_DURATION,
+    DOA_METHOD,
+    FIR_FILTER,
+    GOVERNOR,
+    GOVERNOR_HIGH_LOAD,
+    GOVERNOR_LOW_LOAD,
+    GOVERNOR_DWELL,
+    GOVERNOR_ONSET_DB,
+)
+
+FULL_SCALE = 32768.0
+LOAD_SMOOTHING = 0.1  # weight of the newest chunk in the moving average cycle time
+LEVEL_SMOOTHING = 0.2  # weight of the newest chunk in the background level
+# Stepping back to a better mode waits longer than stepping down, so a load that
+# sits between the two thresholds does not flip the mode back and forth
+UPGRADE_DWELL_FACTOR = 4
+
+
+class GovernorMode(NamedTuple):
+    name: str
+    doa_interval: int  # chunks between DOA estimates, onsets always get one
+    doa_method: str
+    fir: bool
+
+
+# Cheapest last
+GOVERNOR_MODES: Tuple[GovernorMode, ...] = (
+    GovernorMode("full", 1, DOA_METHOD, FIR_FILTER),
+    GovernorMode("reduced", 3, DOA_METHOD, FIR_FILTER),
+    GovernorMode("economy", 6, "gcc_phat", FIR_FILTER),
+    GovernorMode("minimal", 12, "gcc_phat", False),
+)
+
+
+class CpuGovernor:
+    """
+    Picks how much work the beamformer does per chunk from its measured cycle time.
+
+    The moving average of the time spent per chunk is compared to the block duration.
+    Above GOVERNOR_HIGH_LOAD the governor steps to the next cheaper mode, below
+    GOVERNOR_LOW_LOAD back to the next better one, never changing twice within
+    GOVERNOR_DWELL chunks (four times that before stepping back up). Cheaper modes run
+    DOA less often (the steering of the last estimate is reused in between), fall back
+    to GCC-PHAT and finally skip the FIR.
+    An energy onset, a chunk GOVERNOR_ONSET_DB above the background level, always
+    gets a fresh DOA estimate so a new talker is steered to straight away.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = GOVERNOR,
+        block_duration: float = BLOCK_DURATION / 1000,
+        high_load: float = GOVERNOR_HIGH_LOAD,
+        low_load: float = GOVERNOR_LOW_LOAD,
+        dwell: int = GOVERNOR_DWELL,
+        onset_db: float = GOVERNOR_ONSET_DB,
+    ) -> None:
+        self.enabled = enabled
+        self.block_duration = block_duration
+        self.high_load = high_load
+        self.low_load = low_load
+        self.dwell = dwell
+        self.onset_db = onset_db
+        self.mode_index = 0
+        self.load = 0.0
+        self.level: float | None = None
+        # float64 copy of the first microphone, reused for every chunk
+        self.scratch = np.empty(0, dtype=np.float64)
+        self.chunks_since_change = 0
+        self.chunks_since_doa = 0
+        # counters for stats()
+        self.doa_runs = 0
+        self.doa_skips = 0
+        self.onsets = 0
+        self.mode_changes = 0
+
+    @property
+    def mode(self) -> GovernorMode:
+        return GOVERNOR_MODES[self.mode_index]
+
+    def onset(self, audio_data: NDArray[np.int16]) -> bool:
+        # Level of the first microphone against its slowly moving background
+        samples = audio_data[0]
+        # float64 sums the squares of int16 samples exactly, nothing is allocated
+        if self.scratch.shape != samples.shape:
+            self.scratch = np.empty(samples.shape, dtype=np.float64)
+        np.copyto(self.scratch, samples)
+        mean_square = np.dot(self.scratch, self.scratch) / len(samples)
+        level = float(10 * np.log10(max(mean_square, 1.0) / FULL_SCALE**2))
+        if self.level is None:
+            self.level = level
+        onset = level - self.level > self.onset_db
+        self.level += LEVEL_SMOOTHING * (level - self.level)
+        return onset
+
+    def should_update_doa(self, audio_data: NDArray[np.int16]) -> bool:
+        """
+        :param audio_data: (channels, samples) block about to be beamformed.
+        :return: True if the DOA has to be estimated for this chunk.
+        """
+        onset = self.onset(audio_data)
+        self.chunks_since_doa += 1
+        if onset or self.chunks_since_doa >= self.mode.doa_interval:
+            self.onsets += onset
+            self.doa_runs += 1
+            self.chunks_since_doa = 0
+            return True
+        self.doa_skips += 1
+        return False
+
+    def end_chunk(self, cycle_time: float) -> None:
+        """
+        Feed the time spent on one chunk and adapt the mode.
+        :param cycle_time: Seconds from taking the block off the ring to handing the
+        result on.
+        """
+        self.load += LOAD_SMOOTHING * (cycle_time / self.block_duration - self.load)
+        self.chunks_since_change += 1
+        if not self.enabled or self.chunks_since_change < self.dwell:
+            return
+        if self.load > self.high_load and self.mode_index < len(GOVERNOR_MODES) - 1:
+            self.set_mode(self.mode_index + 1)
+        elif (
+            self.load < self.low_load
+            and self.mode_index > 0
+            and self.chunks_since_change >= UPGRADE_DWELL_FACTOR * self.dwell
+        ):
+            self.set_mode(self.mode_index - 1)
+
+    def set_mode(self, mode_index: int) -> None:
+        logger.debug(
+            f"Governor: {self.mode.name} -> {GOVERNOR_MODES[mode_index].name} "
+            f"at {self.load * 100:.0f} % load"
+        )
+        self.mode_index = mode_index
+        self.chunks_since_change = 0
+        self.mode_changes += 1
+
+    def stats(self) -> dict:
+        return {
+            "mode": self.mode.name,
+            "load": round(self.load, 3),
+            "doa_runs": self.doa_runs,
+            "doa_skips": self.doa_skips,
+            "onsets": self.onsets,
+            "mode_changes": self.mode_changes,
+        }
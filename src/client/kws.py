@@ -0,0 +1,312 @@
+from collections import deque
+from typing import Deque, List, Protocol, Tuple
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from numpy.typing import NDArray
+
+try:
+    import onnxruntime  # type: ignore
+except ImportError:
+    # NumPy models only
+    onnxruntime = None
+
+from logger import logger
+from enums import (
+    RATE,
+    BLOCK_DURATION,
+    KWS_MODEL,
+    KWS_THRESHOLD,
+    KWS_SMOOTHING,
+    KWS_STRIDE,
+    KWS_PRE_ROLL_SECONDS,
+    KWS_SESSION_SECONDS,
+    KWS_MAX_SESSION_SECONDS,
+)
+
+FULL_SCALE = 32768.0
+# MFCC front end: 25 ms frames every 10 ms, the usual keyword spotting features
+FRAME_LENGTH = 400
+FRAME_HOP = 160
+FFT_SIZE = 512
+MEL_BANDS = 40
+MEL_MIN_FREQUENCY = 20
+MEL_MAX_FREQUENCY = 7600
+MFCC_COEFFICIENTS = 13
+WINDOW_FRAMES = 100  # 1 s of features per model run
+
+
+def mel_filterbank(
+    sample_rate: int = RATE,
+    fft_size: int = FFT_SIZE,
+    bands: int = MEL_BANDS,
+    min_frequency: float = MEL_MIN_FREQUENCY,
+    max_frequency: float = MEL_MAX_FREQUENCY,
+) -> NDArray[np.float32]:
+    """
+    :return: (bands, fft_size // 2 + 1) triangular filters, equally spaced on the mel
+    scale.
+    """
+    to_mel = lambda hz: 2595 * np.log10(1 + hz / 700)
+    to_hz = lambda mel: 700 * (10 ** (mel / 2595) - 1)
+    edges = to_hz(np.linspace(to_mel(min_frequency), to_mel(max_frequency), bands + 2))
+    frequencies = np.fft.rfftfreq(fft_size, d=1 / sample_rate)
+    lower, center, upper = edges[:-2, None], edges[1:-1, None], edges[2:, None]
+    rising = (frequencies - lower) / (center - lower)
+    falling = (upper - frequencies) / (upper - center)
+    return np.maximum(0, np.minimum(rising, falling)).astype(np.float32)
+
+
+def dct_matrix(
+    bands: int = MEL_BANDS, coefficients: int = MFCC_COEFFICIENTS
+) -> NDArray[np.float32]:
+    # Orthonormal DCT-II, (coefficients, bands)
+    n = np.arange(bands)
+    k = np.arange(coefficients)[:, None]
+    matrix = np.cos(np.pi / bands * (n + 0.5) * k) * np.sqrt(2 / bands)
+    matrix[0] /= np.sqrt(2)
+    return matrix.astype(np.float32)
+
+
+class StreamingMfcc:
+    """
+    MFCCs of a stream of blocks. The last FRAME_LENGTH - FRAME_HOP samples of a block
+    are kept so frames run across block boundaries, a 640 sample block yields exactly
+    4 frames.
+    """
+
+    def __init__(self) -> None:
+        self.window = np.hamming(FRAME_LENGTH).astype(np.float32)
+        self.filterbank = mel_filterbank()
+        self.dct = dct_matrix()
+        self.tail = np.zeros(FRAME_LENGTH - FRAME_HOP, dtype=np.float32)
+
+    def reset(self) -> None:
+        self.tail = np.zeros(FRAME_LENGTH - FRAME_HOP, dtype=np.float32)
+
+    def process(self, audio: NDArray[np.int16]) -> NDArray[np.float32]:
+        """
+        :param audio: (samples,) block, a multiple of FRAME_HOP.
+        :return: (frames, MFCC_COEFFICIENTS) features.
+        """
+        samples = np.concatenate((self.tail, audio.astype(np.float32) / FULL_SCALE))
+        frames = sliding_window_view(samples, FRAME_LENGTH)[::FRAME_HOP]
+        self.tail = samples[len(frames) * FRAME_HOP :]
+        power = np.abs(np.fft.rfft(frames * self.window, n=FFT_SIZE)) ** 2
+        log_mel = np.log(power @ self.filterbank.T + 1e-6)
+        return log_mel @ self.dct.T
+
+
+class KeywordModel(Protocol):
+    def predict(self, features: NDArray[np.float32]) -> float: ...
+
+
+class NumpyGruModel:
+    """
+    One GRU layer over the feature window and a dense output on its last state.
+    The .npz holds the PyTorch nn.GRU parameters (weight_ih, weight_hh, bias_ih,
+    bias_hh, gates in r, z, n order), dense_weight (1, hidden), dense_bias (1,) and
+    optionally feature_mean / feature_std to normalise the MFCCs.
+    """
+
+    def __init__(self, path: str) -> None:
+        weights = np.load(path)
+        self.weight_ih = weights["weight_ih"].astype(np.float32)
+        self.weight_hh = weights["weight_hh"].astype(np.float32)
+        self.bias_ih = weights["bias_ih"].astype(np.float32)
+        self.bias_hh = weights["bias_hh"].astype(np.float32)
+        self.dense_weight = weights["dense_weight"].astype(np.float32).ravel()
+        self.dense_bias = float(np.ravel(weights["dense_bias"])[0])
+        self.mean = weights["feature_mean"] if "feature_mean" in weights else 0.0
+        self.std = weights["feature_std"] if "feature_std" in weights else 1.0
+        self.hidden = self.weight_hh.shape[1]
+
+    def predict(self, features: NDArray[np.float32]) -> float:
+        features = (features - self.mean) / self.std
+        # Input projections of every frame in one matrix product
+        inputs = features @ self.weight_ih.T + self.bias_ih
+        state = np.zeros(self.hidden, dtype=np.float32)
+        h = self.hidden
+        for projected in inputs:
+            recurrent = self.weight_hh @ state + self.bias_hh
+            reset = 1 / (1 + np.exp(-(projected[:h] + recurrent[:h])))
+            update = 1 / (1 + np.exp(-(projected[h : 2 * h] + recurrent[h : 2 * h])))
+            candidate = np.tanh(projected[2 * h :] + reset * recurrent[2 * h :])
+            state = (1 - update) * candidate + update * state
+        logit = float(self.dense_weight @ state) + self.dense_bias
+        return float(1 / (1 + np.exp(-logit)))
+
+
+class OnnxModel:
+    """
+    Any ONNX model taking (1, WINDOW_FRAMES, MFCC_COEFFICIENTS) float32 MFCCs and
+    returning the wake word probability.
+    """
+
+    def __init__(self, path: str) -> None:
+        if onnxruntime is None:
+            raise ImportError("onnxruntime is needed for ONNX keyword models")
+        self.session = onnxruntime.InferenceSession(path)
+        self.input_name = self.session.get_inputs()[0].name
+
+    def predict(self, features: NDArray[np.float32]) -> float:
+        outputs = self.session.run(None, {self.input_name: features[np.newaxis]})
+        return float(np.ravel(outputs[0])[0])
+
+
+def load_model(path: str = KWS_MODEL) -> KeywordModel:
+    return OnnxModel(path) if path.endswith(".onnx") else NumpyGruModel(path)
+
+
+class KeywordSpotter:
+    """
+    Wake word detector for the beamformed stream.
+    MFCCs are computed for every block into a ring of the last WINDOW_FRAMES frames,
+    the model scores the window every `stride` blocks and a detection needs the mean
+    of the last `smoothing` scores above `threshold`.
+    """
+
+    def __init__(
+        self,
+        model: KeywordModel,
+        threshold: float = KWS_THRESHOLD,
+        smoothing: int = KWS_SMOOTHING,
+        stride: int = KWS_STRIDE,
+    ) -> None:
+        self.model = model
+        self.threshold = threshold
+        self.stride = stride
+        self.mfcc = StreamingMfcc()
+        self.features = np.zeros((WINDOW_FRAMES, MFCC_COEFFICIENTS), dtype=np.float32)
+        self.index = 0
+        self.frames = 0
+        self.blocks = 0
+        self.scores: Deque[float] = deque(maxlen=smoothing)
+        # counters for stats()
+        self.runs = 0
+        self.detections = 0
+        self.max_score = 0.0
+
+    def reset(self) -> None:
+        """
+        Forget the audio heard so far, the next model run needs a full window of new
+        audio. Otherwise the window that held the wake word is scored again.
+        """
+        self.mfcc.reset()
+        self.features[:] = 0
+        self.index = 0
+        self.frames = 0
+        self.scores.clear()
+
+    def process(self, audio: NDArray[np.int16]) -> bool:
+        """
+        :param audio: One beamformed block. The spotter starts over after a detection.
+        :return: True if the wake word was detected with this block.
+        """
+        for frame in self.mfcc.process(audio):
+            self.features[self.index] = frame
+            self.index = (self.index + 1) % WINDOW_FRAMES
+            self.frames += 1
+        self.blocks += 1
+        if self.frames < WINDOW_FRAMES or self.blocks % self.stride:
+            return False
+        # Oldest frame first
+        window = np.concatenate((self.features[self.index :], self.features[: self.index]))
+        score = self.model.predict(window)
+        self.runs += 1
+        self.max_score = max(self.max_score, score)
+        self.scores.append(score)
+        if len(self.scores) < self.scores.maxlen or np.mean(self.scores) < self.threshold:
+            return False
+        self.detections += 1
+        self.reset()
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "runs": self.runs,
+            "detections": self.detections,
+            "max_score": round(self.max_score, 3),
+        }
+
+
+class WakeWordGate:
+    """
+    Holds back the beamformed stream until the wake word is spotted locally.
+
+    Idle, every block feeds the keyword spotter and a ring of the last
+    KWS_PRE_ROLL_SECONDS, nothing is sent. On detection the pre-roll, which holds the
+    wake word itself, is released and a session starts: the frames the VAD (or the
+    strength gate) lets through are sent until KWS_SESSION_SECONDS pass without speech
+    or the session is KWS_MAX_SESSION_SECONDS old.
+    """
+
+    def __init__(
+        self,
+        spotter: KeywordSpotter,
+        pre_roll_seconds: float = KWS_PRE_ROLL_SECONDS,
+        session_seconds: float = KWS_SESSION_SECONDS,
+        max_session_seconds: float = KWS_MAX_SESSION_SECONDS,
+    ) -> None:
+        self.spotter = spotter
+        self.pre_roll: Deque[Tuple[NDArray[np.int16], float]] = deque(
+            maxlen=int(pre_roll_seconds * 1000 / BLOCK_DURATION)
+        )
+        self.session_seconds = session_seconds
+        self.max_session_seconds = max_session_seconds
+        self.session_start: float | None = None
+        self.session_end = 0.0
+        # counters for stats()
+        self.sessions = 0
+        self.idle_blocks = 0
+
+    @property
+    def active(self) -> bool:
+        return self.session_start is not None
+
+    def process(
+        self,
+        audio: NDArray[np.int16],
+        timestamp: float,
+        frames: List[Tuple[NDArray[np.int16], float]],
+        speech: bool,
+    ) -> Tuple[List[Tuple[NDArray[np.int16], float]], bool]:
+        """
+        :param audio: The beamformed block.
+        :param timestamp: Its capture timestamp.
+        :param frames: What the VAD or strength gate would send for this block.
+        :param speech: Whether the block is speech, extends the session.
+        :return: The frames to send and whether the wake word was detected with this
+        block (the first frame is then the start of the pre-roll).
+        """
+        if self.session_start is not None:
+            if speech:
+                self.session_end = timestamp + self.session_seconds
+            if (
+                timestamp < self.session_end
+                and timestamp - self.session_start < self.max_session_seconds
+            ):
+                return frames, False
+            logger.debug(f"Wake word session over after {timestamp - self.session_start:.1f} s")
+            self.session_start = None
+            # The spotter was not fed during the session, it starts from this block
+            self.spotter.reset()
+        self.idle_blocks += 1
+        self.pre_roll.append((audio.copy(), timestamp))
+        if not self.spotter.process(audio):
+            return [], False
+        # The pre-roll already ends with this block
+        self.session_start = timestamp
+        self.session_end = timestamp + self.session_seconds
+        self.sessions += 1
+        released = list(self.pre_roll)
+        self.pre_roll.clear()
+        return released, True
+
+    def stats(self) -> dict:
+        return {
+            "sessions": self.sessions,
+            "active": self.active,
+            "idle_blocks": self.idle_blocks,
+            **self.spotter.stats(),
+        }
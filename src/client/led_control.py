@@ -1,29 +1,98 @@
 import math
-from matrix_lite import led
+import threading
+from typing import List, Optional, Tuple
+
+try:
+    from matrix_lite import led
+except ImportError:
+    # No Matrix Creator (replay.py and benchmarks on a regular Linux box)
+    class _NoLeds:
+        length = 35
+
+        def set(self, everloop):
+            pass
+
+    led = _NoLeds()
 
 # from enums import mic_positions
 import numpy as np
 import time
 
 from logger import logger
+from enums import LED_MAX_FPS, THETA_SMOOTHING, THETA_OUTLIER_DEGREES
+
+# Mean resultant length above which the window is considered to point somewhere
+COHERENT_WINDOW = 0.5
 
 
 class ThetaSmoother:
-    def __init__(self, size=10):
+    """
+    Circular moving average of the last `size` azimuths.
+
+    The sines and cosines of the accepted angles live in preallocated arrays used as a
+    ring, with running sums, so the mean direction is atan2(sum sin, sum cos) and both
+    adding and reading are constant time. Averaging on the unit circle keeps 359° and
+    1° together instead of averaging them to 180°.
+    """
+
+    def __init__(self, size=THETA_SMOOTHING, max_deviation=THETA_OUTLIER_DEGREES):
         self.size = size
-        self.thetas = []
+        self.max_deviation = np.radians(max_deviation)
+        self.sines = np.zeros(size, dtype=np.float64)
+        self.cosines = np.zeros(size, dtype=np.float64)
+        self.index = 0
+        self.count = 0
+        self.sin_sum = 0.0
+        self.cos_sum = 0.0
+        self.rejected = 0
 
     def add_theta(self, theta):
-        # discard values that are more than 20 degrees from the mean. Allow all values if there are less than 10 values.
-        if np.abs(np.mean(self.thetas) - theta) <= 20 or len(self.thetas) < 10:
-            self.thetas.append(theta)
-        if len(self.thetas) > self.size:
-            self.thetas.pop(0)
+        # discard values that are more than max_deviation from the mean. Allow all
+        # values until the window is full and while it has no clear direction (noise).
+        sin_theta, cos_theta = math.sin(theta), math.cos(theta)
+        norm = math.hypot(self.sin_sum, self.cos_sum)
+        if self.count == self.size and norm > COHERENT_WINDOW * self.count:
+            # cos of the angle between theta and the mean direction
+            if (
+                sin_theta * self.sin_sum + cos_theta * self.cos_sum
+            ) / norm < math.cos(self.max_deviation):
+                self.rejected += 1
+                if self.rejected < self.size:
+                    return
+                # A window of consecutive outliers: the speaker moved, start over
+                self.reset()
+        self.rejected = 0
+        if self.count == self.size:
+            self.sin_sum -= self.sines[self.index]
+            self.cos_sum -= self.cosines[self.index]
+        else:
+            self.count += 1
+        self.sines[self.index] = sin_theta
+        self.cosines[self.index] = cos_theta
+        self.sin_sum += sin_theta
+        self.cos_sum += cos_theta
+        self.index += 1
+        if self.index == self.size:
+            # Rebuild the sums once per wrap to bound floating point drift
+            self.index = 0
+            self.sin_sum = float(np.sum(self.sines))
+            self.cos_sum = float(np.sum(self.cosines))
+
+    def reset(self):
+        self.index = 0
+        self.count = 0
+        self.sin_sum = 0.0
+        self.cos_sum = 0.0
+        self.rejected = 0
 
     def get_theta(self):
-        if not self.thetas:
+        if self.count == 0:
             return 0
-        return np.mean(self.thetas)
+        return math.atan2(self.sin_sum, self.cos_sum) % (2 * np.pi)
+
+    def update(self, theta):
+        self.add_theta(theta)
+        return self.get_theta()
 
 
 default_everloop = ["black"] * led.length
@@ -31,11 +100,6 @@ default_everloop = ["black"] * led.length
 # Angular span for each LED
 angular_span = 2 * np.pi / led.length
 
-# Instantiate the smoother
-theta_smoother = ThetaSmoother(
-    size=10
-)  # Size can be adjusted based on desired smoothing
-
 
 def scale_strength(strength, min_strength=-45, max_strength=0):
     """
@@ -54,39 +118,113 @@ def scale_strength(strength, min_strength=-45, max_strength=0):
     return scaled_strength
 
 
-def set_leds(theta, strength):
+def render_everloop(theta, strength) -> List:
+    """
+    Build the everloop frame pointing at theta.
+    :param theta: Azimuth in radians.
+    :param strength: Signal strength in dB, sets the brightness.
+    :return: One colour per LED, as taken by led.set.
+    """
     scaled_strength = scale_strength(strength)
-    theta_smoother.add_theta(theta)
 
     everloop = default_everloop.copy()
     led_position = map_theta_to_led(theta)
     max_color_value = 255
     led_count = led.length
-    try:
-        for i in range(led_position - 3, led_position + 4):
-            # Handle wrapping around
-            index = i % led_count
+    for i in range(led_position - 3, led_position + 4):
+        # Handle wrapping around
+        index = i % led_count
 
-            # Distance from the central LED
-            distance = abs(i - led_position)
+        # Distance from the central LED
+        distance = abs(i - led_position)
 
-            # Calculate the reduction percentage (10% per distance unit)
-            reduction_percentage = 0.1 * distance
+        # Calculate the reduction percentage (10% per distance unit)
+        reduction_percentage = 0.1 * distance
 
-            # Calculate the color value, adjusting for strength and distance
-            color = int(
-                (max_color_value - max_color_value * reduction_percentage)
-                * scaled_strength
-            )
+        # Calculate the color value, adjusting for strength and distance
+        color = int(
+            (max_color_value - max_color_value * reduction_percentage)
+            * scaled_strength
+        )
 
-            everloop[index] = {"b": color}
+        everloop[index] = {"b": color}
+    return everloop
+
+
+def set_leds(theta, strength):
+    try:
         # logger.debug("Setting LEDs")
         # MIC_QUEUE.put_nowait((theta, led_position, time.time()))
-        led.set(everloop)
+        led.set(render_everloop(theta, strength))
     except Exception as e:
         logger.error(e)
 
 
+class LedRenderer(threading.Thread):
+    """
+    Draws the everloop from a background thread so the DSP loop never waits on the
+    Matrix Creator bus.
+
+    submit() only overwrites a single slot mailbox: the renderer always draws the
+    latest (theta, strength) and older ones are dropped. Redraws are capped at
+    max_fps and a frame identical to the one on the LEDs is not written again.
+    """
+
+    def __init__(self, max_fps: float = LED_MAX_FPS) -> None:
+        super().__init__(name="led-renderer", daemon=True)
+        self.min_interval = 1 / max_fps
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        # None in the mailbox means all LEDs off
+        self._mailbox: Optional[Tuple[float, float]] = None
+        self._last_frame: Optional[List] = None
+        # counters for stats()
+        self.submitted = 0
+        self.rendered = 0
+        self.skipped = 0
+
+    def submit(self, theta, strength) -> None:
+        with self._lock:
+            self._mailbox = (theta, strength)
+            self.submitted += 1
+        self._wakeup.set()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._mailbox = None
+            self.submitted += 1
+        self._wakeup.set()
+
+    def run(self) -> None:
+        while True:
+            self._wakeup.wait()
+            with self._lock:
+                self._wakeup.clear()
+                request = self._mailbox
+            started = time.monotonic()
+            try:
+                frame = (
+                    default_everloop if request is None else render_everloop(*request)
+                )
+                if frame == self._last_frame:
+                    self.skipped += 1
+                else:
+                    led.set(frame)
+                    self._last_frame = frame
+                    self.rendered += 1
+            except Exception as e:
+                logger.error(f"Error in LED rendering: {e}")
+            # Cap the frame rate, requests arriving meanwhile collapse into one
+            time.sleep(max(self.min_interval - (time.monotonic() - started), 0))
+
+    def stats(self) -> dict:
+        return {
+            "submitted": self.submitted,
+            "rendered": self.rendered,
+            "skipped": self.skipped,
+        }
+
+
 def map_theta_to_led(theta):
     # Normalize theta to [0, 2π] range
     theta_normalized = theta % (2 * np.pi)
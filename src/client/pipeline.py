@@ -0,0 +1,91 @@
+import queue
+import threading
+from multiprocessing import Process, Queue, Value
+from multiprocessing.sharedctypes import Synchronized
+from typing import NamedTuple, Union
+
+import numpy as np
+
+from beamforming import beamform_audio
+from encoder import encode_audio, PROFILE_NAMES
+from ring_buffer import LocalRingBuffer, SharedRingBuffer
+from enums import (
+    CHANNELS,
+    CHUNK,
+    BLOCK_DURATION,
+    BACKLOG_SECONDS,
+    OPUS_PROFILE,
+    PIPELINE,
+)
+
+PIPELINE_MODES = ("processes", "threads")
+
+
+class StageThread(threading.Thread):
+    """
+    Pipeline stage running as a daemon thread, with the Process methods app.run()
+    uses. The stages loop forever, they stop with the interpreter.
+    """
+
+    def __init__(self, target, args) -> None:
+        super().__init__(target=target, args=args, name=target.__name__, daemon=True)
+
+    def terminate(self) -> None:
+        pass
+
+
+class Pipeline(NamedTuple):
+    raw_audio_ring: SharedRingBuffer
+    beamformed_audio_ring: SharedRingBuffer
+    encoded_audio_queue: Union[Queue, queue.Queue]
+    # Opus profile negotiated with the server, an index into PROFILE_NAMES
+    opus_profile: Synchronized
+    # Capture timestamp of the last wake word spotted on the device
+    wake_word: Synchronized
+    # Set while the server asks for less audio, only speech blocks are streamed
+    throttle: Synchronized
+    beamformer: Union[Process, StageThread]
+    encoder: Union[Process, StageThread]
+
+
+def create_pipeline(mode: str = PIPELINE) -> Pipeline:
+    """
+    Wire capture -> beamformer -> encoder -> sender.
+    "processes" runs the beamformer and the encoder in their own processes, connected
+    by shared memory rings and a multiprocessing queue. "threads" keeps everything in
+    one process: one NumPy/SciPy import instead of three, no pickling on the encoder
+    queue and a beamformer woken up by the capture callback instead of polling. NumPy,
+    SciPy and libopus release the GIL for the heavy lifting. Either way the rings are
+    preallocated and their slots reused for every block.
+    :param mode: One of PIPELINE_MODES.
+    :return: The stages, not started yet.
+    """
+    if mode not in PIPELINE_MODES:
+        raise ValueError(f"Unknown pipeline mode {mode}")
+    threads = mode == "threads"
+    ring = LocalRingBuffer if threads else SharedRingBuffer
+    stage = StageThread if threads else Process
+    # Bounded so a long disconnect caps memory, the encoder drops the oldest packets
+    queue_size = int(BACKLOG_SECONDS * 1000 / BLOCK_DURATION)
+    raw_audio_ring = ring((CHUNK, CHANNELS), np.int16)
+    beamformed_audio_ring = ring((CHUNK,), np.int16)
+    encoded_audio_queue = queue.Queue(queue_size) if threads else Queue(queue_size)
+    opus_profile = Value("i", PROFILE_NAMES.index(OPUS_PROFILE))
+    wake_word = Value("d", 0.0)
+    throttle = Value("b", False)
+    return Pipeline(
+        raw_audio_ring,
+        beamformed_audio_ring,
+        encoded_audio_queue,
+        opus_profile,
+        wake_word,
+        throttle,
+        stage(
+            target=beamform_audio,
+            args=(raw_audio_ring, beamformed_audio_ring, wake_word, throttle),
+        ),
+        stage(
+            target=encode_audio,
+            args=(beamformed_audio_ring, encoded_audio_queue, opus_profile),
+        ),
+    )
@@ -0,0 +1,168 @@
+# Compares the two pipeline layouts (PIPELINE = "processes" or "threads").
+#
+# Feeds a synthetic far field source into the raw ring at the capture pace, from a
+# thread like the sounddevice callback, and takes the Opus packets off the encoder
+# queue like the sender. Reports the capture to send latency, the proportional set
+# size of every process of the pipeline, context switches and CPU time. Linux only
+# (/proc). Every layout runs in a fresh interpreter so they do not share imports.
+#
+#   python pipeline_benchmark.py --seconds 30
+#   python pipeline_benchmark.py --mode threads
+import argparse
+import glob
+import json
+import os
+import queue
+import subprocess
+import sys
+import threading
+import time
+
+import numpy as np
+
+import beamforming
+from pipeline import PIPELINE_MODES, create_pipeline
+from replay import synthetic_source
+from enums import BLOCK_DURATION, CHUNK
+
+WARMUP_SECONDS = 2.0  # left out of the latency percentiles
+
+
+def process_usage(pid: int) -> dict:
+    """
+    Proportional set size (shared pages split between the processes mapping them),
+    context switches of all threads and CPU time of one process.
+    """
+    with open(f"/proc/{pid}/smaps_rollup") as smaps:
+        pss_kb = next(int(line.split()[1]) for line in smaps if line.startswith("Pss:"))
+    switches = 0
+    for status_path in glob.glob(f"/proc/{pid}/task/*/status"):
+        with open(status_path) as status:
+            for line in status:
+                if line.startswith(("voluntary_ctxt_switches", "nonvoluntary_ctxt")):
+                    switches += int(line.split()[1])
+    with open(f"/proc/{pid}/stat") as stat:
+        # utime and stime, after the parenthesised command name
+        fields = stat.read().rsplit(")", 1)[1].split()
+    cpu_seconds = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    return {"pss_kb": pss_kb, "switches": switches, "cpu_seconds": cpu_seconds}
+
+
+def run_pipeline(mode: str, seconds: float) -> dict:
+    # Every block has to reach the encoder, the synthetic source never passes the VAD
+    beamforming.VAD = False
+    audio = synthetic_source(np.radians(45), seconds)
+    pipeline = create_pipeline(mode)
+    baseline = process_usage(os.getpid())
+    pipeline.beamformer.start()
+    pipeline.encoder.start()
+    chunks = len(audio) // CHUNK
+    start = time.time()
+
+    def capture() -> None:
+        for index in range(chunks):
+            # Paced like the audio device, the timestamp is the capture time
+            delay = start + index * BLOCK_DURATION / 1000 - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            pipeline.raw_audio_ring.write(
+                audio[index * CHUNK : (index + 1) * CHUNK], time.time()
+            )
+
+    capture_thread = threading.Thread(target=capture, daemon=True)
+    capture_thread.start()
+    latencies = []
+    received = 0
+    deadline = start + seconds + 1.0
+    while time.time() < deadline:
+        try:
+            _seq, timestamp, _packet = pipeline.encoded_audio_queue.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        received += 1
+        if timestamp - start >= WARMUP_SECONDS:
+            latencies.append(time.time() - timestamp)
+    elapsed = time.time() - start
+
+    pids = [os.getpid()]
+    if mode == "processes":
+        pids += [pipeline.beamformer.pid, pipeline.encoder.pid]
+    usage = [process_usage(pid) for pid in pids]
+    # The stages of this process started after the baseline
+    usage[0]["switches"] -= baseline["switches"]
+    usage[0]["cpu_seconds"] -= baseline["cpu_seconds"]
+    pipeline.beamformer.terminate()
+    pipeline.encoder.terminate()
+    latencies_ms = np.array(latencies) * 1000 if latencies else np.zeros(1)
+    report = {
+        "mode": mode,
+        "chunks": chunks,
+        "received": received,
+        "latency_ms": {
+            name: round(float(np.percentile(latencies_ms, percentile)), 2)
+            for name, percentile in (("p50", 50), ("p90", 90), ("p99", 99))
+        },
+        "pss_mb": round(sum(item["pss_kb"] for item in usage) / 1024, 1),
+        "switches_per_second": round(sum(item["switches"] for item in usage) / elapsed),
+        "cpu_percent": round(
+            sum(item["cpu_seconds"] for item in usage) / elapsed * 100, 1
+        ),
+        "raw_ring": pipeline.raw_audio_ring.stats(),
+    }
+    if mode == "processes":
+        pipeline.beamformer.join()
+        pipeline.encoder.join()
+        for ring in (pipeline.raw_audio_ring, pipeline.beamformed_audio_ring):
+            ring.close()
+            ring.unlink()
+    return report
+
+
+def print_reports(reports: list) -> None:
+    print(
+        f"{'mode':<10} {'received':>9} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} "
+        f"{'PSS MB':>8} {'ctx/s':>8} {'CPU %':>7} {'overruns':>9}"
+    )
+    for report in reports:
+        latency = report["latency_ms"]
+        print(
+            f"{report['mode']:<10} {report['received']:>9} {latency['p50']:>8} "
+            f"{latency['p90']:>8} {latency['p99']:>8} {report['pss_mb']:>8} "
+            f"{report['switches_per_second']:>8} {report['cpu_percent']:>7} "
+            f"{report['raw_ring']['overruns']:>9}"
+        )
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Compare the client pipeline layouts")
+    parser.add_argument("--mode", choices=PIPELINE_MODES, help="run only this layout")
+    parser.add_argument("--seconds", type=float, default=20)
+    parser.add_argument("--json", action="store_true", help="print the raw report")
+    args = parser.parse_args()
+
+    if args.mode:
+        report = run_pipeline(args.mode, args.seconds)
+        if args.json:
+            print(json.dumps(report))
+        else:
+            print_reports([report])
+        # The stages never return, do not wait for them
+        sys.stdout.flush()
+        os._exit(0)
+
+    reports = []
+    for mode in PIPELINE_MODES:
+        output = subprocess.run(
+            [sys.executable, __file__, "--mode", mode, "--json"]
+            + ["--seconds", str(args.seconds)],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        reports.append(json.loads(output.strip().splitlines()[-1]))
+    print_reports(reports)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
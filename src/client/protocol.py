@@ -0,0 +1,78 @@
+# Binary audio framing shared with the server (server/ws_server/protocol.py).
+#
+# | type u8 | flags u8 | seq u32 | capture timestamp f64 | frame count u16 | frames |
+#
+# followed by frame count Opus packets, each one prefixed with its length (u16).
+# Control messages (config, interrupt, wake_word, ...) stay JSON text frames.
+#
+# The config message also picks one of OPUS_PROFILES for the connection: the client
+# proposes one, the server answers with the one to use.
+import struct
+from typing import Dict, List, NamedTuple
+
+FRAME_HEADER = struct.Struct("!BBIdH")
+FRAME_LENGTH = struct.Struct("!H")
+
+FRAME_TYPE_AUDIO = 1
+
+# Header flags
+FLAG_REPLAY = 0x01  # frames captured during a connection drop, sent after reconnecting
+
+FRAMING_JSON = "json"
+FRAMING_BINARY = "binary"
+
+
+class OpusProfile(NamedTuple):
+    application: str  # "voip", "audio" or "restricted_lowdelay"
+    bitrate: int  # bits per second
+    complexity: int  # 0 (cheapest) to 10
+    dtx: bool  # discontinuous transmission, silence costs next to nothing
+    fec: bool  # in-band forward error correction, SILK only so not with low delay
+    packet_loss: int  # expected loss in percent, sizes the FEC
+
+
+OPUS_PROFILES: Dict[str, OpusProfile] = {
+    # Speech over a lossy link, the decoder recovers a lost frame from the next one
+    "voip": OpusProfile("voip", 24000, 5, True, True, 10),
+    # CELT only, the lowest algorithmic delay at a higher bitrate
+    "low_delay": OpusProfile("restricted_lowdelay", 32000, 5, False, False, 0),
+    # Cheapest encode, leaves the CPU to the beamformer
+    "low_cpu": OpusProfile("voip", 16000, 0, True, False, 0),
+}
+
+
+class AudioFrame(NamedTuple):
+    flags: int
+    seq: int
+    timestamp: float
+    frames: List[bytes]
+
+
+def pack_audio_frame(
+    seq: int, timestamp: float, frames: List[bytes], flags: int = 0
+) -> bytes:
+    parts = [
+        FRAME_HEADER.pack(
+            FRAME_TYPE_AUDIO, flags, seq & 0xFFFFFFFF, timestamp, len(frames)
+        )
+    ]
+    for frame in frames:
+        parts.append(FRAME_LENGTH.pack(len(frame)))
+        parts.append(frame)
+    return b"".join(parts)
+
+
+def unpack_audio_frame(message: bytes) -> AudioFrame:
+    frame_type, flags, seq, timestamp, frame_count = FRAME_HEADER.unpack_from(message)
+    if frame_type != FRAME_TYPE_AUDIO:
+        raise ValueError(f"Unknown binary frame type {frame_type}")
+    frames: List[bytes] = []
+    offset = FRAME_HEADER.size
+    for _ in range(frame_count):
+        (length,) = FRAME_LENGTH.unpack_from(message, offset)
+        offset += FRAME_LENGTH.size
+        frames.append(message[offset : offset + length])
+        offset += length
+    if offset != len(message):
+        raise ValueError("Binary frame length does not match its header")
+    return AudioFrame(flags, seq, timestamp, frames)
@@ -1,8 +1,24 @@
+import io
+import os
+import threading
 import wave
 import numpy as np
 import time
+from typing import Dict, List
 from numpy.typing import NDArray
 
+from logger import logger
+from enums import (
+    CHUNK,
+    RATE,
+    SAMPLE_WIDTH,
+    RECORD_DIRECTORY,
+    RECORD_RING_CAPACITY,
+    RECORD_BATCH,
+    RECORD_ROTATE_BYTES,
+    RECORD_ROTATE_SECONDS,
+)
+
 
 def open(
     output_filename=f"sent_audio-{time.time()}.wav",
@@ -26,3 +42,166 @@ def record(
 def close(wav_file: wave.Wave_write | None) -> None:
     if wav_file:
         wav_file.close()
+
+
+class AsyncRecorder:
+    """
+    Records several streams of int16 blocks to WAV files from a background thread.
+
+    write() only copies the blocks of every stream into the same slot of a
+    preallocated ring, so the streams stay sample aligned and the caller never touches
+    the SD card. The writer thread drains the ring in batches of up to `batch` blocks
+    with one writeframes call per stream (two when the batch wraps around the ring).
+
+    Every segment is a set of files named after its first capture timestamp,
+    <directory>/<stream>/<timestamp>.wav, plus <directory>/timestamps/<timestamp>.csv
+    with the frame offset and capture timestamp of every block. A new segment starts
+    once the largest WAV passes rotate_bytes or the segment is rotate_seconds old.
+    When the writer falls behind by a whole ring the new block is dropped and counted.
+    """
+
+    def __init__(
+        self,
+        streams: Dict[str, int],
+        directory: str = RECORD_DIRECTORY,
+        chunk: int = CHUNK,
+        sample_rate: int = RATE,
+        capacity: int = RECORD_RING_CAPACITY,
+        batch: int = RECORD_BATCH,
+        rotate_bytes: int = RECORD_ROTATE_BYTES,
+        rotate_seconds: float = RECORD_ROTATE_SECONDS,
+    ) -> None:
+        self.streams = streams
+        self.directory = directory
+        self.chunk = chunk
+        self.sample_rate = sample_rate
+        self.capacity = capacity
+        self.batch = batch
+        self.rotate_bytes = rotate_bytes
+        self.rotate_seconds = rotate_seconds
+        # One ring per stream sharing the slot index, blocks stored interleaved
+        self._blocks = {
+            name: np.zeros((capacity, chunk, channels), dtype=np.int16)
+            for name, channels in streams.items()
+        }
+        self._timestamps = np.zeros(capacity, dtype=np.float64)
+        # Only the producer writes _write_seq, only the writer thread _read_seq
+        self._write_seq = 0
+        self._read_seq = 0
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._files: Dict[str, wave.Wave_write] = {}
+        self._sidecar: io.TextIOWrapper | None = None
+        self._segment_start = 0.0
+        self._segment_frames = 0
+        self.dropped = 0
+        self.segments = 0
+        for name in [*streams, "timestamps"]:
+            os.makedirs(os.path.join(directory, name), exist_ok=True)
+        self._thread = threading.Thread(
+            target=self._run, name="recorder", daemon=True
+        )
+        self._thread.start()
+
+    def write(self, timestamp: float, **blocks: NDArray[np.int16]) -> bool:
+        """
+        Queue one block of every stream.
+        :param timestamp: Capture timestamp shared by the blocks.
+        :param blocks: One (chunk,) or (chunk, channels) block per stream name.
+        :return: False if the ring was full and the blocks were dropped.
+        """
+        if self._write_seq - self._read_seq >= self.capacity:
+            self.dropped += 1
+            return False
+        slot = self._write_seq % self.capacity
+        for name, block in blocks.items():
+            self._blocks[name][slot] = np.reshape(block, (self.chunk, -1))
+        self._timestamps[slot] = timestamp
+        self._write_seq += 1
+        if self._write_seq - self._read_seq >= self.batch:
+            self._wakeup.set()
+        return True
+
+    def close(self) -> None:
+        """
+        Flush everything queued and close the current segment.
+        """
+        self._stopped = True
+        self._wakeup.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        while True:
+            # Flush at least once per batch duration even when less is queued
+            self._wakeup.wait(timeout=self.batch * self.chunk / self.sample_rate)
+            self._wakeup.clear()
+            try:
+                while self._write_seq > self._read_seq:
+                    self._flush()
+            except Exception as e:
+                logger.error(f"Error in recording: {e}")
+            if self._stopped:
+                self._close_segment()
+                return
+
+    def _flush(self) -> None:
+        start = self._read_seq % self.capacity
+        count = min(self._write_seq - self._read_seq, self.batch)
+        # Contiguous run of slots, up to the end of the ring
+        count = min(count, self.capacity - start)
+        timestamps = self._timestamps[start : start + count]
+        if not self._files or self._should_rotate(timestamps[0]):
+            self._close_segment()
+            self._open_segment(timestamps[0])
+        for name, wav_file in self._files.items():
+            wav_file.writeframes(self._blocks[name][start : start + count].tobytes())
+        if self._sidecar is not None:
+            lines: List[str] = [
+                f"{self._segment_frames + i * self.chunk},{timestamp:.6f}\n"
+                for i, timestamp in enumerate(timestamps)
+            ]
+            self._sidecar.writelines(lines)
+            self._sidecar.flush()
+        self._segment_frames += count * self.chunk
+        # Hand the slots back to the producer
+        self._read_seq += count
+
+    def _should_rotate(self, timestamp: float) -> bool:
+        largest = max(self.streams.values()) * SAMPLE_WIDTH * self._segment_frames
+        return (
+            largest >= self.rotate_bytes
+            or timestamp - self._segment_start >= self.rotate_seconds
+        )
+
+    def _open_segment(self, timestamp: float) -> None:
+        name = f"{timestamp:.3f}"
+        self._files = {
+            stream: open(
+                os.path.join(self.directory, stream, f"{name}.wav"),
+                channels=channels,
+                sample_rate=self.sample_rate,
+            )
+            for stream, channels in self.streams.items()
+        }
+        self._sidecar = io.open(
+            os.path.join(self.directory, "timestamps", f"{name}.csv"), "w"
+        )
+        self._sidecar.write("frame,timestamp\n")
+        self._segment_start = timestamp
+        self._segment_frames = 0
+        self.segments += 1
+
+    def _close_segment(self) -> None:
+        for wav_file in self._files.values():
+            close(wav_file)
+        self._files = {}
+        if self._sidecar is not None:
+            self._sidecar.close()
+            self._sidecar = None
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._write_seq - self._read_seq,
+            "dropped": self.dropped,
+            "segments": self.segments,
+        }
@@ -0,0 +1,251 @@
+# Offline replay of the client DSP chain, as fast as it runs.
+#
+# Streams an 8 channel WAV, or a synthetic far field source at a known azimuth,
+# through the same FIR, process_audio, VAD and Opus encoder code as the live
+# client, without sounddevice, pacing or LEDs. Reports throughput, per stage
+# latency percentiles and the DOA error against the ground truth.
+#
+#   python replay.py --synthetic 45 --seconds 30 --no-vad
+#   python replay.py --wav recordings/input/1700000000.000.wav --angle 90
+#
+# --max-doa-error and --min-realtime turn it into a regression gate: the exit
+# status is 1 when either limit is missed.
+import argparse
+import sys
+import time
+import wave
+
+import numpy as np
+from numpy.typing import NDArray
+
+import beamforming
+import encoder
+from encoder import encode, ProfileEncoder, PROFILE_NAMES, DTX_PACKET_BYTES
+from governor import GOVERNOR_MODES
+from kws import KeywordSpotter, WakeWordGate, load_model
+from enums import (
+    CHANNELS,
+    CHUNK,
+    RATE,
+    BLOCK_DURATION,
+    VAD,
+    SPEED_OF_SOUND,
+    STRENGHT_THRESHOLD,
+    mic_positions_3d,
+)
+
+
+def read_wav(path: str) -> NDArray[np.int16]:
+    """
+    :return: (samples, CHANNELS) interleaved int16 audio, as delivered by sounddevice.
+    """
+    with wave.open(path, "rb") as wav_file:
+        assert wav_file.getnchannels() == CHANNELS, "Expected a raw array recording"
+        assert wav_file.getsampwidth() == 2, "Expected int16 samples"
+        if wav_file.getframerate() != RATE:
+            print(f"Warning: {path} is {wav_file.getframerate()} Hz, not {RATE} Hz")
+        frames = wav_file.readframes(wav_file.getnframes())
+    return np.frombuffer(frames, dtype=np.int16).reshape(-1, CHANNELS)
+
+
+def synthetic_source(
+    theta: float, seconds: float, noise: float = 0.05, seed: int = 0
+) -> NDArray[np.int16]:
+    """
+    Band limited noise from a far field source at azimuth theta (radians), delayed
+    exactly for every microphone in the frequency domain, plus uncorrelated sensor
+    noise (relative amplitude).
+    :return: (samples, CHANNELS) interleaved int16 audio.
+    """
+    rng = np.random.default_rng(seed)
+    samples = int(seconds * RATE)
+    spectrum = np.fft.rfft(rng.standard_normal(samples))
+    frequencies = np.fft.rfftfreq(samples, d=1 / RATE)
+    spectrum[(frequencies < 200) | (frequencies > 4000)] = 0
+    direction = np.array([np.cos(theta), np.sin(theta), 0.0])
+    # Microphones closer to the source hear it first
+    delays = -(mic_positions_3d @ direction) / SPEED_OF_SOUND
+    channels = np.fft.irfft(
+        spectrum[np.newaxis, :]
+        * np.exp(-2j * np.pi * frequencies[np.newaxis, :] * delays[:, np.newaxis]),
+        n=samples,
+    )
+    channels /= np.max(np.abs(channels))
+    channels += noise * rng.standard_normal(channels.shape)
+    return (np.clip(channels * 8000, -32768, 32767).astype(np.int16)).T.copy()
+
+
+def angular_error(a, b) -> float:
+    # Smallest absolute difference of two azimuths, in degrees
+    return float(np.degrees(np.abs(np.angle(np.exp(1j * (a - b))))))
+
+
+def replay(
+    audio: NDArray[np.int16],
+    ground_truth: float | None = None,
+    vad: bool = VAD,
+    wake_word_gate: WakeWordGate | None = None,
+) -> dict:
+    timer = beamforming.stage_timer
+    timer.reset()
+    chunks = len(audio) // CHUNK
+    errors = []
+    sent = 0
+    sent_bytes = 0
+    wake_words = []
+    start = time.perf_counter()
+    for index in range(chunks):
+        block = audio[index * CHUNK : (index + 1) * CHUNK]
+        timestamp = index * BLOCK_DURATION / 1000
+        cycle_start = time.perf_counter()
+        reshaped_audio_data = beamforming.filter_audio(block.T)
+        beamformed_audio, doa_angle, strength = beamforming.process_audio(
+            reshaped_audio_data
+        )
+        if ground_truth is not None and strength > STRENGHT_THRESHOLD:
+            errors.append(angular_error(doa_angle, ground_truth))
+        if vad:
+            with timer.stage("vad"):
+                frames = beamforming.vad.process(beamformed_audio, timestamp)
+        elif strength > STRENGHT_THRESHOLD:
+            frames = [(beamformed_audio, timestamp)]
+        else:
+            frames = []
+        if wake_word_gate is not None:
+            with timer.stage("kws"):
+                frames, detected = wake_word_gate.process(
+                    beamformed_audio,
+                    timestamp,
+                    frames,
+                    beamforming.vad.active if vad else strength > STRENGHT_THRESHOLD,
+                )
+            if detected:
+                wake_words.append(round(timestamp, 2))
+        # The live encoder runs in its own process, it is not part of the cycle
+        beamforming.governor.end_chunk(time.perf_counter() - cycle_start)
+        for frame, _timestamp in frames:
+            with timer.stage("encode"):
+                packet = encode(frame)
+            if packet is not None and len(packet) > DTX_PACKET_BYTES:
+                sent += 1
+                sent_bytes += len(packet)
+    elapsed = time.perf_counter() - start
+
+    report = {
+        "chunks": chunks,
+        "sent": sent,
+        "kbps": sent_bytes * 8 / max(chunks * BLOCK_DURATION, 1),
+        "chunks_per_second": chunks / elapsed,
+        "realtime_factor": chunks * BLOCK_DURATION / 1000 / elapsed,
+        "stages_us": timer.percentiles(),
+        "governor": beamforming.governor.stats(),
+    }
+    if wake_word_gate is not None:
+        report["wake_words"] = wake_words
+        report["kws"] = wake_word_gate.stats()
+    if errors:
+        report["doa_error_deg"] = {
+            "mean": float(np.mean(errors)),
+            "p90": float(np.percentile(errors, 90)),
+            "within_10_deg": float(np.mean(np.array(errors) <= 10)),
+            "chunks": len(errors),
+        }
+    return report
+
+
+def print_report(report: dict) -> None:
+    print(
+        f"{report['chunks']} chunks, {report['sent']} sent ({report['kbps']:.1f} kbps), "
+        f"{report['chunks_per_second']:.1f} chunks/s "
+        f"({report['realtime_factor']:.1f}x real time)"
+    )
+    print(f"{'stage':<10} {'p50 us':>10} {'p90 us':>10} {'p99 us':>10}")
+    for name, stage in report["stages_us"].items():
+        print(f"{name:<10} {stage['p50']:>10} {stage['p90']:>10} {stage['p99']:>10}")
+    print(f"Governor: {report['governor']}")
+    if "kws" in report:
+        print(f"Wake words at {report['wake_words']} s: {report['kws']}")
+    if "doa_error_deg" in report:
+        doa = report["doa_error_deg"]
+        print(
+            f"DOA error over {doa['chunks']} chunks: mean {doa['mean']:.1f} deg, "
+            f"p90 {doa['p90']:.1f} deg, {doa['within_10_deg'] * 100:.0f} % within 10 deg"
+        )
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Offline replay of the client DSP chain")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--wav", help="8 channel 16 kHz int16 recording")
+    source.add_argument(
+        "--synthetic", type=float, metavar="DEGREES", help="source azimuth"
+    )
+    parser.add_argument("--angle", type=float, help="ground truth azimuth of --wav")
+    parser.add_argument("--seconds", type=float, default=30)
+    parser.add_argument("--noise", type=float, default=0.05)
+    parser.add_argument(
+        "--beamformer",
+        choices=("delay_and_sum", "mvdr"),
+        help="override BEAMFORMER_MODE",
+    )
+    parser.add_argument(
+        "--governor-mode",
+        choices=[mode.name for mode in GOVERNOR_MODES],
+        help="pin the CPU governor to one mode",
+    )
+    parser.add_argument(
+        "--opus-profile", choices=PROFILE_NAMES, help="override OPUS_PROFILE"
+    )
+    parser.add_argument(
+        "--kws", metavar="MODEL", help="gate on this keyword model, as with KWS"
+    )
+    parser.add_argument(
+        "--no-vad",
+        action="store_true",
+        help="gate on strength only, the synthetic noise source never passes the VAD",
+    )
+    parser.add_argument("--max-doa-error", type=float, help="limit on the mean, deg")
+    parser.add_argument("--min-realtime", type=float, help="limit on the speed")
+    args = parser.parse_args()
+    if args.beamformer:
+        beamforming.BEAMFORMER_MODE = args.beamformer
+    if args.opus_profile:
+        encoder.opus_encoder = ProfileEncoder(args.opus_profile)
+    if args.governor_mode:
+        governor = beamforming.governor
+        governor.enabled = False
+        governor.mode_index = [mode.name for mode in GOVERNOR_MODES].index(
+            args.governor_mode
+        )
+
+    if args.wav:
+        audio = read_wav(args.wav)
+        angle = args.angle
+    else:
+        audio = synthetic_source(np.radians(args.synthetic), args.seconds, args.noise)
+        angle = args.synthetic
+    ground_truth = None if angle is None else np.radians(angle)
+
+    wake_word_gate = (
+        WakeWordGate(KeywordSpotter(load_model(args.kws))) if args.kws else None
+    )
+    report = replay(
+        audio, ground_truth, vad=VAD and not args.no_vad, wake_word_gate=wake_word_gate
+    )
+    print_report(report)
+
+    failed = False
+    if args.min_realtime is not None and report["realtime_factor"] < args.min_realtime:
+        print(f"FAIL: slower than {args.min_realtime}x real time")
+        failed = True
+    if args.max_doa_error is not None and (
+        "doa_error_deg" not in report
+        or report["doa_error_deg"]["mean"] > args.max_doa_error
+    ):
+        print(f"FAIL: mean DOA error above {args.max_doa_error} deg")
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,175 @@
+import threading
+import time
+from multiprocessing.shared_memory import SharedMemory
+from typing import Optional, Tuple
+
+import numpy as np
+from numpy.typing import NDArray
+
+from enums import RING_CAPACITY, BLOCK_DURATION
+
+# Header slots, each one is only ever written by one side
+WRITE_SEQ = 0  # producer
+READ_SEQ = 1  # consumer
+OVERRUNS = 2  # producer
+UNDERRUNS = 3  # consumer
+HEADER_SIZE = 4
+
+POLL_INTERVAL = BLOCK_DURATION / 8000  # seconds
+
+
+class SharedRingBuffer:
+    """
+    Lock free single producer / single consumer ring of fixed shape blocks in
+    multiprocessing.shared_memory.
+
+    The producer copies a block into the next free slot and then publishes it by
+    bumping the write sequence number. The consumer gets a view of the oldest slot
+    with peek() and hands it back with advance(). Nothing is pickled or sent through
+    a pipe. When the ring is full the new block is dropped and counted as an overrun,
+    the producer never blocks.
+    """
+
+    def __init__(
+        self,
+        block_shape: Tuple[int, ...],
+        dtype=np.int16,
+        capacity: int = RING_CAPACITY,
+        name: Optional[str] = None,
+        create: bool = True,
+    ) -> None:
+        self.block_shape = tuple(block_shape)
+        self.dtype = np.dtype(dtype)
+        self.capacity = capacity
+        self._shm = SharedMemory(name=name, create=create, size=self._size())
+        self._attach(self._shm.buf)
+
+    def _size(self) -> int:
+        block_bytes = int(np.prod(self.block_shape)) * self.dtype.itemsize
+        # header + per slot sequence numbers + per slot timestamps + blocks
+        return (HEADER_SIZE + 2 * self.capacity) * 8 + self.capacity * block_bytes
+
+    def _attach(self, buf) -> None:
+        offset = 0
+        self._header = np.ndarray((HEADER_SIZE,), dtype=np.uint64, buffer=buf)
+        offset += HEADER_SIZE * 8
+        self._seqs = np.ndarray(
+            (self.capacity,), dtype=np.uint64, buffer=buf, offset=offset
+        )
+        offset += self.capacity * 8
+        self._timestamps = np.ndarray(
+            (self.capacity,), dtype=np.float64, buffer=buf, offset=offset
+        )
+        offset += self.capacity * 8
+        self._blocks = np.ndarray(
+            (self.capacity, *self.block_shape),
+            dtype=self.dtype,
+            buffer=buf,
+            offset=offset,
+        )
+
+    # Child processes attach to the same segment by name
+    def __getstate__(self):
+        return (self._shm.name, self.block_shape, self.dtype.str, self.capacity)
+
+    def __setstate__(self, state) -> None:
+        name, self.block_shape, dtype, self.capacity = state
+        self.dtype = np.dtype(dtype)
+        self._shm = SharedMemory(name=name, create=False)
+        self._attach(self._shm.buf)
+
+    def write(self, block: NDArray, timestamp: Optional[float] = None) -> bool:
+        write_seq = int(self._header[WRITE_SEQ])
+        if write_seq - int(self._header[READ_SEQ]) >= self.capacity:
+            self._header[OVERRUNS] += 1
+            return False
+        slot = write_seq % self.capacity
+        np.copyto(self._blocks[slot], block, casting="unsafe")
+        self._seqs[slot] = write_seq
+        self._timestamps[slot] = time.time() if timestamp is None else timestamp
+        # Publish the slot only once it is complete
+        self._header[WRITE_SEQ] = write_seq + 1
+        return True
+
+    def peek(
+        self, timeout: Optional[float] = None
+    ) -> Optional[Tuple[int, float, NDArray]]:
+        """
+        Wait for the oldest unread block.
+        :param timeout: Seconds to wait. None waits forever.
+        :return: (sequence number, capture timestamp, view of the block) or None if the
+        ring stayed empty for timeout seconds. The view is valid until advance().
+        """
+        read_seq = int(self._header[READ_SEQ])
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while int(self._header[WRITE_SEQ]) == read_seq:
+            if deadline is not None and time.monotonic() >= deadline:
+                self._header[UNDERRUNS] += 1
+                return None
+            self._wait()
+        slot = read_seq % self.capacity
+        return int(self._seqs[slot]), float(self._timestamps[slot]), self._blocks[slot]
+
+    def _wait(self) -> None:
+        time.sleep(POLL_INTERVAL)
+
+    def advance(self) -> None:
+        self._header[READ_SEQ] += 1
+
+    def __len__(self) -> int:
+        return int(self._header[WRITE_SEQ]) - int(self._header[READ_SEQ])
+
+    def stats(self) -> dict:
+        return {
+            "written": int(self._header[WRITE_SEQ]),
+            "read": int(self._header[READ_SEQ]),
+            "overruns": int(self._header[OVERRUNS]),
+            "underruns": int(self._header[UNDERRUNS]),
+        }
+
+    def close(self) -> None:
+        # The numpy views have to go before the mapping can be closed
+        del self._header, self._seqs, self._timestamps, self._blocks
+        self._shm.close()
+
+    def unlink(self) -> None:
+        self._shm.unlink()
+
+
+class LocalRingBuffer(SharedRingBuffer):
+    """
+    The same ring in the memory of one process, for pipeline stages running as
+    threads. A consumer waiting in peek() is woken up by write() instead of polling.
+    """
+
+    def __init__(
+        self,
+        block_shape: Tuple[int, ...],
+        dtype=np.int16,
+        capacity: int = RING_CAPACITY,
+    ) -> None:
+        self.block_shape = tuple(block_shape)
+        self.dtype = np.dtype(dtype)
+        self.capacity = capacity
+        self._published = threading.Event()
+        self._attach(memoryview(bytearray(self._size())))
+
+    def __getstate__(self):
+        raise TypeError("LocalRingBuffer cannot be shared with another process")
+
+    def write(self, block: NDArray, timestamp: Optional[float] = None) -> bool:
+        written = super().write(block, timestamp)
+        self._published.set()
+        return written
+
+    def _wait(self) -> None:
+        # peek() checks the write sequence number again after every wakeup, a write
+        # landing between wait() and clear() is not missed
+        self._published.wait(POLL_INTERVAL)
+        self._published.clear()
+
+    def close(self) -> None:
+        del self._header, self._seqs, self._timestamps, self._blocks
+
+    def unlink(self) -> None:
+        pass
@@ -1,50 +1,99 @@
 import numpy as np
-from collections import deque
-from typing import List, Deque
+from typing import Tuple
+from numpy.typing import NDArray
 
 from logger import logger
 
 
 class SignalStrengthTracker:
+    """
+    Weighted moving average of the signal strength in dBFS.
+
+    The last smoothing_window strengths and their weights live in fixed arrays used as
+    a ring, with running sums of weight * strength and of the weights, so every chunk
+    is a constant time update without allocations. The sums are rebuilt from the ring
+    each time it wraps around to keep floating point drift bounded.
+    """
+
     def __init__(self, smoothing_window=5, silence_threshold=-40):
         self.smoothing_window = smoothing_window
         self.silence_threshold = silence_threshold
-        self.strength_buffer: Deque[np.float64] = deque([], maxlen=smoothing_window)
+        self.strengths = np.zeros(smoothing_window, dtype=np.float64)
+        self.weights = np.zeros(smoothing_window, dtype=np.float64)
+        self.index = 0
+        self.count = 0
+        self.weighted_sum = 0.0
+        self.weight_sum = 0.0
         self.silence_weight = 1
         self.non_silence_weight = 10
         self.log_constant = np.log10(1 / 32768)
+        # float64 copy of the last chunk or block, reused while its shape stays the same
+        self.scratch = np.empty(0, dtype=np.float64)
 
     def calculate_signal_strength(self, signal):
+        """
+        RMS level in dBFS along the last axis.
+        :param signal: (samples,) chunk or (channels, samples) block of int16 audio.
+        :return: The level of the chunk, or one level per channel. Silence is -90.3 dB.
+        """
         if signal.size == 0:
             return 0
-        if not np.any(signal):  # Check if the signal is all zeros
-            return self.log_constant
-
-        rms = np.sqrt(np.mean(np.square(signal.astype(np.float64))))
-        rms = max(rms, 1)
+        # float64 sums the squares of int16 samples exactly, the copy goes into the
+        # scratch buffer so nothing is allocated per chunk
+        if self.scratch.shape != signal.shape:
+            self.scratch = np.empty(signal.shape, dtype=np.float64)
+        np.copyto(self.scratch, signal)
+        if signal.ndim == 1:
+            energy = np.dot(self.scratch, self.scratch)
+        else:
+            energy = np.einsum("ci,ci->c", self.scratch, self.scratch)
+        rms = np.sqrt(np.maximum(energy / signal.shape[-1], 1))
         strength_db = 20 * (np.log10(rms) + self.log_constant)
         # logger.debug(f"RMS: {rms}, Strength: {strength_db}")
         return strength_db
 
     def update_strength_buffer(self, strength):
-        self.strength_buffer.append(strength)
+        weight = (
+            self.non_silence_weight
+            if strength >= self.silence_threshold
+            else self.silence_weight
+        )
+        if self.count == self.smoothing_window:
+            # Drop the oldest entry before it is overwritten
+            self.weighted_sum -= self.strengths[self.index] * self.weights[self.index]
+            self.weight_sum -= self.weights[self.index]
+        else:
+            self.count += 1
+        self.strengths[self.index] = strength
+        self.weights[self.index] = weight
+        self.weighted_sum += strength * weight
+        self.weight_sum += weight
+        self.index += 1
+        if self.index == self.smoothing_window:
+            self.index = 0
+            self.weighted_sum = float(np.dot(self.strengths, self.weights))
+            self.weight_sum = float(np.sum(self.weights))
 
     def get_smoothed_strength(self):
-        if not self.strength_buffer:
+        if self.count == 0:
             return 0  # Default value if buffer is empty
-
-        buffer_array = np.array(self.strength_buffer)
-        weights = np.where(
-            buffer_array >= self.silence_threshold,
-            self.non_silence_weight,
-            self.silence_weight,
-        )
-        weighted_strengths = buffer_array * weights
-        smoothed_strength = np.sum(weighted_strengths) / np.sum(weights)
-
-        return smoothed_strength
+        return self.weighted_sum / self.weight_sum
 
     def process_chunk(self, chunk):
         strength = self.calculate_signal_strength(chunk)
         self.update_strength_buffer(strength)
         return self.get_smoothed_strength()
+
+    def process_block(self, block) -> Tuple[np.float64, NDArray[np.float64]]:
+        """
+        Track the level of a multichannel block in the same pass as the per channel
+        levels.
+        :param block: (channels, samples) block of int16 audio.
+        :return: The smoothed level of the block (mean power of the channels) and the
+        level of every channel.
+        """
+        channel_strengths = self.calculate_signal_strength(block)
+        # Average the channels in the power domain
+        strength = 10 * np.log10(np.mean(np.power(10.0, channel_strengths / 10)))
+        self.update_strength_buffer(strength)
+        return self.get_smoothed_strength(), channel_strengths
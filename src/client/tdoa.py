@@ -4,13 +4,99 @@ from numpy.typing import NDArray
 from scipy.signal import find_peaks
 
 from logger import logger
-from enums import CHANNELS, mic_positions
+from enums import (
+    CHANNELS,
+    CHUNK,
+    RATE,
+    SPEED_OF_SOUND,
+    DOA_METHOD,
+    AZIMUTH_GRID_STEP,
+    SRP_MIN_FREQUENCY,
+    SRP_MAX_FREQUENCY,
+    mic_positions,
+    mic_positions_3d,
+)
 from utils import calculate_mic_pair_angles
 
 num_mics = mic_positions.shape[0]
 
 mic_pair_angles = calculate_mic_pair_angles(mic_positions)
 
+# GCC-PHAT uses every unique microphone pair
+pair_i, pair_j = np.triu_indices(num_mics, k=1)
+# Only lags the array geometry can produce are searched
+max_lag_samples = int(
+    np.ceil(
+        np.max(np.linalg.norm(mic_positions[pair_i] - mic_positions[pair_j], axis=1))
+        / SPEED_OF_SOUND
+        * RATE
+    )
+)
+gcc_lags = np.arange(-max_lag_samples, max_lag_samples + 1)
+# Zero padding past the chunk length avoids circular wrap around of the searched lags
+GCC_N_FFT = 1 << int(np.ceil(np.log2(CHUNK + max_lag_samples)))
+# Inverse DFT restricted to the searched lags: correlation = Re(cross_spectra @ gcc_lag_table)
+gcc_bin_weights = np.full(GCC_N_FFT // 2 + 1, 2.0)
+gcc_bin_weights[[0, -1]] = 1.0  # DC and Nyquist appear once in the full spectrum
+gcc_lag_table = (
+    gcc_bin_weights[:, np.newaxis]
+    * np.exp(
+        2j * np.pi * np.outer(np.arange(GCC_N_FFT // 2 + 1), gcc_lags) / GCC_N_FFT
+    )
+    / GCC_N_FFT
+).astype(np.complex64)
+# Least squares solution of (p_j - p_i) . u = c * tdoa_ij for the source direction u
+pair_baselines_pinv = np.linalg.pinv(mic_positions[pair_j] - mic_positions[pair_i])
+
+
+def calculate_srp_steering_table(
+    grid_step=AZIMUTH_GRID_STEP,
+    min_frequency=SRP_MIN_FREQUENCY,
+    max_frequency=SRP_MAX_FREQUENCY,
+    n_fft=GCC_N_FFT,
+    fs=RATE,
+    speed_of_sound=SPEED_OF_SOUND,
+):
+    """
+    Precompute the SRP-PHAT steering table for a grid of azimuths in the array plane.
+
+    Parameters:
+    grid_step: Spacing of the azimuth grid in degrees.
+    min_frequency, max_frequency: Band of the cross-spectra that is steered.
+    n_fft: FFT length of the cross-spectra.
+    fs: Sampling frequency.
+    speed_of_sound: Speed of sound in air (m/s).
+
+    Returns:
+    azimuths: (angles,) grid in radians.
+    bins: Indices of the cross-spectra bins used.
+    table: (angles, 2 * pairs * bins) real steering table. The steered response power
+    of every azimuth is table @ [Re(G), Im(G)] with G = cross_spectra[:, bins].ravel().
+    """
+    azimuths = np.radians(np.arange(0, 360, grid_step))
+    frequencies = np.fft.rfftfreq(n_fft, d=1 / fs)
+    bins = np.flatnonzero((frequencies >= min_frequency) & (frequencies <= max_frequency))
+    directions = np.stack(
+        [np.cos(azimuths), np.sin(azimuths), np.zeros_like(azimuths)], axis=1
+    )
+    # Expected t_i - t_j for every (azimuth, pair)
+    expected_tdoas = (
+        directions @ (mic_positions_3d[pair_j] - mic_positions_3d[pair_i]).T
+    ) / speed_of_sound
+    # exp(j w tau) undoes the exp(-j w tau) phase of a source in that direction
+    phase = (
+        2
+        * np.pi
+        * frequencies[bins][np.newaxis, np.newaxis, :]
+        * expected_tdoas[:, :, np.newaxis]
+    ).reshape(len(azimuths), -1)
+    # Re(e^{j phase} G) = cos(phase) Re(G) - sin(phase) Im(G), as one real matrix
+    table = np.concatenate([np.cos(phase), -np.sin(phase)], axis=1)
+    return azimuths, bins, table.astype(np.float32)
+
+
+srp_azimuths, srp_bins, srp_steering_table = calculate_srp_steering_table()
+
 
 @profile
 def estimate_tdoa(sig1, sig2, fs, threshold=0.1):
@@ -67,6 +153,103 @@ def estimate_tdoa_cross_correlation(sig1, sig2, fs):
     return tdoa
 
 
+def gcc_phat_cross_spectra(
+    audio_data: NDArray[np.int16], n_fft: int = GCC_N_FFT
+) -> NDArray[np.complex64]:
+    """
+    PHAT weighted cross-spectra of every microphone pair.
+
+    Parameters:
+    audio_data: (channels, samples) block.
+    n_fft: FFT length.
+
+    Returns:
+    cross_spectra: (pairs, n_fft // 2 + 1) array, pairs ordered as (pair_i, pair_j).
+    """
+    # One FFT for all channels
+    spectra = np.fft.rfft(audio_data, n=n_fft, axis=1)
+    # Phase transform: whitening each channel once is the same as normalising every
+    # cross-spectrum, since |X_i X_j*| = |X_i| |X_j|
+    spectra /= np.maximum(np.abs(spectra), 1e-12)
+    # Unit magnitude spectra are safe to handle in single precision
+    spectra = spectra.astype(np.complex64)
+    return spectra[pair_i] * np.conj(spectra[pair_j])
+
+
+@profile
+def estimate_tdoas_gcc_phat(audio_data: NDArray[np.int16], fs=RATE) -> NDArray[np.float64]:
+    """
+    Estimate the TDOA of every microphone pair with GCC-PHAT.
+
+    Parameters:
+    audio_data: (channels, samples) block.
+    fs: Sampling frequency of the signals.
+
+    Returns:
+    tdoas: (pairs,) TDOAs in seconds. A positive value means mic pair_i hears the
+    source after mic pair_j.
+    """
+    cross_spectra = gcc_phat_cross_spectra(audio_data)
+    correlation = (cross_spectra @ gcc_lag_table).real
+
+    peaks = np.argmax(correlation, axis=1)
+    # Parabolic interpolation around the peak for a sub-sample estimate
+    rows = np.arange(correlation.shape[0])
+    inner = np.clip(peaks, 1, len(gcc_lags) - 2)
+    y0 = correlation[rows, inner - 1]
+    y1 = correlation[rows, inner]
+    y2 = correlation[rows, inner + 1]
+    denominator = y0 - 2 * y1 + y2
+    # Peaks on the edge of the search window or flat tops are not refined
+    refine = (peaks == inner) & (denominator < 0)
+    offset = np.zeros_like(y1)
+    offset[refine] = 0.5 * (y0[refine] - y2[refine]) / denominator[refine]
+    return (gcc_lags[peaks] + offset) / fs
+
+
+def calculate_azimuth_lstsq(tdoas, speed_of_sound=SPEED_OF_SOUND) -> np.float64:
+    """
+    Estimate the azimuth angle from the TDOAs of every microphone pair.
+
+    Parameters:
+    tdoas: (pairs,) TDOA measurements in seconds, as returned by estimate_tdoas_gcc_phat.
+    speed_of_sound: Speed of sound in air (m/s).
+
+    Returns:
+    azimuth: Estimated azimuth angle in radians, in [0, 2π).
+    """
+    direction = pair_baselines_pinv @ (tdoas * speed_of_sound)
+    return np.float64(np.mod(np.arctan2(direction[1], direction[0]), 2 * np.pi))
+
+
+@profile
+def srp_phat_power_map(audio_data: NDArray[np.int16]) -> NDArray[np.float32]:
+    """
+    Steered response power of every azimuth in srp_azimuths.
+
+    Parameters:
+    audio_data: (channels, samples) block.
+
+    Returns:
+    power: (angles,) power map.
+    """
+    cross_spectra = gcc_phat_cross_spectra(audio_data)[:, srp_bins].ravel()
+    return srp_steering_table @ np.concatenate([cross_spectra.real, cross_spectra.imag])
+
+
+def calculate_azimuth_srp_phat(audio_data: NDArray[np.int16]) -> np.float64:
+    """
+    Estimate the azimuth angle as the peak of the SRP-PHAT power map.
+
+    Parameters:
+    audio_data: (channels, samples) block.
+
+    Returns:
+    azimuth: Estimated azimuth angle in radians, on the AZIMUTH_GRID_STEP grid.
+    """
+    return np.float64(srp_azimuths[np.argmax(srp_phat_power_map(audio_data))])
+
+
 @profile
 def calculate_azimuth(tdoas, speed_of_sound=343.0) -> np.float64:
     """
@@ -103,7 +286,14 @@ def calculate_azimuth(tdoas, speed_of_sound=343.0) -> np.float64:
 
 
 @profile
-def calculate_doa(audio_data: NDArray[np.int16], mic_positions, fs=16000) -> np.float64:
+def calculate_doa(
+    audio_data: NDArray[np.int16], mic_positions, fs=16000, method=DOA_METHOD
+) -> np.float64:
+    if method == "srp_phat":
+        return calculate_azimuth_srp_phat(audio_data)
+    if method == "gcc_phat":
+        return calculate_azimuth_lstsq(estimate_tdoas_gcc_phat(audio_data, fs))
+
     # logger.debug("Retrieving audio shape")
     num_channels = CHANNELS
     half_channels = num_channels // 2  # 4
@@ -116,7 +306,7 @@ def calculate_doa(audio_data: NDArray[np.int16], mic_positions, fs=16000) -> np.
         j = i + half_channels
         # logger.debug(f"Calculating TDOA for mic {i} and {j}")
         # tdoa1 = estimate_tdoa(audio_data[:, i], audio_data[:, j], fs)
-        tdoa2 = estimate_tdoa_cross_correlation(audio_data[:, i], audio_data[:, j], fs)
+        tdoa2 = estimate_tdoa_cross_correlation(audio_data[i], audio_data[j], fs)
         # if tdoa1 and tdoa2:
         # logger.debug(f"tdoa1: {tdoa1}, tdoa2: {tdoa2}, diff: {tdoa1 - tdoa2}")
         tdoa = tdoa2
@@ -1,5 +1,11 @@
+import time
+from contextlib import contextmanager
+from typing import Dict
+
 import numpy as np
 
+from enums import STAGE_TIMER_CAPACITY
+
 
 def calculate_mic_pair_angles(mic_positions):
     # Expand mic_positions to enable broadcasting
@@ -13,3 +19,49 @@ def calculate_mic_pair_angles(mic_positions):
     angles = np.arctan2(deltas[:, :, 1], deltas[:, :, 0])
 
     return angles
+
+
+class StageTimer:
+    """
+    Wall clock duration of named pipeline stages over the last `capacity` calls,
+    kept in preallocated arrays.
+
+        with stage_timer.stage("doa"):
+            theta = calculate_doa(audio, mic_positions)
+    """
+
+    def __init__(self, capacity=STAGE_TIMER_CAPACITY):
+        self.capacity = capacity
+        self.durations: Dict[str, np.ndarray] = {}
+        self.counts: Dict[str, int] = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, duration):
+        if name not in self.durations:
+            self.durations[name] = np.zeros(self.capacity, dtype=np.float64)
+            self.counts[name] = 0
+        self.durations[name][self.counts[name] % self.capacity] = duration
+        self.counts[name] += 1
+
+    def percentiles(self, q=(50, 90, 99)) -> Dict[str, Dict[str, float]]:
+        """
+        :param q: Percentiles to report.
+        :return: {stage: {"p50": microseconds, ...}} over the recorded window.
+        """
+        report = {}
+        for name, durations in self.durations.items():
+            recorded = durations[: min(self.counts[name], self.capacity)]
+            values = np.percentile(recorded, q) * 1e6
+            report[name] = {f"p{p}": round(float(v), 1) for p, v in zip(q, values)}
+        return report
+
+    def reset(self):
+        self.durations.clear()
+        self.counts.clear()
@@ -0,0 +1,150 @@
+from collections import deque
+from typing import Deque, List, Tuple
+
+import numpy as np
+from numpy.typing import NDArray
+
+from enums import (
+    RATE,
+    CHUNK,
+    VAD_ENERGY_MARGIN,
+    VAD_MIN_ENERGY,
+    VAD_FLATNESS_THRESHOLD,
+    VAD_HANGOVER,
+    VAD_PRE_ROLL,
+    SRP_MIN_FREQUENCY,
+    SRP_MAX_FREQUENCY,
+)
+
+FULL_SCALE = 32768.0
+# Noise floor tracking: falls quickly to quieter blocks, creeps up during loud ones
+# outside speech
+FLOOR_FALL = 0.5
+FLOOR_RISE_DB = 0.05  # dB per block, so a new stationary noise becomes floor in ~10 s
+# Minimum statistics: the floor is never below the quietest block of this window, so a
+# stationary noise that passes as speech still becomes floor. Speech dips between words.
+FLOOR_WINDOW_SECONDS = 5.0
+
+
+class VoiceActivityDetector:
+    """
+    Lightweight voice activity gate for the beamformed signal.
+
+    A block is speech when its energy is VAD_ENERGY_MARGIN dB above the tracked noise
+    floor and its spectrum in the speech band is not flat. Fans, HVAC and hum are
+    stationary and end up in the noise floor, broadband bursts fail the spectral
+    flatness test. After the last speech block VAD_HANGOVER more blocks are let through
+    so word endings and short pauses are not cut, and on speech onset the previous
+    VAD_PRE_ROLL blocks are released first so the leading consonant is kept.
+    """
+
+    def __init__(
+        self,
+        sample_rate: int = RATE,
+        chunk: int = CHUNK,
+        energy_margin: float = VAD_ENERGY_MARGIN,
+        min_energy: float = VAD_MIN_ENERGY,
+        flatness_threshold: float = VAD_FLATNESS_THRESHOLD,
+        hangover: int = VAD_HANGOVER,
+        pre_roll: int = VAD_PRE_ROLL,
+    ) -> None:
+        self.energy_margin = energy_margin
+        self.min_energy = min_energy
+        self.flatness_threshold = flatness_threshold
+        self.hangover = hangover
+        self.window = np.hanning(chunk).astype(np.float32)
+        frequencies = np.fft.rfftfreq(chunk, d=1 / sample_rate)
+        self.band = (frequencies >= SRP_MIN_FREQUENCY) & (frequencies <= SRP_MAX_FREQUENCY)
+        self.noise_floor: float | None = None
+        # Energies of the last FLOOR_WINDOW_SECONDS, a ring
+        self.recent_energy = np.full(
+            int(FLOOR_WINDOW_SECONDS * sample_rate / chunk), -np.inf
+        )
+        self.energy_index = 0
+        self.hangover_left = 0
+        # Whether the last block processed was speech, hangover aside
+        self.speech = False
+        self.pre_roll: Deque[Tuple[NDArray[np.int16], float]] = deque(maxlen=pre_roll)
+        # counters for stats()
+        self.blocks = 0
+        self.speech_blocks = 0
+        self.forwarded_blocks = 0
+
+    def energy(self, audio: NDArray[np.int16]) -> float:
+        # dBFS, same scale as SignalStrengthTracker
+        mean_square = np.mean(np.square(audio, dtype=np.float64))
+        return float(10 * np.log10(max(mean_square, 1.0) / FULL_SCALE**2))
+
+    def spectral_flatness(self, audio: NDArray[np.int16]) -> float:
+        # Geometric over arithmetic mean of the power spectrum in the speech band:
+        # close to 0.5 for white noise, close to 0 for voiced speech
+        power = np.abs(np.fft.rfft(audio * self.window)[self.band]) ** 2 + 1e-6
+        return float(np.exp(np.mean(np.log(power))) / np.mean(power))
+
+    def is_speech(self, audio: NDArray[np.int16]) -> bool:
+        """
+        Classify one block and update the noise floor. The floor does not creep up
+        during speech and its hangover, a long utterance would otherwise become the
+        floor and close the gate, it only catches up with the quietest recent block.
+        """
+        energy = self.energy(audio)
+        if self.noise_floor is None:
+            self.noise_floor = energy
+        threshold = max(self.noise_floor + self.energy_margin, self.min_energy)
+        speech = (
+            energy > threshold
+            and self.spectral_flatness(audio) < self.flatness_threshold
+        )
+        if energy < self.noise_floor:
+            self.noise_floor += FLOOR_FALL * (energy - self.noise_floor)
+        elif not speech and self.hangover_left == 0:
+            self.noise_floor = min(self.noise_floor + FLOOR_RISE_DB, energy)
+        self.recent_energy[self.energy_index] = energy
+        self.energy_index = (self.energy_index + 1) % len(self.recent_energy)
+        self.noise_floor = max(self.noise_floor, float(np.min(self.recent_energy)))
+        return speech
+
+    def process(
+        self, audio: NDArray[np.int16], timestamp: float
+    ) -> List[Tuple[NDArray[np.int16], float]]:
+        """
+        Gate one beamformed block. The detector keeps a reference to the block for the
+        pre-roll, so it must not be modified afterwards.
+        :param audio: Beamformed block.
+        :param timestamp: Capture timestamp of the block.
+        :return: (block, timestamp) pairs to forward to the encoder, oldest first.
+        """
+        self.blocks += 1
+        self.speech = self.is_speech(audio)
+        if self.speech:
+            self.speech_blocks += 1
+            onset = self.hangover_left == 0
+            self.hangover_left = self.hangover
+            frames = [(audio, timestamp)]
+            if onset:
+                # Release the leading context first
+                frames = list(self.pre_roll) + frames
+                self.pre_roll.clear()
+            self.forwarded_blocks += len(frames)
+            return frames
+        if self.hangover_left > 0:
+            self.hangover_left -= 1
+            self.forwarded_blocks += 1
+            return [(audio, timestamp)]
+        self.pre_roll.append((audio, timestamp))
+        return []
+
+    @property
+    def active(self) -> bool:
+        # Speech in the last block or still within its hangover
+        return self.hangover_left > 0
+
+    def stats(self) -> dict:
+        return {
+            "blocks": self.blocks,
+            "speech": self.speech_blocks,
+            "forwarded": self.forwarded_blocks,
+            "noise_floor_db": None
+            if self.noise_floor is None
+            else round(self.noise_floor, 1),
+        }
@@ -14,6 +14,8 @@ from faster_whisper.transcribe import Segment
 
 
 from typing import Any, List
+from pcm_ring import PcmRingPool
+from sessions import Tagged
 from logger import logger
 
 # Set the start method for multiprocessing
@@ -24,17 +26,15 @@ mp.set_start_method(
 
 def create_processes(
     shutdown_event: Ev,
-    decoded_audio_queue: Any,  # Queue([NDArray[np.float32]])
-    transcribed_text_queue: "Queue[str]",
-    concept_queue: "Queue[Segment]",
+    audio_pool: PcmRingPool,
+    transcribed_text_queue: "Queue[Tagged[str]]",
+    concept_queue: "Queue[Tagged[Segment]]",
     stt_ready_event: Ev,
-    question_queue: "Queue[str]",
-    intent_queue: "Queue[str]",
-    response_queue: Any,  # Queue([str])
-    wake_word_event: Ev,
-    question_event: Ev,
+    question_queue: "Queue[Tagged[str]]",
+    intent_queue: "Queue[Tagged[str]]",
+    response_queue: Any,  # Queue([(session ID, str)])
+    session_flags: Any,  # DictProxy[(session ID, flag), bool]
     process_segments_ready_event: Ev,
-    thinking_event: Ev,
 ) -> List[Process]:
     processes: List[Process] = []
     stt_process = mp.Process(
@@ -42,11 +42,11 @@ def create_processes(
         target=speech_to_text.stt,
         args=(
             shutdown_event,
-            decoded_audio_queue,
+            audio_pool,
             transcribed_text_queue,
             concept_queue,
             stt_ready_event,
-            wake_word_event,
+            session_flags,
         ),
     )
     processes.append(stt_process)
@@ -60,7 +60,7 @@ def create_processes(
             question_queue,
             intent_queue,
             process_segments_ready_event,
-            question_event,
+            session_flags,
             5.0,  # timeout
         ),
     )
@@ -76,8 +76,7 @@ def create_processes(
         name="parse_command",
         args=(
             shutdown_event,
-            wake_word_event,
-            thinking_event,
+            session_flags,
             intent_queue,
             response_queue,
         ),
@@ -87,9 +86,7 @@ def create_processes(
         name="parse_question",
         args=(
             shutdown_event,
-            question_event,
-            thinking_event,
-            wake_word_event,
+            session_flags,
             question_queue,
             response_queue,
         ),
@@ -106,14 +103,16 @@ def main() -> None:
     asyncio.set_event_loop(loop)
     manager = Manager()
     # Communication Queues
-    decoded_audio_queue = manager.Queue()  # Queue([NDArray[np.float32]])
-    response_queue = manager.Queue()  # Queue([str])
+    # Decoded audio of every session, straight from the receiver to STT
+    audio_pool = PcmRingPool()
+    # Every item is tagged with the session (device) it belongs to
+    response_queue = manager.Queue()  # Queue([(session ID, str)])
     # IPC Queues
     ctx = get_context("spawn")
-    transcribed_text_queue: "Queue[str]" = ctx.Queue()  # Queue([str])
-    concept_queue: "Queue[Segment]" = ctx.Queue()  # Queue([segment])
-    question_queue: "Queue[str]" = ctx.Queue()  # Queue([str])
-    intent_queue: "Queue[str]" = ctx.Queue()  # Queue([str])
+    transcribed_text_queue: "Queue[Tagged[str]]" = ctx.Queue()  # Queue([(id, str)])
+    concept_queue: "Queue[Tagged[Segment]]" = ctx.Queue()  # Queue([(id, segment)])
+    question_queue: "Queue[Tagged[str]]" = ctx.Queue()  # Queue([(id, str)])
+    intent_queue: "Queue[Tagged[str]]" = ctx.Queue()  # Queue([(id, str)])
 
     # Create a shared event to signal shutdown
     shutdown_event = Event()
@@ -123,23 +122,20 @@ def main() -> None:
     # Skip Processing Events
     _music_event = Event()
     _stop_listening_event = Event()
-    wake_word_event = Event()
-    question_event = Event()
-    thinking_event = Event()
+    # Wake word, question and thinking flags of every session, see sessions.py
+    session_flags = manager.dict()
 
     processes = create_processes(
         shutdown_event=shutdown_event,
-        decoded_audio_queue=decoded_audio_queue,
+        audio_pool=audio_pool,
         transcribed_text_queue=transcribed_text_queue,
         concept_queue=concept_queue,
         stt_ready_event=stt_ready_event,
         question_queue=question_queue,
         intent_queue=intent_queue,
         response_queue=response_queue,
-        wake_word_event=wake_word_event,
+        session_flags=session_flags,
         process_segments_ready_event=process_segments_ready_event,
-        question_event=question_event,
-        thinking_event=thinking_event,
     )
     try:
         logger.info("Creating processes. Please wait...")
@@ -153,13 +149,11 @@ def main() -> None:
 
     try:
         server = ws_server.start_async_server(
-            manager_queue=decoded_audio_queue,
+            audio_pool=audio_pool,
             stt_ready_event=stt_ready_event,
             response_queue=response_queue,
             process_segments_ready_event=process_segments_ready_event,
-            thinking_event=thinking_event,
-            question_event=question_event,
-            wake_word_event=wake_word_event,
+            session_flags=session_flags,
         )
         loop.run_until_complete(server)
         loop.run_forever()
@@ -172,6 +166,8 @@ def main() -> None:
                 process.terminate()
                 process.join()
                 logger.info(f"Process {process} joined")
+        audio_pool.close()
+        audio_pool.unlink()
         loop.close()
 
 
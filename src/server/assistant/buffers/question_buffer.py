@@ -4,10 +4,12 @@ from threading import Thread
 from multiprocessing.synchronize import Event
 from typing import List, Self
 
+from sessions import SessionEvent, Tagged
+
 from logger import logger
 
 class QuestionBuffer:
-    def __init__(self: Self, question_queue: "Queue[str]", max_question_length: int = 10,timeout: float = 5.0)-> None:
+    def __init__(self: Self, question_queue: "Queue[Tagged[str]]", session_id: str, max_question_length: int = 10,timeout: float = 5.0)-> None:
         self._lock = Lock()
         # initialize empty buffers
         self._buffer: List[str] = []
@@ -18,6 +20,7 @@ class QuestionBuffer:
         self.timeout = timeout # seconds before question is considered complete.
         # Assign queue object
         self.queue = question_queue
+        self.session_id = session_id
         # Create thread to check for timeout
         self._stop_thread = False
         self.thread: Thread = Thread()
@@ -43,7 +46,7 @@ class QuestionBuffer:
                 self.thread.join()
             question = " ".join(self._buffer)
             logger.debug(f"Question: {question}")
-            self.queue.put(question)
+            self.queue.put((self.session_id, question))
             self._reset()
     # Reset buffer
     def _reset(self: Self)-> None:
@@ -74,7 +77,7 @@ class QuestionBuffer:
     def handle_question(
         self: Self,
         sentence: str,
-        question_event: Event,
+        question_event: Event | SessionEvent,
     ) -> None:
         if question_event.is_set(): # Question is in progress. Flag cleared by the question process.
             self._add_sentence(sentence)
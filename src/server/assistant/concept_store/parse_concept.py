@@ -2,14 +2,15 @@ from multiprocessing import Queue
 from multiprocessing.synchronize import Event
 import time
 from faster_whisper.transcribe import Segment
+from sessions import Tagged
 from logger import logger
 
 
-def parse_concept(shutdown_event: Event, concept_queue: "Queue[Segment]") -> None:
+def parse_concept(shutdown_event: Event, concept_queue: "Queue[Tagged[Segment]]") -> None:
     logger.info("Parse Concept Ready")
     while shutdown_event.is_set() is False:
-        concept = concept_queue.get()
-        logger.debug(f"Received concept: {concept.text}")
+        session_id, concept = concept_queue.get()
+        logger.debug(f"Received concept ({session_id}): {concept.text}")
         # concept_queue.task_done()
 
 
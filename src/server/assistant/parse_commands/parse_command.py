@@ -2,8 +2,9 @@ import json
 from multiprocessing import Queue
 from multiprocessing.synchronize import Event
 import time
-from typing import List, cast
+from typing import Any, List, cast
 from logger import logger
+from sessions import THINKING, WAKE_WORD, SessionEvent, Tagged
 from assistant.assistants import (
     intent_assistant,
     threads,
@@ -24,16 +25,17 @@ from openai.types.beta.threads.message_content_text import (
 # TODO: Implement responses.
 def parse_command(
     shutdown_event: Event,
-    wake_word_event: Event,
-    thinking_event: Event,
-    intent_queue: "Queue[str]",
-    response_queue: "Queue[str]",
+    session_flags: Any,
+    intent_queue: "Queue[Tagged[str]]",
+    response_queue: "Queue[Tagged[str]]",
 ) -> None:
     logger.info("Parse Command Ready")
     while shutdown_event.is_set() is False:
-        intent = (
+        session_id, intent = (
             intent_queue.get()
         )  # blocking operation. waits until there is an item in the queue.
+        wake_word_event = SessionEvent(session_flags, session_id, WAKE_WORD)
+        thinking_event = SessionEvent(session_flags, session_id, THINKING)
         # let the client know that we are thinking.
         thinking_event.set()
         logger.debug(intent)
@@ -84,14 +86,18 @@ def parse_command(
             if message.role == "assistant":
                 response = cast(MessageContentText, message.content[0])
                 logger.debug(response.text.value)
-                intent_queue.put(response.text.value)
+                # The reply goes back to the device that asked
+                response_queue.put((session_id, response.text.value))
 
         if result == "True":
             threads.delete(thread_id=intent_thread.id)
         else:
             logger.debug("Result was not true. Not deleting thread.")
             response_queue.put(
-                "Error in command execution. Failed to {data['command']} the {data['domain']} {data['entity_id']}."
+                (
+                    session_id,
+                    "Error in command execution. Failed to {data['command']} the {data['domain']} {data['entity_id']}.",
+                )
             )
         wake_word_event.clear()
         thinking_event.clear()
@@ -1,28 +1,29 @@
 from multiprocessing import Queue
 from multiprocessing.synchronize import Event
 from time import sleep
+from typing import Any
 
+from sessions import QUESTION, THINKING, WAKE_WORD, SessionEvent, Tagged
 from logger import logger
 
 
 def parse_question(
     shutdown_event: Event,
-    question_event: Event,
-    thinking_event: Event,
-    wake_word_event: Event,
-    question_queue: "Queue[str]",
-    response_queue: "Queue[str]",
+    session_flags: Any,
+    question_queue: "Queue[Tagged[str]]",
+    response_queue: "Queue[Tagged[str]]",
 ) -> None:
     logger.info("Parse Question Ready")
     while shutdown_event.is_set() is False:
-        question = question_queue.get()
+        session_id, question = question_queue.get()
+        thinking_event = SessionEvent(session_flags, session_id, THINKING)
         thinking_event.set()
-        logger.debug(question)
+        logger.debug(f"Question ({session_id}): {question}")
         answer = answer_question(question)  # Blocking operation
-        response_queue.put(answer)
-        question_event.clear()
+        response_queue.put((session_id, answer))
+        SessionEvent(session_flags, session_id, QUESTION).clear()
         thinking_event.clear()
-        wake_word_event.clear()
+        SessionEvent(session_flags, session_id, WAKE_WORD).clear()
         # question_queue.task_done()
 
 
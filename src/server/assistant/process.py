@@ -2,11 +2,12 @@ import re
 from multiprocessing import Queue
 
 from multiprocessing.synchronize import Event
-from typing import List
+from typing import Any, Dict, List
 
 from assistant.buffers.question_buffer import QuestionBuffer
 from assistant.buffers.segment_buffer import SegmentBuffer
 from text_classification.text_classification import TextClassificationModel
+from sessions import QUESTION, SessionEvent, Tagged
 
 from logger import logger
 
@@ -20,21 +21,34 @@ END = "\033[0m"
 # Modify process_segments function to use the updated SentenceBuffer
 def process_segments(
     shutdown_event: Event,
-    transcribed_text_queue: "Queue[str]",
-    question_queue: "Queue[str]",
-    intent_queue: "Queue[str]",
+    transcribed_text_queue: "Queue[Tagged[str]]",
+    question_queue: "Queue[Tagged[str]]",
+    intent_queue: "Queue[Tagged[str]]",
     process_segments_ready_event: Event,
-    question_event: Event,
+    session_flags: Any,
     timeout: float = 5.0,
 ) -> None:
-    segment_buffer = SegmentBuffer()
-    question_buffer = QuestionBuffer(question_queue=question_queue, timeout=timeout)
+    # Sentences are assembled and questions collected per session
+    segment_buffers: Dict[str, SegmentBuffer] = {}
+    question_buffers: Dict[str, QuestionBuffer] = {}
     text_classification_model = TextClassificationModel()
     process_segments_ready_event.set()
     logger.debug("Process Segment Ready")
+    session_id = ""
     while shutdown_event.is_set() is False:
         try:
-            segment = transcribed_text_queue.get()  # Wait for segment to be available
+            # Wait for segment to be available
+            session_id, segment = transcribed_text_queue.get()
+            if session_id not in segment_buffers:
+                segment_buffers[session_id] = SegmentBuffer()
+                question_buffers[session_id] = QuestionBuffer(
+                    question_queue=question_queue,
+                    session_id=session_id,
+                    timeout=timeout,
+                )
+            segment_buffer = segment_buffers[session_id]
+            question_buffer = question_buffers[session_id]
+            question_event = SessionEvent(session_flags, session_id, QUESTION)
 
             # This should filter the period that keeps coming in as individual segments
             cleaned_segment = re.sub(r"\.{2,}", ".", segment)
@@ -75,7 +89,7 @@ def process_segments(
                         question_event=question_event,
                     )
                 elif classification == "intent":
-                    intent_queue.put(sentence)
+                    intent_queue.put((session_id, sentence))
                 else:
                     logger.debug(
                         f"Classification: {classification}, Sentence: {sentence}"
@@ -103,4 +117,5 @@ def process_segments(
 
         except Exception as e:
             logger.error(f"An error occurred: {e}")
-            segment_buffer.clear()
+            if session_id in segment_buffers:
+                segment_buffers[session_id].clear()
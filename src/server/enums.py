@@ -12,6 +12,30 @@ RECORD: bool = True  # Record audio from microphone
 
 CHUNK: int = int((RATE * BLOCK_DURATION) // 1000)
 
+# Opus configs
+OPUS_PROFILE: str | None = None  # forced on every client, None accepts the client's
+MAX_CONCEALED_FRAMES: int = 3  # longer sequence gaps are DTX or VAD silence (120 ms)
+DECODE_WORKERS: int = 4  # threads decoding the Opus packets of all connections
+
+# WebSocket server configs
+BRIDGE_POLL_INTERVAL: float = 0.1  # seconds between checks of the bridged queues and events
+SESSION_POLL_INTERVAL: float = 0.05  # seconds between checks of a waited session flag
+
+# STT audio ring configs
+MAX_SESSIONS: int = 16  # PCM rings, more connected devices than that are refused
+PCM_RING_SECONDS: float = 12.0  # float32 audio held per session until STT reads it
+SESSION_ID_BYTES: int = 64  # longest device ID, UTF-8
+STT_WAIT_TIMEOUT: float = 0.5  # seconds without new audio before idle sessions are checked
+MAX_BUFFER_DURATION: float = 4.0  # longest audio transcribed at once, started at half
+STT_TRANSCRIBE_SECONDS: float = 1.0  # to transcribe one window, the throttle allows for it
+
+# Ingest backpressure configs
+INGEST_POLICY: str = "drop_oldest"  # what happens when STT falls behind, see pcm_ring
+INGEST_MAX_LAG: float = 6.0  # seconds of untranscribed audio a session may build up
+INGEST_LIVE_SECONDS: float = 1.0  # audio kept when skip_to_live jumps to real time
+INGEST_THROTTLE_LAG: float = 4.0  # throttle policy: the client is asked to back off
+INGEST_STATS_INTERVAL: float = 30.0  # seconds between logs of the ring counters
+
 # Detection Config
 NO_SPEECH_COUNT = 0
 NO_SPEECH_LIMIT = 2 * (RATE // CHUNK)
@@ -0,0 +1,354 @@
+# Shared memory audio between the WebSocket server and the STT process.
+#
+# The receiver writes every decoded chunk straight into the ring of its session and
+# STT transcribes views of the same memory, audio never goes through the manager
+# process. One ring per session, at most MAX_SESSIONS of them. A ring only changes
+# hands while no connection writes to it, further devices are refused.
+#
+# When STT falls behind, a session builds up at most INGEST_MAX_LAG seconds of
+# untranscribed audio, INGEST_POLICY decides what gives:
+#   drop_oldest   the oldest audio is skipped, STT goes on with the last INGEST_MAX_LAG
+#   skip_to_live  everything but the last INGEST_LIVE_SECONDS is skipped
+#   throttle      like drop_oldest, and from INGEST_THROTTLE_LAG on the client is asked
+#                 to stream speech only, without pauses, leading context or hangover
+#
+# lag() counts the window STT is transcribing until advance(), so it reaches
+# MAX_BUFFER_DURATION / 2 on every window. The throttle lag has to leave room for that
+# window and its transcription, lower values would throttle every window.
+import time
+from multiprocessing import Semaphore
+from multiprocessing.shared_memory import SharedMemory
+from typing import Dict, Hashable, Iterator, List, Self, Tuple
+
+import numpy as np
+from numpy.typing import NDArray
+
+from enums import (
+    MAX_SESSIONS,
+    PCM_RING_SECONDS,
+    RATE,
+    SESSION_ID_BYTES,
+    MAX_BUFFER_DURATION,
+    STT_TRANSCRIBE_SECONDS,
+    INGEST_POLICY,
+    INGEST_MAX_LAG,
+    INGEST_LIVE_SECONDS,
+    INGEST_THROTTLE_LAG,
+)
+
+DROP_OLDEST = "drop_oldest"
+SKIP_TO_LIVE = "skip_to_live"
+THROTTLE = "throttle"
+INGEST_POLICIES = (DROP_OLDEST, SKIP_TO_LIVE, THROTTLE)
+
+# Counters of every ring, each one is only ever written by one side
+WRITTEN = 0  # samples, server
+READ = 1  # samples, STT
+OVERRUNS = 2  # dropped chunks, server
+GENERATION = 3  # bumped when the ring is given to another session, server
+START = 4  # written counter when the current session got the ring, server
+HELD = 5  # first sample of the audio STT is transcribing, STT
+DROPPED = 6  # samples skipped because STT was behind, STT
+RECEIVED = 7  # highest audio frame sequence number received + 1, server
+COUNTERS = 8
+
+NOT_HELD = 2**63
+
+
+class PcmRingPool:
+    """
+    Single producer / single consumer float32 rings in multiprocessing.shared_memory,
+    one per session, with monotonic sample counters.
+
+    The server process opens a ring for a session, writes whole chunks into it and
+    publishes them by bumping the written counter, then releases a semaphore to wake
+    STT. STT reads a view of the oldest unread samples and hands them back with
+    advance() once they are transcribed, after skipping what the ingest policy gives
+    up when it is more than max_lag seconds behind. The server never blocks: older
+    unread audio is overwritten, only a chunk that would overwrite the audio STT is
+    transcribing is dropped and counted as an overrun.
+    """
+
+    def __init__(
+        self: Self,
+        slots: int = MAX_SESSIONS,
+        seconds: float = PCM_RING_SECONDS,
+        sample_rate: int = RATE,
+        policy: str = INGEST_POLICY,
+        max_lag: float = INGEST_MAX_LAG,
+        live_seconds: float = INGEST_LIVE_SECONDS,
+        throttle_lag: float = INGEST_THROTTLE_LAG,
+    ) -> None:
+        if policy not in INGEST_POLICIES:
+            raise ValueError(f"Unknown ingest policy {policy}")
+        if max_lag >= seconds:
+            raise ValueError("The ring has to hold more than max_lag seconds")
+        if policy == THROTTLE:
+            if throttle_lag <= MAX_BUFFER_DURATION / 2 + STT_TRANSCRIBE_SECONDS:
+                raise ValueError(
+                    "throttle_lag has to be above MAX_BUFFER_DURATION / 2 plus "
+                    "STT_TRANSCRIBE_SECONDS, or every STT window throttles"
+                )
+            if throttle_lag >= max_lag:
+                raise ValueError("throttle_lag has to be below max_lag")
+        self.slots = slots
+        self.capacity = int(seconds * sample_rate)
+        self.sample_rate = sample_rate
+        self.policy = policy
+        self.max_lag = int(max_lag * sample_rate)
+        self.live = int(min(live_seconds, max_lag) * sample_rate)
+        # Seconds behind from which the throttle policy asks the client to back off
+        self.throttle_lag = throttle_lag
+        self._ready = Semaphore(0)
+        self._shm = SharedMemory(create=True, size=self._size())
+        self._attach(self._shm.buf)
+        self._counters[:, HELD] = NOT_HELD
+        # Server side, session ID -> ring, kept after disconnect for the reconnect
+        self._open: Dict[str, int] = {}
+        # Server side, ring -> the connection writing to it
+        self._writers: Dict[int, Hashable] = {}
+        # Server side, ring -> client stream the RECEIVED sequence numbers belong to
+        self._streams: Dict[int, str | None] = {}
+
+    def _size(self: Self) -> int:
+        # counters + last write times + session IDs + samples
+        return (
+            self.slots * (COUNTERS + 1) * 8
+            + self.slots * SESSION_ID_BYTES
+            + self.slots * self.capacity * 4
+        )
+
+    def _attach(self: Self, buf) -> None:
+        offset = 0
+        self._counters = np.ndarray(
+            (self.slots, COUNTERS), dtype=np.uint64, buffer=buf, offset=offset
+        )
+        offset += self.slots * COUNTERS * 8
+        self._last_write = np.ndarray(
+            (self.slots,), dtype=np.float64, buffer=buf, offset=offset
+        )
+        offset += self.slots * 8
+        self._session_ids = np.ndarray(
+            (self.slots, SESSION_ID_BYTES), dtype=np.uint8, buffer=buf, offset=offset
+        )
+        offset += self.slots * SESSION_ID_BYTES
+        self._samples = np.ndarray(
+            (self.slots, self.capacity), dtype=np.float32, buffer=buf, offset=offset
+        )
+
+    # The STT process attaches to the same segment by name
+    def __getstate__(self: Self) -> tuple:
+        return (
+            self._shm.name,
+            self.slots,
+            self.capacity,
+            self.sample_rate,
+            self.policy,
+            self.max_lag,
+            self.live,
+            self.throttle_lag,
+            self._ready,
+        )
+
+    def __setstate__(self: Self, state: tuple) -> None:
+        name, self.slots, self.capacity, self.sample_rate = state[:4]
+        self.policy, self.max_lag, self.live, self.throttle_lag, self._ready = state[4:]
+        self._shm = SharedMemory(name=name, create=False)
+        self._attach(self._shm.buf)
+        self._open = {}
+        self._writers = {}
+        self._streams = {}
+
+    # Server side
+
+    def open(
+        self: Self,
+        session_id: str,
+        connection: Hashable,
+        stream_id: str | None = None,
+    ) -> int | None:
+        """
+        The ring of a session, for connection to write to until release(). A
+        reconnecting device gets its ring back with the audio STT has not read yet,
+        taken over from its stale connection of the same stream if that one is still
+        open, other clients check in_use() first. A new one
+        takes a free ring or the one of the disconnected device heard from least
+        recently, rings with a live connection are never handed over.
+        :param stream_id: Client process the sequence numbers come from, last_seq()
+        starts over when it changes.
+        :return: The ring to write() to, None when every ring has a live connection.
+        """
+        slot = self._open.get(session_id)
+        if slot is None:
+            slot = self._assign(session_id)
+            if slot is None:
+                return None
+        if slot in self._streams and self._streams[slot] != stream_id:
+            # A restarted client numbers its packets from 0 again
+            self._counters[slot, RECEIVED] = 0
+        self._streams[slot] = stream_id
+        # The stale connection of a reconnecting device stops writing, see writes()
+        self._writers[slot] = connection
+        return slot
+
+    def _assign(self: Self, session_id: str) -> int | None:
+        # A ring for a new session, from those no connection writes to
+        idle = [slot for slot in range(self.slots) if slot not in self._writers]
+        if not idle:
+            return None
+        assigned = set(self._open.values())
+        free = [slot for slot in idle if slot not in assigned]
+        if free:
+            slot = free[0]
+        else:
+            slot = min(idle, key=lambda idle_slot: self._last_write[idle_slot])
+            self._open = {
+                owner: owned for owner, owned in self._open.items() if owned != slot
+            }
+        encoded = session_id.encode()[:SESSION_ID_BYTES]
+        self._session_ids[slot] = 0
+        self._session_ids[slot, : len(encoded)] = np.frombuffer(encoded, np.uint8)
+        self._last_write[slot] = time.time()
+        self._counters[slot, START] = self._counters[slot, WRITTEN]
+        self._counters[slot, RECEIVED] = 0
+        self._counters[slot, GENERATION] += 1
+        self._open[session_id] = slot
+        return slot
+
+    def in_use(self: Self, session_id: str, stream_id: str | None) -> bool:
+        # Whether another client streams as this session right now, only the stream
+        # of the live connection may take its ring over
+        slot = self._open.get(session_id)
+        return slot in self._writers and self._streams.get(slot) != stream_id
+
+    def release(self: Self, slot: int, connection: Hashable) -> None:
+        # The connection is over, the ring can go to another device
+        if self._writers.get(slot) is connection:
+            del self._writers[slot]
+
+    def writes(self: Self, slot: int, connection: Hashable) -> bool:
+        # False once a newer connection of the device took the ring over
+        return self._writers.get(slot) is connection
+
+    def write(self: Self, slot: int, audio: NDArray[np.float32]) -> bool:
+        written = int(self._counters[slot, WRITTEN])
+        if written + len(audio) - int(self._counters[slot, HELD]) > self.capacity:
+            self._counters[slot, OVERRUNS] += 1
+            return False
+        start = written % self.capacity
+        head = min(len(audio), self.capacity - start)
+        self._samples[slot, start : start + head] = audio[:head]
+        self._samples[slot, : len(audio) - head] = audio[head:]
+        self._last_write[slot] = time.time()
+        # Publish the samples only once they are complete
+        self._counters[slot, WRITTEN] = written + len(audio)
+        self._ready.release()
+        return True
+
+    def last_seq(self: Self, slot: int) -> int:
+        """
+        Highest sequence number received for the session of the ring, over all the
+        connections of its stream, -1 before the first frame. Replays never overlap
+        with it.
+        """
+        return int(self._counters[slot, RECEIVED]) - 1
+
+    def set_last_seq(self: Self, slot: int, seq: int) -> None:
+        self._counters[slot, RECEIVED] = seq + 1
+
+    # STT side
+
+    def wait(self: Self, timeout: float) -> bool:
+        """
+        Wait for a write to any ring.
+        :return: False if nothing was written for timeout seconds.
+        """
+        if not self._ready.acquire(timeout=timeout):
+            return False
+        # One wakeup covers every write so far
+        while self._ready.acquire(block=False):
+            pass
+        return True
+
+    def sessions(self: Self) -> Iterator[Tuple[int, str]]:
+        """
+        :return: (ring, session ID) of every ring in use.
+        """
+        for slot in range(self.slots):
+            if self._counters[slot, GENERATION]:
+                yield slot, self.session_id(slot)
+
+    def session_id(self: Self, slot: int) -> str:
+        return self._session_ids[slot].tobytes().rstrip(b"\0").decode(errors="replace")
+
+    def generation(self: Self, slot: int) -> int:
+        return int(self._counters[slot, GENERATION])
+
+    def skip_previous_session(self: Self, slot: int) -> None:
+        # Audio of the session that had the ring before is never read
+        self._counters[slot, READ] = max(
+            self._counters[slot, READ], self._counters[slot, START]
+        )
+
+    def unread(self: Self, slot: int) -> int:
+        return int(self._counters[slot, WRITTEN]) - int(self._counters[slot, READ])
+
+    def lag(self: Self, slot: int) -> float:
+        # Seconds of audio STT has yet to transcribe
+        return self.unread(slot) / self.sample_rate
+
+    def last_write_time(self: Self, slot: int) -> float:
+        return float(self._last_write[slot])
+
+    def read(self: Self, slot: int, max_samples: int) -> Tuple[NDArray[np.float32], int]:
+        """
+        The oldest unread samples of a ring, once the ingest policy skipped what STT
+        is too far behind on.
+        :param max_samples: Longest audio to return.
+        :return: The audio, a view of the shared memory unless it wraps around the
+        end of the ring, valid until advance(), and the counter to advance() to.
+        """
+        written = int(self._counters[slot, WRITTEN])
+        start = int(self._counters[slot, READ])
+        if written - start > self.max_lag:
+            keep = self.live if self.policy == SKIP_TO_LIVE else self.max_lag
+            self._counters[slot, DROPPED] += written - keep - start
+            start = written - keep
+        # Published before the view is taken, the server does not overwrite it
+        self._counters[slot, HELD] = start
+        end = min(written, start + max_samples)
+        first, last = start % self.capacity, end % self.capacity
+        if end - start == 0:
+            return self._samples[slot, :0], end
+        if first < last or last == 0:
+            return self._samples[slot, first : last or self.capacity], end
+        return np.concatenate(
+            (self._samples[slot, first:], self._samples[slot, :last])
+        ), end
+
+    def advance(self: Self, slot: int, end: int) -> None:
+        self._counters[slot, READ] = end
+        self._counters[slot, HELD] = NOT_HELD
+
+    def stats(self: Self) -> List[dict]:
+        return [
+            {
+                "session": session_id,
+                "written": int(self._counters[slot, WRITTEN]),
+                "read": int(self._counters[slot, READ]),
+                "lag_seconds": round(self.lag(slot), 2),
+                "dropped_seconds": round(
+                    int(self._counters[slot, DROPPED]) / self.sample_rate, 2
+                ),
+                "overruns": int(self._counters[slot, OVERRUNS]),
+            }
+            for slot, session_id in self.sessions()
+        ]
+
+    def close(self: Self) -> None:
+        # The numpy views have to go before the mapping can be closed
+        del self._counters, self._last_write, self._session_ids, self._samples
+        self._shm.close()
+
+    def unlink(self: Self) -> None:
+        self._shm.unlink()
@@ -0,0 +1,47 @@
+# Per device sessions shared by the server processes.
+#
+# Every client is a session, keyed by the device ID of its config message. Items on
+# the queues between the processes are (session ID, payload) tuples, and the wake
+# word, question and thinking flags are kept per session in a Manager dict so two
+# rooms never share a conversation.
+import time
+from typing import Any, Self, Tuple, TypeVar
+
+from enums import SESSION_POLL_INTERVAL
+
+T = TypeVar("T")
+Tagged = Tuple[str, T]  # (session ID, payload)
+
+# Session flags
+WAKE_WORD = "wake_word"
+QUESTION = "question"
+THINKING = "thinking"
+
+
+class SessionEvent:
+    """
+    Event-like view of one flag of one session in the shared session flags, a
+    Manager dict keyed by (session ID, flag name). It can be passed wherever a
+    multiprocessing Event was, wait() polls.
+    """
+
+    def __init__(self: Self, flags: Any, session_id: str, name: str) -> None:
+        self.flags = flags
+        self.key = (session_id, name)
+
+    def set(self: Self) -> None:
+        self.flags[self.key] = True
+
+    def clear(self: Self) -> None:
+        self.flags[self.key] = False
+
+    def is_set(self: Self) -> bool:
+        return self.flags.get(self.key, False)
+
+    def wait(self: Self, timeout: float | None = None) -> bool:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.is_set():
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(SESSION_POLL_INTERVAL)
+        return True
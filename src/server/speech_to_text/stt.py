@@ -1,69 +1,78 @@
 import time
-import numpy as np
-from numpy.typing import NDArray
+from typing import Any, Dict
 from multiprocessing.synchronize import Event
 from multiprocessing import Queue
 from faster_whisper.transcribe import Segment
 
-from speech_to_text.buffers.circular_buffer import CircularBuffer
 from speech_to_text.transcribe import WhisperModelManager
+from pcm_ring import PcmRingPool
+from sessions import WAKE_WORD, SessionEvent, Tagged
+from enums import (
+    RATE,
+    STT_WAIT_TIMEOUT,
+    MAX_BUFFER_DURATION,
+    INGEST_MAX_LAG,
+    INGEST_STATS_INTERVAL,
+)
 from logger import logger
 
-# Initialize the circular buffer
-MAX_BUFFER_DURATION = 4  # seconds # 100 samples  at 40ms per sample
-
 
 def stt(
     shutdown_event: Event,
-    decoded_audio_queue: "Queue[NDArray[np.float32]]",
-    transcribed_text_queue: "Queue[str]",
-    concept_queue: "Queue[Segment]",
+    audio_pool: PcmRingPool,
+    transcribed_text_queue: "Queue[Tagged[str]]",
+    concept_queue: "Queue[Tagged[Segment]]",
     stt_ready_event: Event,
-    wake_word_event: Event,
+    session_flags: Any,
 ) -> None:
     model_manager = WhisperModelManager()
     logger.info("STT Ready")
     try:
-        circular_buffer = CircularBuffer(
-            capacity=MAX_BUFFER_DURATION, sample_rate=16000
-        )
-        duration = 0.0
+        # Ring generation last seen, a new one is a new session on that ring
+        generations: Dict[int, int] = {}
+        next_stats = time.time() + INGEST_STATS_INTERVAL
         # this function is only going to start when model is loaded.
         # that happens when all imports are being evaluated.
         stt_ready_event.set()  # Signal that STT is ready
         logger.debug("Waiting for data to be added to buffer")
         while shutdown_event.is_set() is False:
-            try:
-                new_data = decoded_audio_queue.get()
-                circular_buffer.write(new_data)
-                # logger.debug("Data added to buffer")
-            except Exception as e:
-                logger.debug(f"Error in getting data from Queue: {e}")
-                pass
-
-            # If buffer is full , transcribe it
-            buffer_duration = circular_buffer.get_buffer_duration()
-            time_since_last_write = time.time() - circular_buffer.last_write_time
-            if duration == buffer_duration:
-                continue
-            else:
-                duration = buffer_duration
-                # logger.debug("Buffer duration: " + str(buffer_duration))
+            # Woken by the receiver, or after STT_WAIT_TIMEOUT to check idle sessions
+            audio_pool.wait(STT_WAIT_TIMEOUT)
+            if time.time() >= next_stats:
+                logger.info(f"STT ingest: {audio_pool.stats()}")
+                next_stats = time.time() + INGEST_STATS_INTERVAL
+            # Audio from different rooms is never mixed, every session has its ring
+            for slot, session_id in audio_pool.sessions():
+                if generations.get(slot) != audio_pool.generation(slot):
+                    logger.info(f"New STT session: {session_id}")
+                    generations[slot] = audio_pool.generation(slot)
+                    audio_pool.skip_previous_session(slot)
+                buffer_duration = audio_pool.lag(slot)
+                time_since_last_write = time.time() - audio_pool.last_write_time(slot)
 
-            # Begin transcription if buffer is half full or if it has been 2 seconds since last transcription
-            if buffer_duration >= (MAX_BUFFER_DURATION / 2) or (
-                time_since_last_write > 2 and buffer_duration > 0.5
-            ):
-                # logger.debug("Transcription condition met. Starting transcription")
-                audio_chunk = circular_buffer.read(buffer_duration)
-                if audio_chunk:
-                    model_manager.transcribe_chunk(
-                        audio_chunk,
-                        transcribed_text_queue,
-                        concept_queue,
-                        wake_word_event,
+                # Begin transcription if buffer is half full or if it has been 2 seconds since last transcription
+                if buffer_duration >= (MAX_BUFFER_DURATION / 2) or (
+                    time_since_last_write > 2 and buffer_duration > 0.5
+                ):
+                    # logger.debug("Transcription condition met. Starting transcription")
+                    if buffer_duration > INGEST_MAX_LAG:
+                        logger.warning(
+                            f"STT {buffer_duration:.1f} s behind on {session_id}, "
+                            f"{audio_pool.policy} skips the oldest audio"
+                        )
+                    # A view of the shared ring, valid until advance()
+                    audio_chunk, end = audio_pool.read(
+                        slot, int(MAX_BUFFER_DURATION * RATE)
                     )
-            # time.sleep(0.1)  # Sleep for 100ms
+                    if len(audio_chunk):
+                        model_manager.transcribe_chunk(
+                            audio_chunk,
+                            session_id,
+                            transcribed_text_queue,
+                            concept_queue,
+                            SessionEvent(session_flags, session_id, WAKE_WORD),
+                        )
+                    audio_pool.advance(slot, end)
         logger.debug("Transcription thread exiting")
     except Exception as e:
         logger.error(f"Error in transcribe: {e}")
@@ -1,12 +1,14 @@
+from collections import defaultdict
 from multiprocessing import Queue
 from multiprocessing.synchronize import Event
-from typing import Self
+from typing import DefaultDict, Self
 import numpy as np
 from numpy.typing import NDArray
 
 from faster_whisper import WhisperModel
 from faster_whisper.transcribe import Segment
 from speech_to_text.buffers.wake_word import WakeWordBuffer
+from sessions import SessionEvent, Tagged
 from logger import logger
 
 
@@ -24,7 +26,10 @@ class WhisperModelManager:
 
         self.word_timestamps = False
         self.initial_prompt = None
-        self.wake_word_buffer = WakeWordBuffer()
+        # Recent segments of every session, searched for the wake word
+        self.wake_word_buffers: DefaultDict[str, WakeWordBuffer] = defaultdict(
+            WakeWordBuffer
+        )
 
     def load_model(self: Self) -> None:
         self.model = WhisperModel(
@@ -37,9 +42,10 @@ class WhisperModelManager:
     def transcribe_chunk(
         self: Self,
         audio_chunk: NDArray[np.float32],
-        transcript_queue: "Queue[str]",
-        concept_queue: "Queue[Segment]",
-        wake_word_event: Event,
+        session_id: str,
+        transcript_queue: "Queue[Tagged[str]]",
+        concept_queue: "Queue[Tagged[Segment]]",
+        wake_word_event: Event | SessionEvent,
     ) -> None:
         try:
             # logger.debug(
@@ -55,20 +61,21 @@ class WhisperModelManager:
                 initial_prompt=self.initial_prompt,
             )
 
+            wake_word_buffer = self.wake_word_buffers[session_id]
             for segment in segments:
-                logger.debug(f"Transcribed segment: {segment.text}")
-                self.wake_word_buffer.update_buffer(segment)
-                concept_queue.put(segment)
+                logger.debug(f"Transcribed segment ({session_id}): {segment.text}")
+                wake_word_buffer.update_buffer(segment)
+                concept_queue.put((session_id, segment))
                 if wake_word_event.is_set() is False:
-                    self.wake_word_buffer.detect_wake_word(
-                        self.wake_word_buffer.get_buffer_text(), wake_word_event
+                    wake_word_buffer.detect_wake_word(
+                        wake_word_buffer.get_buffer_text(), wake_word_event
                     )
                 # Store all transcribed segments in a queue for nightly processing
                 if (
                     wake_word_event.is_set()
                     and self.detect_artifacts(segment.text) is False
                 ):
-                    transcript_queue.put(segment.text)
+                    transcript_queue.put((session_id, segment.text))
             # logger.debug(f"Transcribed data: {segments}")
 
         except Exception as e:
@@ -0,0 +1,129 @@
+import asyncio
+import queue
+import threading
+import time
+from multiprocessing.synchronize import Event
+from typing import Any, Callable, Generic, Self, TypeVar
+
+from logger import logger
+
+from enums import BRIDGE_POLL_INTERVAL
+from sessions import SessionEvent
+
+T = TypeVar("T")
+
+
+class QueueBridge(Generic[T]):
+    """
+    Forwards the items of a cross-process queue (multiprocessing or Manager) into the
+    event loop.
+
+    A daemon thread blocks on the source queue and hands every item to the loop with
+    call_soon_threadsafe, connection tasks await get() on an asyncio.Queue. Nothing
+    blocks the loop, and cancelling a task waiting in get() never loses an item.
+    With dispatch, every item is passed to it on the loop instead, to route them.
+    """
+
+    def __init__(
+        self: Self,
+        source: Any,
+        loop: asyncio.AbstractEventLoop,
+        name: str,
+        poll_interval: float = BRIDGE_POLL_INTERVAL,
+        dispatch: Callable[[T], None] | None = None,
+    ) -> None:
+        self.source = source
+        self.loop = loop
+        self.poll_interval = poll_interval
+        self.items: asyncio.Queue[T] = asyncio.Queue()
+        self.dispatch = dispatch or self.items.put_nowait
+        self._thread = threading.Thread(
+            target=self._run, name=f"{name}-bridge", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self: Self) -> None:
+        while True:
+            try:
+                item = self.source.get(timeout=self.poll_interval)
+            except queue.Empty:
+                continue
+            except (EOFError, OSError) as e:
+                # The manager process is gone, the server is shutting down
+                logger.debug(f"{self._thread.name} stopped: {e}")
+                return
+            try:
+                self.loop.call_soon_threadsafe(self.dispatch, item)
+            except RuntimeError:
+                # Event loop closed
+                return
+
+    async def get(self: Self) -> T:
+        return await self.items.get()
+
+
+class EventBridge:
+    """
+    Mirrors a cross-process Event (or a SessionEvent) into the event loop.
+
+    A daemon thread polls the event every poll_interval (a multiprocessing Event can
+    only be waited on to become set, not cleared) and wakes every task waiting in
+    wait_for() on a change, until close().
+    """
+
+    def __init__(
+        self: Self,
+        source: Event | SessionEvent,
+        loop: asyncio.AbstractEventLoop,
+        name: str,
+        poll_interval: float = BRIDGE_POLL_INTERVAL,
+    ) -> None:
+        self.source = source
+        self.loop = loop
+        self.poll_interval = poll_interval
+        self.state = source.is_set()
+        self._changed = asyncio.Event()
+        self._closed = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name=f"{name}-bridge", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self: Self) -> None:
+        state = self.state
+        while not self._closed.is_set():
+            try:
+                if state:
+                    time.sleep(self.poll_interval)
+                    changed = not self.source.is_set()
+                else:
+                    changed = self.source.wait(self.poll_interval)
+            except (EOFError, OSError) as e:
+                # The manager process is gone, the server is shutting down
+                logger.debug(f"{self._thread.name} stopped: {e}")
+                return
+            if not changed:
+                continue
+            state = not state
+            try:
+                self.loop.call_soon_threadsafe(self._set_state, state)
+            except RuntimeError:
+                # Event loop closed
+                return
+
+    def _set_state(self: Self, state: bool) -> None:
+        self.state = state
+        # Wake the current waiters, later ones wait on a fresh event
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def wait_for(self: Self, state: bool) -> None:
+        """
+        Wait until the event is set (state True) or cleared (state False).
+        """
+        while self.state != state:
+            await self._changed.wait()
+
+    def close(self: Self) -> None:
+        # The thread exits within a poll interval
+        self._closed.set()
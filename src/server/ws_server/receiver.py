@@ -1,103 +1,356 @@
 import asyncio
-from multiprocessing import Queue
-from multiprocessing.synchronize import Event
-from typing import Self, cast
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List, Self
 from websockets.legacy.server import WebSocketServerProtocol
 import websockets
 import base64
+import ctypes
 import json
-from pyogg import OpusEncoder, OpusDecoder  # type: ignore
+import struct
+from pyogg import opus  # type: ignore
 import numpy as np
 
 from numpy.typing import NDArray
 
 from logger import logger
 
-from enums import CHUNK, RATE
+from enums import (
+    CHUNK,
+    RATE,
+    OPUS_PROFILE,
+    MAX_CONCEALED_FRAMES,
+)
+from pcm_ring import THROTTLE, PcmRingPool
+from sessions import QUESTION, WAKE_WORD, SessionEvent
+from ws_server.protocol import (
+    FLAG_REPLAY,
+    FRAMING_BINARY,
+    FRAMING_JSON,
+    OPUS_PROFILES,
+    OpusProfile,
+    unpack_audio_frame,
+)
 
 
 class OpusDecoderManager:
-    def __init__(self: Self, sample_rate: int, channels: int = 1) -> None:
-        self.decoder = OpusDecoder()
-        self.decoder.set_sampling_frequency(sample_rate)  # type: ignore
-        self.decoder.set_channels(channels)  # type: ignore
+    """
+    Mono Opus decoder with packet loss concealment, one per connection.
+    pyogg's OpusDecoder only decodes complete packets, FEC and PLC go through
+    opus_decode directly. Packets are decoded into a preallocated int16 buffer and
+    converted straight into a reusable float32 buffer, nothing is allocated per packet.
+    """
+
+    def __init__(
+        self: Self,
+        sample_rate: int,
+        channels: int = 1,
+        profile: OpusProfile | None = None,
+    ) -> None:
+        error = ctypes.c_int()
+        self.decoder = opus.opus_decoder_create(
+            sample_rate, channels, ctypes.byref(error)
+        )
+        if error.value != 0:
+            raise RuntimeError(f"Could not create the Opus decoder: {error.value}")
+        self.channels = channels
+        # Only worth asking for FEC data when the encoder adds it
+        self.fec = profile is not None and profile.fec
+        self._pcm = (ctypes.c_int16 * (CHUNK * channels))()
+        self._pcm_samples = np.frombuffer(self._pcm, dtype=np.int16)
+        # float32 output of decode_batch(), grown to the largest batch seen
+        self._output = np.empty(CHUNK * channels, dtype=np.float32)
+        # counters for stats()
+        self.concealed = 0
+        self.recovered = 0
+
+    def __del__(self: Self) -> None:
+        if getattr(self, "decoder", None):
+            opus.opus_decoder_destroy(self.decoder)
 
     def decode_audio(
-        self,
-        encoded_data: str,
-    ) -> NDArray[np.int16] | None:
+        self: Self,
+        opus_data: bytes | None,
+        out: NDArray[np.float32],
+        fec: bool = False,
+    ) -> int:
         """
-        Decode the base64 and Opus encoded audio data.
-        :param encoded_data: Base64 encoded string of Opus audio data.
-        :return: Decoded raw audio bytes.
+        Decode one Opus packet.
+        :param opus_data: Opus encoded bytes, None to conceal a lost packet.
+        :param out: Where the audio goes, as float32 in [-1, 1).
+        :param fec: Decode the forward error correction data of opus_data instead, it
+        holds the packet before it.
+        :return: Number of samples written to out, 0 on error.
         """
-        # base64_data = encoded_data.encode("utf-8")
-        # Decode the base64 data to get Opus encoded bytes
-        opus_data = base64.b64decode(encoded_data.encode("utf-8"))
         try:
-            # Then, decode the Opus bytes to get raw audio data
-            # logger.debug(f"Decoding audio of length: {len(opus_data)}")
-
-            decoded_data = opus_decoder.decode(bytearray(opus_data))  # type: ignore
-            if decoded_data is not None:
-                audio = np.frombuffer(cast(bytes, decoded_data), dtype=np.int16)
-                assert len(audio) == CHUNK
-                return audio
-                # logger.debug(f"Decoded audio of length: {len(decoded_data)}")
+            if opus_data is None:
+                data, length = None, 0
             else:
-                logger.error("Error in audio decoding. decoded_data is None")
-            return None
+                data = ctypes.cast(opus_data, ctypes.POINTER(ctypes.c_ubyte))
+                length = len(opus_data)
+            samples = opus.opus_decode(
+                self.decoder, data, length, self._pcm, CHUNK, int(fec)
+            )
+            if samples < 0:
+                logger.error(f"Error in audio decoding: opus_decode returned {samples}")
+                return 0
+            assert samples == CHUNK
+            samples *= self.channels
+            np.multiply(
+                self._pcm_samples[:samples], np.float32(1 / 32768.0), out=out[:samples]
+            )
+            return samples
         except Exception as e:
             logger.error(f"Error in audio decoding: {e}")
+            return 0
+
+    def decode_batch(
+        self: Self, frames: List[bytes], missing: int = 0
+    ) -> NDArray[np.float32] | None:
+        """
+        Decode the Opus packets of one aggregated message.
+        The packets lost right before the first one are concealed first, the last of
+        them is recovered from the FEC data of the first packet when the profile has
+        FEC, the others are extrapolated by the decoder (PLC).
+        :param frames: Consecutive Opus packets.
+        :param missing: Packets lost right before the first one.
+        :return: The decoded audio of every packet, concatenated, as a view of the
+        output buffer valid until the next call. Packets that fail to decode are left
+        out.
+        """
+        if not frames:
             return None
+        needed = (missing + len(frames)) * CHUNK * self.channels
+        if len(self._output) < needed:
+            self._output = np.empty(needed, dtype=np.float32)
+        length = 0
+        for index in range(missing):
+            recover = self.fec and index == missing - 1
+            samples = self.decode_audio(
+                frames[0] if recover else None, self._output[length:], fec=recover
+            )
+            if samples:
+                length += samples
+                self.recovered += recover
+                self.concealed += not recover
+        for frame in frames:
+            length += self.decode_audio(frame, self._output[length:])
+        return self._output[:length] if length else None
+
+    def stats(self: Self) -> dict:
+        return {"concealed": self.concealed, "recovered": self.recovered}
 
 
 async def async_receiver(
     connection: WebSocketServerProtocol,
-    decoded_audio_queue: "Queue[NDArray[np.float32]]",
-    question_event: Event,
-    wake_word_event: Event,
+    audio_pool: PcmRingPool,
+    session_flags: Any,
+    session: "asyncio.Future[str]",
+    decode_pool: ThreadPoolExecutor,
 ) -> None:
+    loop = asyncio.get_running_loop()
     decoder = OpusDecoderManager(RATE, 1)
     logger.info("Client connected.")
+    # Clients without a device ID in their config are a session per host
+    session_id: str = connection.remote_address[0]
+    # The STT ring of the session
+    slot = -1
+    # Whether the client was asked to back off, throttle ingest policy
+    throttled = False
+
+    def start_session(
+        device_id: str | None = None, stream_id: str | None = None
+    ) -> None:
+        nonlocal session_id, slot, last_seq
+        if session.done():
+            return
+        session_id = device_id or session_id
+        if audio_pool.in_use(session_id, stream_id):
+            # Two devices with the same ID would take the session from each other
+            raise ConnectionRefusedError(
+                f"Session {session_id} is live on another client, refused"
+            )
+        opened = audio_pool.open(session_id, connection, stream_id)
+        if opened is None:
+            raise ConnectionRefusedError(
+                f"Every STT ring has a live connection, {session_id} refused"
+            )
+        slot = opened
+        # A reconnecting device goes on from what its last connection received
+        last_seq = audio_pool.last_seq(slot)
+        logger.info(f"Session {session_id} started after seq {last_seq}")
+        session.set_result(session_id)
+
+    async def enqueue(frames: List[bytes], missing: int = 0) -> None:
+        # One ring write per message, however many frames it aggregates. Awaited, so
+        # the packets of a connection are decoded in order, one batch at a time, while
+        # the loop serves the other connections. opus_decode releases the GIL
+        decoded_audio = await loop.run_in_executor(
+            decode_pool, decoder.decode_batch, frames, missing
+        )
+        if decoded_audio is None:
+            logger.error("Error in audio decoding. decoded_audio is None")
+            return
+        # Written from the loop, so the ring has one producer even while a
+        # reconnecting device's stale connection is still open
+        if not audio_pool.writes(slot, connection):
+            logger.info(f"Session {session_id} taken over by a new connection")
+            await connection.close()
+            return
+        if not audio_pool.write(slot, decoded_audio):
+            logger.warning(f"STT ring of {session_id} full, audio dropped")
+        if audio_pool.policy == THROTTLE:
+            await update_throttle()
+
+    async def update_throttle() -> None:
+        # Asked to back off above the throttle lag, released below half of it
+        nonlocal throttled
+        lag = audio_pool.lag(slot)
+        if throttled:
+            changed = lag < audio_pool.throttle_lag / 2
+        else:
+            changed = lag > audio_pool.throttle_lag
+        if not changed:
+            return
+        throttled = not throttled
+        logger.info(f"Throttle {session_id}: {throttled}, STT {lag:.1f} s behind")
+        await connection.send(
+            json.dumps({"type": "throttle", "active": throttled, "lag": round(lag, 2)})
+        )
+
+    # Highest sequence number received for the session, kept with its ring
+    last_seq = -1
+    # Frames the client replays after a reconnect, decoded and queued as one block so
+    # the backlog reaches STT at once instead of at the pace of live audio
+    replay_frames: List[bytes] = []
+    replay_pending = 0
+
+    async def flush_replay() -> None:
+        nonlocal replay_frames, replay_pending
+        if replay_frames:
+            logger.debug(f"Fast-forwarding {len(replay_frames)} replayed frames")
+            await enqueue(replay_frames)
+        replay_frames = []
+        replay_pending = 0
+
+    async def receive_frames(
+        frames: List[bytes], replay: bool, missing: int = 0, duplicates: int = 0
+    ) -> None:
+        nonlocal replay_pending
+        if replay and replay_pending > 0:
+            replay_frames.extend(frames)
+            # Replayed frames the session already had count towards the replay too
+            replay_pending -= len(frames) + duplicates
+            if replay_pending <= 0:
+                await flush_replay()
+            return
+        if not frames:
+            return
+        # A live frame ends the replay, even if some of it never arrived
+        await flush_replay()
+        await enqueue(frames, missing)
+
     try:
         while True:
             message = await connection.recv()
             # logger.debug(f"Received: {message}")
+            if isinstance(message, bytes):
+                start_session()
+                # Binary audio frame, negotiated through the config message
+                try:
+                    frame = unpack_audio_frame(message)
+                except (ValueError, struct.error) as e:
+                    logger.error(f"Malformed binary frame: {e}")
+                    continue
+                frames = frame.frames
+                if not frame.flags & FLAG_REPLAY and frame.seq <= last_seq:
+                    # Only replays go back, the client restarted and numbers from 0
+                    # again. Clients without a stream ID end up here
+                    logger.info(f"Session {session_id} restarted at seq {frame.seq}")
+                    last_seq = -1
+                    audio_pool.set_last_seq(slot, last_seq)
+                missing = frame.seq - last_seq - 1 if last_seq >= 0 else 0
+                if frame.seq <= last_seq:
+                    # Already received, before the connection dropped or replayed
+                    # although it made it
+                    frames = frames[last_seq - frame.seq + 1 :]
+                if frames:
+                    last_seq = frame.seq + len(frame.frames) - 1
+                    audio_pool.set_last_seq(slot, last_seq)
+                await receive_frames(
+                    frames,
+                    bool(frame.flags & FLAG_REPLAY),
+                    # Longer gaps are silence the client did not send
+                    missing if 0 < missing <= MAX_CONCEALED_FRAMES else 0,
+                    duplicates=len(frame.frames) - len(frames),
+                )
+                continue
             data = json.loads(message)
+            if data["type"] != "config":
+                start_session()
             if data["type"] == "audio":
-                # Decode the base64 message
-                decoded_audio_int16 = decoder.decode_audio(data["data"])
-                if decoded_audio_int16 is None:
-                    logger.error("Error in audio decoding. decoded_audio is None")
-                    continue
-                decoded_audio: NDArray[np.float32] = (
-                    decoded_audio_int16.astype(np.float32) / 32768.0
+                # Legacy framing: Opus packet as base64 text
+                await receive_frames(
+                    [base64.b64decode(data["data"].encode("utf-8"))],
+                    bool(data.get("replay")),
+                )
+            elif data["type"] == "gap":
+                # The client reconnected, replayed audio follows
+                logger.warning(
+                    f"Client reconnected after seq {data['last_seq']}: replaying "
+                    f"{data['replayed']} frames, {data['lost']} lost"
                 )
-                decoded_audio_queue.put(decoded_audio)
-                # decoded_audio.astype(np.float32, order="C") / 32768.0
-                # Write the decoded bytes to the WAV file
+                await flush_replay()
+                # Replays start before what the client handed to its socket, the
+                # frames this session already has are dropped by sequence number
+                replay_pending = data["replayed"]
             elif data["type"] == "config":
                 logger.debug(f"Received config: {data}")
+                start_session(data.get("device_id"), data.get("stream_id"))
                 sample_rate = data["sample_rate"]
                 channels = data["channels"]
+                # The site can force a profile, otherwise the client's proposal holds
+                profile = OPUS_PROFILE or data.get("opus_profile")
+                if profile is not None and profile not in OPUS_PROFILES:
+                    logger.error(f"Unknown Opus profile {profile}")
+                    profile = None
                 # reinitialize the decoder with the new sample rate and channels
-                decoder = OpusDecoderManager(sample_rate=sample_rate, channels=channels)
+                decoder = OpusDecoderManager(
+                    sample_rate=sample_rate,
+                    channels=channels,
+                    profile=OPUS_PROFILES[profile] if profile else None,
+                )
+                # Binary frames are only used when the client asks for them
+                framing = (
+                    FRAMING_BINARY
+                    if data.get("framing") == FRAMING_BINARY
+                    else FRAMING_JSON
+                )
+                reply = {"type": "config", "framing": framing}
+                if profile:
+                    reply["opus_profile"] = profile
+                await connection.send(json.dumps(reply))
             elif data["type"] == "interrupt":
                 logger.debug(f"Received interrupt: {data}")
                 # Bypass the wake word and start actively parsing the question
                 # Allows for the user to interrupt the assistant.
-                question_event.set()
+                SessionEvent(session_flags, session_id, QUESTION).set()
             elif data["type"] == "wake_word":
                 logger.debug(f"Received wake_word: {data}")
                 # Allow client to set wake word
                 # Allows for a traditional approach to wake word detection for streaming.
-                wake_word_event.set()
+                SessionEvent(session_flags, session_id, WAKE_WORD).set()
             else:
                 logger.debug(f"Received unknown message: {data}")
     except websockets.exceptions.ConnectionClosed as e:
         logger.debug(f"Client disconnected with exception: {e}")
+    except ConnectionRefusedError as e:
+        logger.warning(e)
+        # 1013: try again later
+        await connection.close(1013, "Session refused")
     except asyncio.CancelledError as e:
         logger.debug("Receive Socket operation cancelled")
     except Exception as e:
         logger.error(f"Error in receive socket: {e}")
+    finally:
+        if slot >= 0:
+            audio_pool.release(slot, connection)
@@ -1,50 +1,46 @@
 import asyncio
-from multiprocessing import Queue
-from multiprocessing.synchronize import Event
-from websockets.legacy.server import WebSocketServerProtocol
+import json
 import websockets
-
-# from pyogg import OpusEncoder, OpusDecoder  # type: ignore
-import numpy as np
-
-from numpy.typing import NDArray
-
-# from typing import cast
+from websockets.legacy.server import WebSocketServerProtocol
 
 from logger import logger
 
+from ws_server.bridge import EventBridge
+
 
 async def async_sender(
     connection: WebSocketServerProtocol,
-    response_queue: "Queue[NDArray[np.float32]]",
+    responses: "asyncio.Queue[str]",
 ) -> None:
-    logger.info("Client connected.")
     try:
         while True:
-            response = response_queue.get()
+            response = await responses.get()
             logger.debug(f"Sending response: {response}")
-            await connection.send({"thinking": False})
+            await connection.send(json.dumps({"thinking": False}))
             await connection.send(response)
     except websockets.exceptions.ConnectionClosed as e:
         logger.debug(f"Client disconnected with exception: {e}")
     except asyncio.CancelledError as e:
-        logger.debug("Receive Socket operation cancelled")
+        logger.debug("Send Socket operation cancelled")
+        raise
     except Exception as e:
-        logger.error(f"Error in receive socket: {e}")
+        logger.error(f"Error in send socket: {e}")
 
 
 async def async_thinking(
-    connection: WebSocketServerProtocol, thinking_event: Event
+    connection: WebSocketServerProtocol, thinking: EventBridge
 ) -> None:
-    logger.info("Client connected.")
     try:
         while True:
-            thinking_event.wait()
+            # Once per question or command, not for as long as the event stays set
+            await thinking.wait_for(True)
             logger.debug(f"Activating thinking mode")
-            await connection.send({"thinking": True})
+            await connection.send(json.dumps({"thinking": True}))
+            await thinking.wait_for(False)
     except websockets.exceptions.ConnectionClosed as e:
         logger.debug(f"Client disconnected with exception: {e}")
     except asyncio.CancelledError as e:
-        logger.debug("Receive Socket operation cancelled")
+        logger.debug("Thinking Socket operation cancelled")
+        raise
     except Exception as e:
-        logger.error(f"Error in receive socket: {e}")
+        logger.error(f"Error in thinking socket: {e}")
@@ -1,32 +1,100 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from multiprocessing.synchronize import Event
 
-from typing import Any
+from typing import Any, Dict
 
 import websockets as ws
 from websockets.legacy.server import Serve, WebSocketServerProtocol
 
+from ws_server.bridge import EventBridge, QueueBridge
 from ws_server.receiver import async_receiver
 from ws_server.sender import async_sender, async_thinking
+from pcm_ring import PcmRingPool
+from sessions import THINKING, SessionEvent, Tagged
 
 from logger import logger
+from enums import DECODE_WORKERS
 import time
 
 
 def start_async_server(
-    manager_queue: Any,
+    audio_pool: PcmRingPool,
     response_queue: Any,
     stt_ready_event: Event,
     process_segments_ready_event: Event,
-    thinking_event: Event,
-    question_event: Event,
-    wake_word_event: Event,
+    session_flags: Any,
     host: str = "0.0.0.0",
     port: int = 8765,
 ) -> Serve:
+    # The cross-process queue and flags are read by bridge threads, never by the loop
+    loop = asyncio.get_event_loop()
+    # Replies of every session, by session ID, for the connection of that device
+    session_responses: Dict[str, asyncio.Queue[str]] = {}
+
+    def route_response(item: Tagged[str]) -> None:
+        session_id, response = item
+        responses = session_responses.get(session_id)
+        if responses is None:
+            logger.warning(f"No connection for session {session_id}, dropped: {response}")
+            return
+        responses.put_nowait(response)
+
+    QueueBridge(response_queue, loop, "responses", dispatch=route_response)
+    # Opus decoding of every connection, off the event loop
+    decode_pool = ThreadPoolExecutor(DECODE_WORKERS, thread_name_prefix="decode")
+
+    async def serve_session(
+        websocket: WebSocketServerProtocol, session: "asyncio.Future[str]"
+    ) -> None:
+        # Replies and thinking notices need the session, named by the config message
+        session_id = await session
+        responses: asyncio.Queue[str] = asyncio.Queue()
+        # A reconnecting device takes its session over from the stale connection
+        session_responses[session_id] = responses
+        thinking = EventBridge(
+            SessionEvent(session_flags, session_id, THINKING),
+            loop,
+            f"thinking-{session_id}",
+        )
+        tasks = [
+            asyncio.create_task(async_sender(websocket, responses), name="sender"),
+            asyncio.create_task(async_thinking(websocket, thinking), name="thinking"),
+        ]
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            thinking.close()
+            if session_responses.get(session_id) is responses:
+                del session_responses[session_id]
+
     async def handler(websocket: WebSocketServerProtocol, _path: str) -> None:
-        await async_receiver(websocket, manager_queue, question_event, wake_word_event)
-        await async_sender(websocket, response_queue)
-        await async_thinking(websocket, thinking_event)
+        # Resolved by the receiver with the device ID of the client
+        session: asyncio.Future[str] = loop.create_future()
+        # Audio keeps flowing in while replies and thinking notices go out
+        tasks = [
+            asyncio.create_task(
+                async_receiver(
+                    websocket, audio_pool, session_flags, session, decode_pool
+                ),
+                name="receiver",
+            ),
+            asyncio.create_task(serve_session(websocket, session), name="session"),
+        ]
+        try:
+            # The connection is over as soon as one of them returns, the receiver
+            # on disconnect
+            _done, pending = await asyncio.wait(
+                tasks, return_when=asyncio.FIRST_COMPLETED
+            )
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        logger.debug(f"Connection closed, {len(pending)} tasks cancelled")
 
     is_ready = False
     time_taken = 0